@@ -1,9 +1,16 @@
 import abc
 from typing import Any, TypeVar
-from mv.data_types import DelayArgs, ConfigArgs, State, ObsState
+from mv.data_types import DelayArgs, ConfigArgs, SubscribeArgs, State, ObsState
 from mv.state_machine import StateSubscriber, CombinedState, Attribute
 
-__all__ = ["DelayArgs", "ConfigArgs", "StateSubscriber", "CombinedState", "Attribute"]
+__all__ = [
+    "DelayArgs",
+    "ConfigArgs",
+    "SubscribeArgs",
+    "StateSubscriber",
+    "CombinedState",
+    "Attribute",
+]
 
 T = TypeVar("T")
 
@@ -104,6 +111,10 @@ class AbstractProxy:
     ):
         """"""
 
+    @abc.abstractmethod
+    def command_abort(self):
+        """"""
+
     @property
     @abc.abstractmethod
     def state(self) -> State:
@@ -9,6 +9,7 @@ from .base import (
     AsynchAbstractObserver,
     DelayArgs,
     ConfigArgs,
+    SubscribeArgs,
     StateSubscriber,
     CombinedState,
     Attribute,
@@ -24,9 +25,13 @@ class ProxyObserver(AbstractObserver):
 
     def push_event(self, data: CombinedState):
         if len(self._subscribers) == 0:
-            self.previous["state"] = data["state"]
-            self.previous["obs_state"] = data["obs_state"]
+            for attribute in ("state", "obs_state"):
+                if attribute in data:
+                    self.previous[attribute] = data[attribute]
         for subscriber, attribute in self._subscribers:
+            # a server side subscription only sends the attributes asked for
+            if attribute not in data:
+                continue
             value = data[attribute]
             if current := self.previous.get(attribute):
                 if current != value:
@@ -53,6 +58,8 @@ class AsynchProxyObserver(AsynchAbstractObserver):
 
     async def push_event(self, data: CombinedState):
         for subscriber, attribute in self._subscribers:
+            if attribute not in data:
+                continue
             value = data[attribute]
             if current := self.previous.get(attribute):
                 if current != value:
@@ -165,6 +172,18 @@ class BaseProxy(AbstractProxy):
         result = self._client.post("background_scan", json=json)
         result.raise_for_status()
 
+    def command_abort(self):
+        result = self._client.post("abort")
+        result.raise_for_status()
+
+    def set_clock(self, mode: str, scale: float | None = None):
+        result = self._client.post("clock", json={"mode": mode, "scale": scale})
+        result.raise_for_status()
+
+    def advance_clock(self, seconds: float):
+        result = self._client.post("clock/advance", json={"seconds": seconds})
+        result.raise_for_status()
+
     @property
     def state(self):
         result = self._client.get("state")
@@ -180,10 +199,10 @@ class BaseProxy(AbstractProxy):
 
 class Proxy(BaseProxy, WSListener):
 
-    def __init__(self, client: TestClient) -> None:
+    def __init__(self, client: TestClient, subscription: None | SubscribeArgs = None) -> None:
         super().__init__(client)
         self._proxy_observer = ProxyObserver()
-        WSListener.__init__(self, self._proxy_observer)
+        WSListener.__init__(self, self._proxy_observer, subscription)
 
     def subscribe(self, subscriber: StateSubscriber, attribute: Attribute = "state"):
         init_state: CombinedState = {}
@@ -195,10 +214,10 @@ class Proxy(BaseProxy, WSListener):
 
 class AsyncProxy(BaseProxy, AsyncWSListener):
 
-    def __init__(self, client: TestClient) -> None:
+    def __init__(self, client: TestClient, subscription: None | SubscribeArgs = None) -> None:
         BaseProxy.__init__(self, client)
         self._proxy_observer = AsynchProxyObserver()
-        AsyncWSListener.__init__(self, self._proxy_observer)
+        AsyncWSListener.__init__(self, self._proxy_observer, subscription)
 
     def subscribe(self, subscriber: StateSubscriber, attribute: Attribute = "state"):
         init_state: CombinedState = {}
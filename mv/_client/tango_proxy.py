@@ -50,6 +50,9 @@ class TangoProxy(AbstractProxy):
         delay_str = str(delay) if delay else ""
         self._proxy.background_switch_off(delay_str)
 
+    def command_abort(self):
+        self._proxy.abort()
+
     @property
     def state(self):
         return self._proxy.agg_state
@@ -4,11 +4,12 @@ from contextlib import asynccontextmanager, contextmanager
 import json
 from queue import Queue
 from threading import Event
-from typing import cast
+from time import sleep
+from typing import Any, cast
 import websockets
 from websockets.sync.client import connect
 
-from .base import AbstractObserver, AsynchAbstractObserver
+from .base import AbstractObserver, AsynchAbstractObserver, SubscribeArgs
 from .config import get_ws_address
 
 from mv.state_machine import AbstractPublisher, get_state_server
@@ -56,6 +57,12 @@ class MockWSServer(AbstractPublisher):
     def wait_closed(self):
         self._closed.wait()
 
+    def clear(self):
+        # the server publishes every state change, a new connection starts without the
+        # ones published before it
+        while not self.messages.empty():
+            self.messages.get_nowait()
+
     def send(self, message):
         self.messages.put(message)
 
@@ -75,6 +82,12 @@ class MockWSServer(AbstractPublisher):
         self.messages.put(state)
 
 
+# a listener that loses its connection reconnects (asking for the events it missed) this
+# many times, waiting a little longer before every next attempt
+RECONNECT_ATTEMPTS = 5
+RECONNECT_DELAY = 0.2
+RECONNECTABLE = (websockets.ConnectionClosed, OSError)
+
 _use_mock_ws = True
 _async_mock_websocket: None | AsyncMockWSServer = None
 _mock_websocket: None | MockWSServer = None
@@ -99,39 +112,61 @@ def get_mock_ws_server():
     return _mock_websocket
 
 
+def _ws_address(since: None | int) -> str:
+    if since is None:
+        return get_ws_address()
+    return f"{get_ws_address()}/?since={since}"
+
+
 @asynccontextmanager
-async def get_async_websocket():
+async def get_async_websocket(since: None | int = None):
     if _use_mock_ws:
         yield get_async_mock_ws_server()
     else:
-        async with websockets.connect(get_ws_address()) as websocket:
+        async with websockets.connect(_ws_address(since)) as websocket:
             yield websocket
 
 
 @contextmanager
-def get_websocket():
+def get_websocket(since: None | int = None):
     if _use_mock_ws:
-        yield get_mock_ws_server()
+        websocket = get_mock_ws_server()
+        websocket.clear()
+        yield websocket
     else:
-        with connect(get_ws_address()) as websocket:
+        with connect(_ws_address(since)) as websocket:
             yield websocket
 
 
+def _take_seq(message: Any, since: None | int) -> None | int:
+    # the seq is only there to resume after a reconnect, the observers get the state
+    if isinstance(message, dict) and isinstance(seq := message.pop("seq", None), int):
+        return seq
+    return since
+
+
 TestWebsocket = websockets.WebSocketClientProtocol | AsyncMockWSServer
 
 
 class AsyncWSListener:
 
-    def __init__(self, observer: AsynchAbstractObserver) -> None:
+    def __init__(
+        self, observer: AsynchAbstractObserver, subscription: None | SubscribeArgs = None
+    ) -> None:
         self._observer = observer
+        self._subscription = subscription
         self._websocket = None
         self._ws_ready = asyncio.Queue[bool | Exception]()
+        self._stopping = False
+        # the seq of the last event received
+        self.since: None | int = None
 
     @property
     def websocket(self):
         return self._websocket
 
     async def stop(self):
+        self._stopping = True
         if self._websocket:
             await self._websocket.close()
 
@@ -140,23 +175,35 @@ class AsyncWSListener:
             raise cast(Exception, result)
 
     async def _listen(self):
-        try:
-            async with get_async_websocket() as websocket:
-                self._websocket = websocket
-                await self._ws_ready.put(True)
-                while True:
-                    try:
-                        message_str = await websocket.recv()
-                        message = json.loads(message_str)
-                    except Exception as exception:
-                        await self._ws_ready.put(exception)
-                        return
-                    await self._observer.push_event(message)
-        except Exception as exception:
-            await self._ws_ready.put(exception)
+        connected = False
+        attempts = 0
+        while True:
+            try:
+                async with get_async_websocket(self.since) as websocket:
+                    self._websocket = websocket
+                    if self._subscription:
+                        await websocket.send(self._subscription.model_dump_json())
+                    if not connected:
+                        connected = True
+                        await self._ws_ready.put(True)
+                    attempts = 0
+                    while True:
+                        message = json.loads(await websocket.recv())
+                        self.since = _take_seq(message, self.since)
+                        await self._observer.push_event(message)
+            except RECONNECTABLE as exception:
+                if not connected or self._stopping or attempts == RECONNECT_ATTEMPTS:
+                    await self._ws_ready.put(exception)
+                    return
+                attempts += 1
+                await asyncio.sleep(RECONNECT_DELAY * attempts)
+            except Exception as exception:
+                await self._ws_ready.put(exception)
+                return
 
     @asynccontextmanager
     async def listening(self):
+        self._stopping = False
         task = asyncio.create_task(self._listen())
         await self._wait_for_ws_ready()
         yield self.websocket
@@ -166,31 +213,52 @@ class AsyncWSListener:
 
 class WSListener:
 
-    def __init__(self, observer: AbstractObserver) -> None:
+    def __init__(
+        self, observer: AbstractObserver, subscription: None | SubscribeArgs = None
+    ) -> None:
         self._observer = observer
+        # asks the server to only send these attributes (and possibly only on change)
+        self._subscription = subscription
         self._websocket = None
         self._ws_ready = Event()
         self._stop_signal = Event()
+        # the seq of the last event received
+        self.since: None | int = None
 
     @property
     def websocket(self):
         return self._websocket
 
     def stop(self):
+        self._stop_signal.set()
         if self._websocket:
             self._websocket.close()
 
     def _listen(self):
-        with get_websocket() as websocket:
-            self._websocket = websocket
-            self._ws_ready.set()
-            while True:
-                try:
-                    message_str = websocket.recv()
-                    message = json.loads(message_str)
-                except Exception:
+        attempts = 0
+        while True:
+            try:
+                with get_websocket(self.since) as websocket:
+                    self._websocket = websocket
+                    if self._subscription:
+                        websocket.send(self._subscription.model_dump_json())
+                    self._ws_ready.set()
+                    attempts = 0
+                    while True:
+                        message = json.loads(websocket.recv())
+                        self.since = _take_seq(message, self.since)
+                        self._observer.push_event(message)
+            except RECONNECTABLE:
+                if not self._ws_ready.is_set():
+                    raise
+                if self._stop_signal.is_set() or attempts == RECONNECT_ATTEMPTS:
                     return
-                self._observer.push_event(message)
+                attempts += 1
+                sleep(RECONNECT_DELAY * attempts)
+            except Exception:
+                if not self._ws_ready.is_set():
+                    raise
+                return
 
     def wait_for_ws_ready(
         self,
@@ -207,6 +275,7 @@ class WSListener:
 
     @contextmanager
     def listening(self):
+        self._stop_signal.clear()
         with ThreadPoolExecutor(max_workers=1) as executor:
             listening_task = executor.submit(self._listen)
             try:
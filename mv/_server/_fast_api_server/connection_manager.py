@@ -1,41 +1,235 @@
 import asyncio
+from collections import deque
 import json
+import logging
+from threading import Lock
+from typing import Any, Iterable
 from fastapi import WebSocket
 
-from mv.state_machine import AbstractPublisher, get_state_server
-from mv.data_types import CombinedState
+from mv.state_machine import (
+    AbstractPublisher,
+    get_state_server,
+    MachineId,
+    DEFAULT_MACHINE_ID,
+)
+from mv.data_types import Attribute, CombinedState
+
+logger = logging.getLogger()
+
+# a client that takes longer than this to take a message (or lets this many messages
+# queue up) is considered stuck and gets disconnected
+SEND_TIMEOUT = 5.0
+MAX_PENDING = 100
+# the number of past events kept for clients that reconnect with the last seq they got
+REPLAY_SIZE = 1000
+
+
+class _Sender:
+    # writes the messages for one websocket in order, on the loop that owns the socket
+
+    def __init__(self, manager: "ConnectionManager", websocket: WebSocket) -> None:
+        self._manager = manager
+        self.websocket = websocket
+        self.messages = asyncio.Queue[str](MAX_PENDING)
+        # None sends the whole state, otherwise only these attributes
+        self.attributes: None | tuple[Attribute, ...] = None
+        self.on_change = False
+        self.sent: dict[str, Any] = {}
+        # the seq of the last event queued, events replayed on connecting are not sent
+        # again when their broadcast comes in afterwards
+        self.seq = 0
+        self.task = asyncio.create_task(self._send())
+
+    def enqueue(self, seq: int, message: str) -> bool:
+        try:
+            self.messages.put_nowait(message)
+        except asyncio.QueueFull:
+            return False
+        self.seq = seq
+        return True
+
+    def select(self, state: CombinedState) -> None | tuple[str, ...]:
+        # the attributes of the state to send to this client, None for all of them
+        if self.attributes is None and not self.on_change:
+            return None
+        attributes = self.attributes if self.attributes is not None else tuple(state)
+        if self.on_change:
+            attributes = tuple(
+                attribute
+                for attribute in attributes
+                if attribute not in self.sent or self.sent[attribute] != state.get(attribute)
+            )
+        for attribute in attributes:
+            self.sent[attribute] = state.get(attribute)
+        return attributes
+
+    async def _send(self):
+        while True:
+            message = await self.messages.get()
+            try:
+                await asyncio.wait_for(
+                    self.websocket.send_text(message), self._manager.send_timeout
+                )
+            except Exception as exception:
+                logger.warning(f"evicting websocket client: {exception!r}")
+                await self._manager.evict(self.websocket)
+                return
 
 
 class ConnectionManager(AbstractPublisher):
-    def __init__(self):
-        self.active_connections: list[WebSocket] = []
+    def __init__(
+        self,
+        machine_id: MachineId = DEFAULT_MACHINE_ID,
+        send_timeout: float = SEND_TIMEOUT,
+        replay_size: int = REPLAY_SIZE,
+    ):
+        self._senders: dict[WebSocket, _Sender] = {}
+        # every event is stamped with the next seq and kept (serialised) for replaying,
+        # which happens on the state server thread so that no event is missed whilst
+        # there is no loop to hand it to
+        self._seq = 0
+        self._replay = deque[tuple[int, CombinedState, str]](maxlen=replay_size)
+        self._replay_lock = Lock()
+        self._machine_id = machine_id
         self._server = None
+        self._loop: None | asyncio.AbstractEventLoop = None
+        self._evictions: set[asyncio.Task] = set()
+        self.send_timeout = send_timeout
+
+    @property
+    def active_connections(self) -> list[WebSocket]:
+        return list(self._senders)
 
-    async def connect(self, websocket: WebSocket):
+    @property
+    def seq(self) -> int:
+        return self._seq
+
+    async def connect(
+        self,
+        websocket: WebSocket,
+        since: None | int = None,
+        attributes: None | Iterable[Attribute] = None,
+        on_change: bool = False,
+    ):
+        # a client that subscribes on connecting gets the events it missed as subscribed
         await websocket.accept()
+        # events are handed over to the loop serving the websockets
+        self._loop = asyncio.get_running_loop()
+        self._senders[websocket] = sender = _Sender(self, websocket)
+        sender.attributes = None if attributes is None else tuple(attributes)
+        sender.on_change = on_change
+        if since is not None:
+            self._replay_since(sender, since)
         if self._server is None:
-            self._server = get_state_server(self)
+            # a burst of changes drops the oldest rather than holding up the writers
+            self._server = get_state_server(self, self._machine_id, "drop_oldest")
             self._server.start_server()
-        self.active_connections.append(websocket)
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
-        if not self.active_connections:
-            if self._server:
-                self._server.stop_server()
-            self._server = None
+        # the state server keeps running without clients so that the events a client
+        # misses whilst reconnecting can be replayed to it
+        if sender := self._senders.pop(websocket, None):
+            if sender.task is not asyncio.current_task():
+                sender.task.cancel()
+
+    def close(self):
+        for websocket in list(self._senders):
+            self.disconnect(websocket)
+        if self._server:
+            self._server.stop_server()
+        self._server = None
+        self._loop = None
+
+    async def evict(self, websocket: WebSocket):
+        self.disconnect(websocket)
+        try:
+            await asyncio.wait_for(websocket.close(), self.send_timeout)
+        except Exception:
+            pass
+
+    def subscribe(
+        self, websocket: WebSocket, attributes: Iterable[Attribute], on_change: bool = False
+    ):
+        if sender := self._senders.get(websocket):
+            sender.attributes = tuple(attributes)
+            sender.on_change = on_change
+            sender.sent.clear()
+
+    def _replay_since(self, sender: _Sender, since: int):
+        # a reconnecting client gets the events it missed, if they are still kept,
+        # otherwise (or if it comes from before a restart) only the latest one
+        with self._replay_lock:
+            if not self._replay:
+                return
+            oldest = self._replay[0][0]
+            if oldest <= since + 1 and since <= self._seq:
+                missed = [event for event in self._replay if event[0] > since]
+            else:
+                missed = [self._replay[-1]]
+        for seq, state, full in missed:
+            if (message := self._message(sender, state, seq, {None: full})) is None:
+                continue
+            if not sender.enqueue(seq, message):
+                self._evict_later(sender.websocket)
+                return
+
+    def _evict_later(self, websocket: WebSocket):
+        logger.warning("evicting websocket client: too many pending messages")
+        eviction = asyncio.create_task(self.evict(websocket))
+        self._evictions.add(eviction)
+        eviction.add_done_callback(self._evictions.discard)
+
+    def _message(
+        self,
+        sender: _Sender,
+        state: CombinedState,
+        seq: int,
+        messages: dict[None | tuple[str, ...], str],
+    ) -> None | str:
+        # the message of the event for a client, None if none of its attributes changed;
+        # clients subscribed to the same attributes share the serialised message
+        attributes = sender.select(state)
+        if attributes == ():
+            return None
+        if (message := messages.get(attributes)) is None:
+            partial = {key: state.get(key) for key in attributes}
+            message = messages[attributes] = json.dumps({**partial, "seq": seq})
+        return message
+
+    def _broadcast(self, state: CombinedState, seq: int, full: str):
+        messages: dict[None | tuple[str, ...], str] = {None: full}
+        for websocket, sender in list(self._senders.items()):
+            if seq <= sender.seq:
+                continue
+            if (message := self._message(sender, state, seq, messages)) is None:
+                continue
+            if not sender.enqueue(seq, message):
+                self._evict_later(websocket)
 
     def publish(self, state: CombinedState):
-        for connection in self.active_connections:
-            value = json.dumps(state)
-            asyncio.run(connection.send_text(value))
+        # called from the state server thread: the stamped state is handed over to the
+        # loop where it is serialised once per distinct subscription and every client
+        # gets its own writer
+        with self._replay_lock:
+            self._seq += 1
+            seq = self._seq
+            full = json.dumps({**state, "seq": seq})
+            self._replay.append((seq, state, full))
+        if self._loop is None:
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._broadcast, state, seq, full)
+        except RuntimeError:
+            # the loop has been closed
+            self._loop = None
 
 
-_connection_manager: None | ConnectionManager = None
+_connection_managers: dict[MachineId, ConnectionManager] = {}
 
 
-def get_connection_manager():
-    global _connection_manager
-    if _connection_manager is None:
-        _connection_manager = ConnectionManager()
-    return _connection_manager
+def get_connection_manager(machine_id: MachineId = DEFAULT_MACHINE_ID):
+    if (connection_manager := _connection_managers.get(machine_id)) is None:
+        connection_manager = _connection_managers.setdefault(
+            machine_id, ConnectionManager(machine_id)
+        )
+    return connection_manager
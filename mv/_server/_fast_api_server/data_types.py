@@ -1,4 +1,4 @@
-from typing import Any
+from typing import Any, Literal
 from pydantic import BaseModel
 
 
@@ -9,3 +9,24 @@ class DelayArgs(BaseModel):
 class ConfigArgs(BaseModel):
     delay: float | None
     config: dict[str, Any] | None
+
+
+class SubscribeArgs(BaseModel):
+    # sent by a websocket client to only receive the named attributes, and optionally
+    # only when they changed, e.g. {"subscribe": ["obs_state"], "on_change": true}
+    subscribe: list[Literal["state", "obs_state"]]
+    on_change: bool = False
+
+
+class ClockArgs(BaseModel):
+    mode: Literal["real", "scaled", "virtual"]
+    scale: float | None = None
+
+
+class AdvanceArgs(BaseModel):
+    seconds: float
+
+
+class ClockInfo(BaseModel):
+    mode: Literal["real", "scaled", "virtual"]
+    now: float
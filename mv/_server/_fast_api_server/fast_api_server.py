@@ -2,29 +2,43 @@ import uvicorn
 from fastapi import (
     FastAPI,
     HTTPException,
+    Query,
     WebSocket,
     WebSocketDisconnect,
-    BackgroundTasks,
     Request,
 )
 
 import logging
 import os
+from pydantic import ValidationError
 from mv.state_machine import (
     get_async_state_machine,
     StateMachineBusyError,
     CommandNotAllowed,
+    ClockBusyError,
+    ClockError,
+    create_clock,
+    get_scheduler,
+    use_clock,
+    MachineId,
+    DEFAULT_MACHINE_ID,
 )
-from mv.data_types import State, ObsState
+from mv.data_types import Attribute, State, ObsState
 from mv._server._fast_api_server.connection_manager import get_connection_manager
-from mv._server._fast_api_server.data_types import DelayArgs, ConfigArgs
+from mv._server._fast_api_server.data_types import (
+    DelayArgs,
+    ConfigArgs,
+    ClockArgs,
+    AdvanceArgs,
+    ClockInfo,
+    SubscribeArgs,
+)
 
 logger = logging.getLogger()
 app = FastAPI()
 
-manager = get_connection_manager()
-
-state_machine = get_async_state_machine()
+# every endpoint takes an optional machine_id query parameter so that a single server
+# can host many independent state machines (e.g. one per subarray)
 
 
 @app.exception_handler(StateMachineBusyError)
@@ -41,80 +55,104 @@ async def state_machine_command_not_allowed_error(
     raise HTTPException(status_code=405, detail=exc.args)
 
 
+@app.exception_handler(ClockError)
+async def clock_error(request: Request, exc: ClockError):
+    raise HTTPException(status_code=405, detail=exc.args)
+
+
+@app.exception_handler(ClockBusyError)
+async def clock_busy_error(request: Request, exc: ClockBusyError):
+    raise HTTPException(status_code=409, detail=exc.args)
+
+
 @app.post("/background_switch_on")
 def post_switch_on_background(
-    args: DelayArgs | None, background_tasks: BackgroundTasks
+    args: DelayArgs | None,
+    machine_id: MachineId = DEFAULT_MACHINE_ID,
 ):
+    state_machine = get_async_state_machine(machine_id)
     delay = args if args is None else args.delay
-    # because we return immediately we have to check the state
-    # before pushing command to background task
-    state_machine.assert_ready()
-    background_tasks.add_task(state_machine.switch_on, delay)
-    # state_machine.wait_busy()
+    state_machine.submit("switch_on", delay)
 
 
 @app.post("/background_switch_off")
 def post_switch_off_background(
-    args: DelayArgs | None, background_tasks: BackgroundTasks
+    args: DelayArgs | None,
+    machine_id: MachineId = DEFAULT_MACHINE_ID,
 ):
+    state_machine = get_async_state_machine(machine_id)
     delay = args if args is None else args.delay
-    # because we return immediately we have to check the state
-    state_machine.assert_ready()
-    background_tasks.add_task(state_machine.switch_off, delay)
+    state_machine.submit("switch_off", delay)
 
 
 @app.post("/switch_on")
-async def post_switch_on(args: DelayArgs | None = None):
+async def post_switch_on(
+    args: DelayArgs | None = None,
+    machine_id: MachineId = DEFAULT_MACHINE_ID,
+):
+    state_machine = get_async_state_machine(machine_id)
     delay = args if args is None else args.get("delay")
     await state_machine.async_switch_on(delay)
 
 
 @app.post("/switch_off")
-async def post_switch_off(args: DelayArgs | None = None):
+async def post_switch_off(
+    args: DelayArgs | None = None,
+    machine_id: MachineId = DEFAULT_MACHINE_ID,
+):
+    state_machine = get_async_state_machine(machine_id)
     delay = args if args is None else args.delay
     await state_machine.async_switch_off(delay)
 
 
 @app.post("/scan")
-async def post_scan(args: ConfigArgs | None = None):
+async def post_scan(
+    args: ConfigArgs | None = None,
+    machine_id: MachineId = DEFAULT_MACHINE_ID,
+):
+    state_machine = get_async_state_machine(machine_id)
     delay = args if args is None else args.delay
     config = args if args is None else args.config
     await state_machine.async_scan(delay, config)
 
 
 @app.post("/background_scan")
-def post_background_scan(args: ConfigArgs | None, background_tasks: BackgroundTasks):
+def post_background_scan(
+    args: ConfigArgs | None,
+    machine_id: MachineId = DEFAULT_MACHINE_ID,
+):
+    state_machine = get_async_state_machine(machine_id)
     delay = args if args is None else args.delay
     config = args if args is None else args.config
-    # because we return immediately we have to check the state
-    # before pushing command to background task
-    state_machine.assert_ready()
-    state_machine.assert_method_allowed(state_machine.scan)
-    background_tasks.add_task(state_machine.scan, delay, config)
+    state_machine.submit("scan", delay, config)
 
 
 @app.post("/clear_config")
-async def post_clear_config(args: DelayArgs | None = None):
+async def post_clear_config(
+    args: DelayArgs | None = None,
+    machine_id: MachineId = DEFAULT_MACHINE_ID,
+):
+    state_machine = get_async_state_machine(machine_id)
     delay = args if args is None else args.delay
     await state_machine.async_clear_config(delay)
 
 
 @app.post("/background_clear_config")
 def post_background_clear_config(
-    args: DelayArgs | None, background_tasks: BackgroundTasks
+    args: DelayArgs | None,
+    machine_id: MachineId = DEFAULT_MACHINE_ID,
 ):
+    state_machine = get_async_state_machine(machine_id)
     delay = args if args is None else args.delay
-    # because we return immediately we have to check the state
-    # before pushing command to background task
-    state_machine.assert_ready()
-    state_machine.assert_method_allowed(state_machine.clear_config)
-    background_tasks.add_task(state_machine.clear_config, delay)
+    state_machine.submit("clear_config", delay)
 
 
 @app.post("/configure")
 async def post_configure(
     args: ConfigArgs | None = None,
+    machine_id: MachineId = DEFAULT_MACHINE_ID,
 ):
+    state_machine = get_async_state_machine(machine_id)
     delay = args if args is None else args.delay
     config = args if args is None else args.config
     await state_machine.async_configure(delay, config)
@@ -122,19 +160,21 @@ async def post_configure(
 
 @app.post("/background_configure")
 def background_post_configure(
-    args: ConfigArgs | None, background_tasks: BackgroundTasks
+    args: ConfigArgs | None,
+    machine_id: MachineId = DEFAULT_MACHINE_ID,
 ):
+    state_machine = get_async_state_machine(machine_id)
     delay = args if args is None else args.delay
     config = args if args is None else args.config
-    # because we return immediately we have to check the state
-    # before pushing command to background task
-    state_machine.assert_ready()
-    state_machine.assert_method_allowed(state_machine.configure)
-    background_tasks.add_task(state_machine.configure, delay, config)
+    state_machine.submit("configure", delay, config)
 
 
 @app.post("/release_resources")
-async def post_release_resources(args: ConfigArgs | None = None):
+async def post_release_resources(
+    args: ConfigArgs | None = None,
+    machine_id: MachineId = DEFAULT_MACHINE_ID,
+):
+    state_machine = get_async_state_machine(machine_id)
     delay = args if args is None else args.delay
     config = args if args is None else args.config
     await state_machine.async_release_resources(delay, config)
@@ -142,21 +182,21 @@ async def post_release_resources(args: ConfigArgs | None = None):
 
 @app.post("/background_release_resources")
 def background_post_release_resources(
-    args: ConfigArgs | None, background_tasks: BackgroundTasks
+    args: ConfigArgs | None,
+    machine_id: MachineId = DEFAULT_MACHINE_ID,
 ):
+    state_machine = get_async_state_machine(machine_id)
     delay = args if args is None else args.delay
     config = args if args is None else args.config
-    # because we return immediately we have to check the state
-    # before pushing command to background task
-    state_machine.assert_ready()
-    state_machine.assert_method_allowed(state_machine.release_resources)
-    background_tasks.add_task(state_machine.release_resources, delay, config)
+    state_machine.submit("release_resources", delay, config)
 
 
 @app.post("/assign_resources")
 async def post_assign_resources(
     args: ConfigArgs | None = None,
+    machine_id: MachineId = DEFAULT_MACHINE_ID,
 ):
+    state_machine = get_async_state_machine(machine_id)
     delay = args if args is None else args.delay
     config = args if args is None else args.config
     await state_machine.async_assign_resources(delay, config)
@@ -165,34 +205,79 @@ async def post_assign_resources(
 @app.post("/background_assign_resources")
 def background_post_assign_resources(
     args: ConfigArgs | None,
-    background_tasks: BackgroundTasks,
+    machine_id: MachineId = DEFAULT_MACHINE_ID,
 ):
+    state_machine = get_async_state_machine(machine_id)
     delay = args if args is None else args.delay
     config = args if args is None else args.config
-    # because we return immediately we have to check the state
-    # before pushing command to background task
-    state_machine.assert_ready()
-    state_machine.assert_method_allowed(state_machine.assign_resources)
-    background_tasks.add_task(state_machine.assign_resources, delay, config)
+    state_machine.submit("assign_resources", delay, config)
+
+
+@app.post("/abort")
+async def post_abort(machine_id: MachineId = DEFAULT_MACHINE_ID):
+    state_machine = get_async_state_machine(machine_id)
+    await state_machine.async_abort()
+
+
+def _clock_info() -> ClockInfo:
+    clock = get_scheduler().clock
+    return ClockInfo(mode=clock.mode, now=clock.now())
+
+
+# the clock the delays of all commands are measured on, e.g. a virtual clock lets a test
+# suite step through delayed transitions without waiting for them
+@app.get("/clock")
+def app_get_clock() -> ClockInfo:
+    return _clock_info()
+
+
+@app.post("/clock")
+def post_clock(args: ClockArgs) -> ClockInfo:
+    use_clock(create_clock(args.mode, args.scale))
+    return _clock_info()
+
+
+@app.post("/clock/advance")
+def post_advance_clock(args: AdvanceArgs) -> ClockInfo:
+    get_scheduler().clock.advance(args.seconds)
+    return _clock_info()
 
 
 @app.get("/state")
-def app_get_state() -> State | None:
-    return state_machine.state
+async def app_get_state(machine_id: MachineId = DEFAULT_MACHINE_ID) -> State | None:
+    state_machine = get_async_state_machine(machine_id)
+    return await state_machine.async_get_attribute("state")
 
 
 @app.get("/obs_state")
-def app_get_obs_state() -> ObsState | None:
-    return state_machine.obs_state
+async def app_get_obs_state(machine_id: MachineId = DEFAULT_MACHINE_ID) -> ObsState | None:
+    state_machine = get_async_state_machine(machine_id)
+    return await state_machine.async_get_attribute("obs_state")
 
 
 @app.websocket("/")
-async def websocket_endpoint(websocket: WebSocket):
-    await manager.connect(websocket)
+async def websocket_endpoint(
+    websocket: WebSocket,
+    machine_id: MachineId = DEFAULT_MACHINE_ID,
+    since: int | None = None,
+    subscribe: list[Attribute] | None = Query(None),
+    on_change: bool = False,
+):
+    # every event carries a seq, a client that reconnects with the last one it got
+    # receives the events it missed, as subscribed with subscribe and on_change (e.g.
+    # ?since=5&subscribe=obs_state&on_change=true) rather than with a message later
+    manager = get_connection_manager(machine_id)
+    await manager.connect(websocket, since, subscribe, on_change)
     try:
         while True:
             data = await websocket.receive_text()
-            await websocket.send_text(data)
+            try:
+                subscription = SubscribeArgs.model_validate_json(data)
+            except ValidationError:
+                # anything but a subscription is echoed back
+                await websocket.send_text(data)
+            else:
+                manager.subscribe(websocket, subscription.subscribe, subscription.on_change)
     except WebSocketDisconnect:
         manager.disconnect(websocket)
 
@@ -1,7 +1,12 @@
-from threading import Thread
 from typing import cast
 from tango.server import Device, command, attribute
-from mv.state_machine import get_state_machine, get_state_server
+from mv.state_machine import (
+    get_state_machine,
+    get_state_server,
+    advance_clock,
+    create_clock,
+    use_clock,
+)
 
 
 class _Args:
@@ -22,7 +27,6 @@ class App(Device):
     def __init__(self, cl, name):
         super().__init__(cl, name)
         self._state_machine = get_state_machine()
-        self._executor: None | Thread = None
         self._server = get_state_server(self)
         self._server.start_server()
         self.set_change_event("agg_state", True, False)
@@ -36,16 +40,10 @@ class App(Device):
         return cast(str, self._state_machine.state)
 
     def _background_on(self, delay: float | None):
-        self._executor = Thread(
-            target=self._state_machine.switch_on, args=[delay], daemon=True
-        )
-        self._executor.start()
+        self._state_machine.submit("switch_on", delay)
 
     def _background_off(self, delay: float | None):
-        self._executor = Thread(
-            target=self._state_machine.switch_off, args=[delay], daemon=True
-        )
-        self._executor.start()
+        self._state_machine.submit("switch_off", delay)
 
     @command(dtype_in=str)
     def switch_on(self, input_args: str):
@@ -65,6 +63,21 @@ class App(Device):
                 return
         self._state_machine.switch_off()
 
+    @command
+    def abort(self):
+        # cancels the command in flight and moves through ABORTED to IDLE
+        self._state_machine.abort()
+
+    @command(dtype_in=str)
+    def set_clock(self, input_args: str):
+        # e.g. "virtual", "real" or "scaled:100", refused whilst commands are in flight
+        mode, _, scale = input_args.partition(":")
+        use_clock(create_clock(mode, float(scale) if scale else None))
+
+    @command(dtype_in=float)
+    def advance_clock(self, seconds: float):
+        advance_clock(seconds)
+
     @command(dtype_in=str)
     def background_switch_off(self, input_args: str):
         args = _Args(input_args)
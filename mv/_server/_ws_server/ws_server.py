@@ -2,7 +2,12 @@ import asyncio
 from queue import Queue
 from websockets.server import serve
 
-from mv.state_machine import state_server, AbstractPublisher, get_state_updater
+from mv.state_machine import (
+    state_server,
+    AbstractPublisher,
+    get_state_updater,
+    advance_clock,
+)
 
 
 class Publisher(AbstractPublisher):
@@ -42,6 +47,9 @@ async def command_listener(websocket):
             await set_state_on()
         elif command == "OFF":
             await set_state_off()
+        elif command.startswith("ADVANCE "):
+            # moves a virtual clock on, e.g. "ADVANCE 2.5"
+            advance_clock(float(command.removeprefix("ADVANCE ")))
 
 
 async def echo(websocket):
@@ -51,7 +59,9 @@ async def echo(websocket):
 
 async def state_machine(websocket):
     publisher = Publisher()
-    with state_server(publisher):
+    # each connection only needs the latest state, so a slow client skips the ones in
+    # between instead of holding up the others
+    with state_server(publisher, policy="keep_latest"):
         while event := await publisher.get_new_event():
             value = event["state"]
             await websocket.send(value)
@@ -1,14 +1,20 @@
 import abc
-from contextlib import contextmanager
-from typing import Generator, Literal, TypedDict
+from contextlib import asynccontextmanager, contextmanager
+from typing import AsyncGenerator, Generator, Literal, TypedDict
+
+from .event_hub import DEFAULT_MAXSIZE, DEFAULT_POLICY, Policy
 
 State = Literal["ON", "OFF", "BUSY"]
 ObsState = Literal[
-    "EMPTY", "RESOURCING", "IDLE", "CONFIGURING", "READY", "SCANNING", "BUSY"
+    "EMPTY", "RESOURCING", "IDLE", "CONFIGURING", "READY", "SCANNING", "BUSY", "ABORTED"
 ]
 
 Attribute = Literal["state", "obs_state"]
 
+MachineId = str
+
+DEFAULT_MACHINE_ID: MachineId = "default"
+
 
 class CombinedState(TypedDict):
     state: State
@@ -60,6 +66,18 @@ class AbstractStateUpdater:
     def atomic(self) -> Generator[None, None, None]:
         raise NotImplementedError()
 
+    @abc.abstractmethod
+    @asynccontextmanager
+    async def async_update_state(
+        self,
+    ) -> AsyncGenerator[CombinedState, None]:
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    @asynccontextmanager
+    async def async_atomic(self) -> AsyncGenerator[None, None]:
+        raise NotImplementedError()
+
     @abc.abstractmethod
     def get_state(self) -> CombinedState:
         raise NotImplementedError()
@@ -73,6 +91,63 @@ class AbstractStateUpdater:
     def state_machine_is_busy(self) -> bool:
         """"""
 
+    # a command marks the machine busy in the backend from its first phase until it
+    # finishes, so that the other processes sharing the backend don't start one of their
+    # own; the mark is a lease (see config.COMMAND_LEASE) renewed whilst the command runs.
+    # Backends only used by this process leave it to the scheduler.
+    @property
+    def leases_commands(self) -> bool:
+        return False
+
+    def begin_command(self, command: str) -> bool:
+        # False if a command of another process holds the machine
+        return True
+
+    def renew_command(self) -> bool:
+        # False if the lease ran out (and may have been taken by another) in the meantime
+        return True
+
+    def end_command(self) -> None:
+        """"""
+
+    def abort_command(self) -> None:
+        # frees the machine from the command in flight, whichever process began it: that
+        # process finds its lease gone on its next renewal and its writes refused
+        """"""
+
+    def command_lost(self) -> bool:
+        # True once the command begun by this updater was aborted or its lease taken
+        # over; called whilst updating the state, backends that refuse such writes
+        # themselves need not check
+        return False
+
+    def command_in_flight(self) -> bool:
+        return False
+
+    # backends whose reads go over the network override these so that they don't block
+    # the event loop
+    async def async_get_state(self) -> CombinedState:
+        return self.get_state()
+
+    async def async_state_machine_is_busy(self) -> bool:
+        return self.state_machine_is_busy()
+
+    async def async_begin_command(self, command: str) -> bool:
+        return self.begin_command(command)
+
+    async def async_end_command(self) -> None:
+        self.end_command()
+
+    async def async_abort_command(self) -> None:
+        self.abort_command()
+
+    # backends that store attributes apart read only the one asked for
+    def get_attribute(self, attribute: Attribute):
+        return self.get_state().get(attribute)
+
+    async def async_get_attribute(self, attribute: Attribute):
+        return (await self.async_get_state()).get(attribute)
+
 
 class AbstractStateServer:
 
@@ -88,9 +163,18 @@ class AbstractStateServer:
 class AbstractFactory:
 
     @abc.abstractmethod
-    def get_state_updater(self) -> AbstractStateUpdater:
+    def get_state_updater(
+        self, machine_id: MachineId = DEFAULT_MACHINE_ID
+    ) -> AbstractStateUpdater:
         """"""
 
+    # policy and maxsize bound the events queued for the server, see event_hub.Policy
     @abc.abstractmethod
-    def get_state_server(self, publisher: AbstractPublisher) -> AbstractStateServer:
+    def get_state_server(
+        self,
+        publisher: AbstractPublisher,
+        machine_id: MachineId = DEFAULT_MACHINE_ID,
+        policy: Policy = DEFAULT_POLICY,
+        maxsize: int = DEFAULT_MAXSIZE,
+    ) -> AbstractStateServer:
         """"""
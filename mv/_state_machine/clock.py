@@ -0,0 +1,137 @@
+import abc
+from threading import Lock
+from time import monotonic
+from typing import Callable, Literal
+
+from . import config
+
+ClockMode = Literal["real", "scaled", "virtual"]
+
+
+class ClockError(Exception):
+    pass
+
+
+class ClockBusyError(ClockError):
+    # the clock can not be switched whilst commands are in flight on it
+    pass
+
+
+class Clock:
+    # the time base of the scheduler: delays of commands are measured in clock seconds,
+    # which need not be wall clock seconds
+
+    mode: ClockMode
+
+    def __init__(self) -> None:
+        self._listeners: list[Callable[[], None]] = []
+
+    @abc.abstractmethod
+    def now(self) -> float:
+        """"""
+
+    # the wall clock seconds it takes for a duration in clock seconds to pass, None if it
+    # only passes when the clock gets moved by hand
+    @abc.abstractmethod
+    def timeout(self, duration: float) -> float | None:
+        """"""
+
+    def subscribe(self, listener: Callable[[], None]):
+        # listeners are called whenever the clock got moved by hand
+        self._listeners.append(listener)
+
+    def unsubscribe(self, listener: Callable[[], None]):
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def _moved(self):
+        for listener in list(self._listeners):
+            listener()
+
+    def advance(self, seconds: float):
+        raise ClockError(f"a {self.mode} clock can not be advanced")
+
+    def __call__(self) -> float:
+        return self.now()
+
+
+class RealClock(Clock):
+
+    mode: ClockMode = "real"
+
+    def now(self) -> float:
+        return monotonic()
+
+    def timeout(self, duration: float) -> float | None:
+        return duration
+
+
+class ScaledClock(Clock):
+
+    mode: ClockMode = "scaled"
+
+    def __init__(self, factor: float) -> None:
+        super().__init__()
+        if factor <= 0:
+            raise ClockError(f"time scale must be positive, got {factor}")
+        self.factor = factor
+        self._start = monotonic()
+
+    def now(self) -> float:
+        return (monotonic() - self._start) * self.factor
+
+    def timeout(self, duration: float) -> float | None:
+        return duration / self.factor
+
+
+class VirtualClock(Clock):
+
+    mode: ClockMode = "virtual"
+
+    def __init__(self, start: float = 0.0) -> None:
+        super().__init__()
+        self._now = start
+        self._lock = Lock()
+
+    def now(self) -> float:
+        return self._now
+
+    def timeout(self, duration: float) -> float | None:
+        return None
+
+    def advance(self, seconds: float):
+        if seconds < 0:
+            raise ClockError(f"time can not go backwards, got {seconds}")
+        with self._lock:
+            self._now += seconds
+        self._moved()
+
+    def advance_to(self, time: float):
+        with self._lock:
+            self._now = max(self._now, time)
+        self._moved()
+
+
+def create_clock(mode: ClockMode, factor: float | None = None) -> Clock:
+    if mode == "real":
+        return RealClock()
+    if mode == "scaled":
+        return ScaledClock(factor if factor else config.get_time_scale())
+    if mode == "virtual":
+        return VirtualClock()
+    raise ClockError(f"unknown clock {mode}, expected one of real, scaled or virtual")
+
+
+_clock: None | Clock = None
+
+
+def get_clock() -> Clock:
+    global _clock
+    if _clock is None:
+        _clock = create_clock(config.get_clock_mode())
+    return _clock
+
+
+def set_clock(clock: Clock | None):
+    global _clock
+    _clock = clock
@@ -2,6 +2,54 @@ import os
 
 REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
 REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+# how the redis updater writes the state: script (a lua compare and set), transaction
+# (WATCH/MULTI, for servers that don't allow scripts) or lock (a redis lock around it)
+REDIS_UPDATE_MODE = os.getenv("REDIS_UPDATE_MODE", "script")
+# how state changes reach the state servers: pubsub (fire and forget) or streams (an
+# event log, trimmed to about REDIS_STREAM_MAXLEN entries, that readers resume from)
+REDIS_STATE_TRANSPORT = os.getenv("REDIS_STATE_TRANSPORT", "pubsub")
+REDIS_STREAM_MAXLEN = int(os.getenv("REDIS_STREAM_MAXLEN", "10000"))
+# a consumer group (e.g. the pod name) lets a stream reader resume where it left off
+# after a restart, without it a reader starts at the newest event
+REDIS_STREAM_GROUP = os.getenv("REDIS_STREAM_GROUP")
+# set to keep a local copy of the redis state for reads, used as long as it is known to be
+# no more than this many seconds behind
+REDIS_MIRROR_MAX_AGE = float(os.getenv("REDIS_MIRROR_MAX_AGE", "0"))
+# how the redis updater stores the state: json (one string for the whole state) or hash (a
+# field per attribute, so that a write or a read touches only the attributes it needs)
+REDIS_STATE_LAYOUT = os.getenv("REDIS_STATE_LAYOUT", "json")
+# put in front of every redis key, so that several deployments can share a redis
+REDIS_KEY_PREFIX = os.getenv("REDIS_KEY_PREFIX", "")
+# the lease (in seconds) of the lock the lock mode takes around every write
+REDIS_LOCK_LEASE = float(os.getenv("REDIS_LOCK_LEASE", "10"))
+# the lease (in seconds) by which a command in flight marks the machine busy in a backend
+# shared with other processes, renewed for as long as the command runs so that it only
+# bounds how long a process that died keeps the machine busy
+COMMAND_LEASE = float(os.getenv("COMMAND_LEASE", "10"))
+# how PERSIST_STATE_IN_FILE keeps the state: json (the whole state rewritten on every
+# write), journal (the changes appended to a journal that is compacted into a snapshot
+# every STATE_JOURNAL_COMPACT_EVERY records, keeping STATE_JOURNAL_KEEP old journals) or
+# mmap (a fixed size record in a memory mapped file, read without system calls)
+STATE_FILE_FORMAT = os.getenv("STATE_FILE_FORMAT", "json")
+# how a state server finds the writes of other processes to the state file: auto (woken by
+# inotify, looking every STATE_FILE_POLL_INTERVAL seconds where there is none), poll or off
+STATE_FILE_WATCH = os.getenv("STATE_FILE_WATCH", "auto")
+STATE_FILE_POLL_INTERVAL = float(os.getenv("STATE_FILE_POLL_INTERVAL", "0.1"))
+# appended records are synced to disk in batches at most this many seconds apart (0 syncs
+# every record before the write returns)
+STATE_JOURNAL_FSYNC_INTERVAL = float(os.getenv("STATE_JOURNAL_FSYNC_INTERVAL", "0.05"))
+STATE_JOURNAL_COMPACT_EVERY = int(os.getenv("STATE_JOURNAL_COMPACT_EVERY", "1000"))
+STATE_JOURNAL_KEEP = int(os.getenv("STATE_JOURNAL_KEEP", "10"))
+# the database of USE_SQLITE_FOR_STATE_SERVER, shared by the processes of a node
+SQLITE_PATH = os.getenv("SQLITE_PATH", ".build/state.db")
+# how long (in seconds) a writer waits for the database held by another writer
+SQLITE_BUSY_TIMEOUT = float(os.getenv("SQLITE_BUSY_TIMEOUT", "5"))
+# how often a state server looks for commits of other processes
+SQLITE_POLL_INTERVAL = float(os.getenv("SQLITE_POLL_INTERVAL", "0.1"))
+# transitions kept per machine, 0 keeps them all
+SQLITE_HISTORY_KEEP = int(os.getenv("SQLITE_HISTORY_KEEP", "10000"))
+STATE_MACHINE_CLOCK = os.getenv("STATE_MACHINE_CLOCK")
+STATE_MACHINE_TIME_SCALE = float(os.getenv("STATE_MACHINE_TIME_SCALE", "1"))
 
 
 def get_redis_host() -> str:
@@ -10,3 +58,90 @@ def get_redis_host() -> str:
 
 def get_redis_port() -> int:
     return REDIS_PORT
+
+
+def get_redis_update_mode() -> str:
+    return REDIS_UPDATE_MODE
+
+
+def get_redis_state_transport() -> str:
+    return REDIS_STATE_TRANSPORT
+
+
+def get_redis_stream_maxlen() -> int:
+    return REDIS_STREAM_MAXLEN
+
+
+def get_redis_stream_group() -> str | None:
+    return REDIS_STREAM_GROUP
+
+
+def get_redis_mirror_max_age() -> float:
+    return REDIS_MIRROR_MAX_AGE
+
+
+def get_redis_state_layout() -> str:
+    return REDIS_STATE_LAYOUT
+
+
+def get_redis_key_prefix() -> str:
+    return REDIS_KEY_PREFIX
+
+
+def get_redis_lock_lease() -> float:
+    return REDIS_LOCK_LEASE
+
+
+def get_command_lease() -> float:
+    return COMMAND_LEASE
+
+
+def get_state_file_format() -> str:
+    return STATE_FILE_FORMAT
+
+
+def get_state_file_watch() -> str:
+    return STATE_FILE_WATCH
+
+
+def get_state_file_poll_interval() -> float:
+    return STATE_FILE_POLL_INTERVAL
+
+
+def get_sqlite_path() -> str:
+    return SQLITE_PATH
+
+
+def get_sqlite_busy_timeout() -> float:
+    return SQLITE_BUSY_TIMEOUT
+
+
+def get_sqlite_poll_interval() -> float:
+    return SQLITE_POLL_INTERVAL
+
+
+def get_sqlite_history_keep() -> int:
+    return SQLITE_HISTORY_KEEP
+
+
+def get_state_journal_fsync_interval() -> float:
+    return STATE_JOURNAL_FSYNC_INTERVAL
+
+
+def get_state_journal_compact_every() -> int:
+    return STATE_JOURNAL_COMPACT_EVERY
+
+
+def get_state_journal_keep() -> int:
+    return STATE_JOURNAL_KEEP
+
+
+def get_clock_mode() -> str:
+    if STATE_MACHINE_CLOCK:
+        return STATE_MACHINE_CLOCK
+    # setting a time scale on its own is enough to run on a scaled clock
+    return "scaled" if STATE_MACHINE_TIME_SCALE != 1 else "real"
+
+
+def get_time_scale() -> float:
+    return STATE_MACHINE_TIME_SCALE
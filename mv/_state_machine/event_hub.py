@@ -0,0 +1,123 @@
+from collections import deque
+from queue import Empty
+from threading import Condition, Lock
+from typing import Generic, Iterator, Literal, TypeVar
+
+T = TypeVar("T")
+
+# how a subscription that fell behind treats a new event:
+# block: the producer waits (for at most block_timeout) for room in the queue
+# drop_oldest: the oldest queued event makes room for the new one
+# keep_latest: only the newest event is kept, any queued event is replaced
+Policy = Literal["block", "drop_oldest", "keep_latest"]
+# a subscriber that falls behind does not hold up the writers unless it asks to
+DEFAULT_POLICY: Policy = "drop_oldest"
+
+DEFAULT_MAXSIZE = 1000
+# events are published whilst the state write lock is held, a blocking subscriber that
+# stopped consuming therefore only holds up writers for so long before it loses events
+BLOCK_TIMEOUT = 1.0
+
+
+class SubscriptionClosed(Exception):
+    pass
+
+
+class Subscription(Generic[T]):
+
+    def __init__(
+        self,
+        hub: "EventHub[T]",
+        maxsize: int = DEFAULT_MAXSIZE,
+        policy: Policy = DEFAULT_POLICY,
+        block_timeout: float = BLOCK_TIMEOUT,
+    ) -> None:
+        self._hub = hub
+        self.maxsize = 1 if policy == "keep_latest" else max(maxsize, 1)
+        self.policy: Policy = policy
+        self._block_timeout = block_timeout
+        self._events: deque[T] = deque()
+        self._condition = Condition()
+        self._closed = False
+        self.dropped = 0
+
+    def __len__(self) -> int:
+        return len(self._events)
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def put(self, event: T):
+        with self._condition:
+            if self._closed:
+                return
+            if len(self._events) >= self.maxsize and self.policy == "block":
+                self._condition.wait_for(
+                    lambda: len(self._events) < self.maxsize or self._closed,
+                    self._block_timeout,
+                )
+            while len(self._events) >= self.maxsize:
+                self._events.popleft()
+                self.dropped += 1
+            self._events.append(event)
+            self._condition.notify_all()
+
+    def get(self, timeout: float | None = None) -> T:
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._events or self._closed, timeout):
+                raise Empty()
+            if self._events:
+                event = self._events.popleft()
+                self._condition.notify_all()
+                return event
+            raise SubscriptionClosed()
+
+    def __iter__(self) -> Iterator[T]:
+        # iterates over the events until the subscription gets closed
+        while True:
+            try:
+                yield self.get()
+            except SubscriptionClosed:
+                return
+
+    def close(self):
+        self._hub.unsubscribe(self)
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
+class EventHub(Generic[T]):
+    # fans every published event out to all subscriptions, each with a bounded queue of
+    # its own so that a slow subscriber only affects itself (unless it chose to block)
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        # replaced rather than changed so that publishing iterates without the lock
+        self._subscriptions: tuple[Subscription[T], ...] = ()
+
+    def subscribe(
+        self,
+        maxsize: int = DEFAULT_MAXSIZE,
+        policy: Policy = DEFAULT_POLICY,
+        block_timeout: float = BLOCK_TIMEOUT,
+    ) -> Subscription[T]:
+        subscription = Subscription(self, maxsize, policy, block_timeout)
+        with self._lock:
+            self._subscriptions = (*self._subscriptions, subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription[T]):
+        with self._lock:
+            self._subscriptions = tuple(
+                existing for existing in self._subscriptions if existing is not subscription
+            )
+
+    @property
+    def subscriptions(self) -> tuple[Subscription[T], ...]:
+        return self._subscriptions
+
+    def publish(self, event: T):
+        for subscription in self._subscriptions:
+            subscription.put(event)
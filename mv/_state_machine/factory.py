@@ -1,4 +1,5 @@
 import os
+from threading import Lock
 import fakeredis
 import redis
 import redis.asyncio as asyncio_redis
@@ -8,42 +9,93 @@ from .base import (
     AbstractPublisher,
     AbstractStateServer,
     AbstractStateUpdater,
+    DEFAULT_MACHINE_ID,
+    MachineId,
+)
+from .event_hub import DEFAULT_MAXSIZE, DEFAULT_POLICY, Policy
+from .file_backend import (
+    FileStateServer,
+    InFileStateUpdater,
+    JournalStateUpdater,
+    MmapStateUpdater,
 )
-from .file_backend import InFileStateUpdater
 from .inmem_backend import InMemStateUpdater
-from .redis_backend import RedisStateUpdater, RedisStateServer
+from .redis_backend import (
+    RedisHashStateUpdater,
+    RedisStateServer,
+    RedisStateUpdater,
+    RedisStreamStateServer,
+    StateMirror,
+)
+from .sqlite_backend import SqliteStateServer, SqliteStateUpdater
 from .state_server import StateServer
 from . import config
 
 
 class InMemFactory(AbstractFactory):
 
-    def get_state_updater(self) -> InMemStateUpdater:
-        return InMemStateUpdater()
+    def get_state_updater(
+        self, machine_id: MachineId = DEFAULT_MACHINE_ID
+    ) -> InMemStateUpdater:
+        return InMemStateUpdater(machine_id)
 
-    def get_state_server(self, publisher: AbstractPublisher) -> AbstractStateServer:
-        state_updater = self.get_state_updater()
-        return StateServer(publisher, state_updater)
+    def get_state_server(
+        self,
+        publisher: AbstractPublisher,
+        machine_id: MachineId = DEFAULT_MACHINE_ID,
+        policy: Policy = DEFAULT_POLICY,
+        maxsize: int = DEFAULT_MAXSIZE,
+    ) -> AbstractStateServer:
+        state_updater = self.get_state_updater(machine_id)
+        return StateServer(publisher, state_updater, machine_id, policy, maxsize)
 
 
 class DefaultFactory(AbstractFactory):
 
-    def get_state_updater(self) -> InMemStateUpdater | InFileStateUpdater:
+    def get_state_updater(
+        self, machine_id: MachineId = DEFAULT_MACHINE_ID
+    ) -> InMemStateUpdater | InFileStateUpdater | JournalStateUpdater | MmapStateUpdater:
         if os.getenv("PERSIST_STATE_IN_FILE"):
-            return InFileStateUpdater()
-        return InMemStateUpdater()
-
-    def get_state_server(self, publisher: AbstractPublisher) -> AbstractStateServer:
-        state_updater = self.get_state_updater()
-        return StateServer(publisher, state_updater)
+            if config.get_state_file_format() == "journal":
+                return JournalStateUpdater(machine_id)
+            if config.get_state_file_format() == "mmap":
+                return MmapStateUpdater(machine_id)
+            return InFileStateUpdater(machine_id)
+        return InMemStateUpdater(machine_id)
+
+    def get_state_server(
+        self,
+        publisher: AbstractPublisher,
+        machine_id: MachineId = DEFAULT_MACHINE_ID,
+        policy: Policy = DEFAULT_POLICY,
+        maxsize: int = DEFAULT_MAXSIZE,
+    ) -> AbstractStateServer:
+        state_updater = self.get_state_updater(machine_id)
+        if isinstance(state_updater, InMemStateUpdater) or config.get_state_file_watch() == "off":
+            return StateServer(publisher, state_updater, machine_id, policy, maxsize)
+        # other processes may share the file
+        return FileStateServer(publisher, state_updater, machine_id, policy, maxsize)
 
 
 class Redisfactory(AbstractFactory):
-
-    def __init__(self) -> None:
-        if os.getenv("USEFAKE_REDIS"):
-            self._redis_client = fakeredis.FakeRedis()
-            self._async_redis_client = fakeredis.FakeAsyncRedis()
+    # the updaters of a machine share one mirror of its state (see StateMirror), which is
+    # stopped with the state server of the machine
+
+    def __init__(
+        self,
+        redis_client: None | redis.Redis = None,
+        async_redis_client: None | asyncio_redis.Redis = None,
+    ) -> None:
+        self._mirrors: dict[tuple[MachineId, str, str], StateMirror] = {}
+        self._mirrors_lock = Lock()
+        if redis_client is not None and async_redis_client is not None:
+            self._redis_client = redis_client
+            self._async_redis_client = async_redis_client
+        elif os.getenv("USEFAKE_REDIS"):
+            # both clients talk to the same fake server, as they would to redis
+            server = fakeredis.FakeServer()
+            self._redis_client = fakeredis.FakeRedis(server=server)
+            self._async_redis_client = fakeredis.FakeAsyncRedis(server=server)
         else:
             redis_port = config.get_redis_port()
             redis_host = config.get_redis_host()
@@ -52,13 +104,74 @@ class Redisfactory(AbstractFactory):
                 host=redis_host, port=redis_port, db=0
             )
 
-    def get_state_updater(self) -> AbstractStateUpdater:
-        return RedisStateUpdater(self._redis_client, self._async_redis_client)
+    def _get_mirror(self, machine_id: MachineId) -> None | StateMirror:
+        max_age = config.get_redis_mirror_max_age()
+        # fake redis lives in this process and publishes on the hub instead
+        if max_age <= 0 or isinstance(self._redis_client, fakeredis.FakeRedis):
+            return None
+        transport = config.get_redis_state_transport()
+        layout = "hash" if config.get_redis_state_layout() == "hash" else "json"
+        with self._mirrors_lock:
+            mirror = self._mirrors.get((machine_id, transport, layout))
+            if mirror is None or mirror.stopped:
+                mirror = StateMirror(
+                    self._async_redis_client, machine_id, transport, max_age, layout
+                )
+                self._mirrors[(machine_id, transport, layout)] = mirror
+        return mirror
+
+    def get_state_updater(
+        self, machine_id: MachineId = DEFAULT_MACHINE_ID
+    ) -> AbstractStateUpdater:
+        mirror = self._get_mirror(machine_id)
+        if config.get_redis_state_layout() == "hash":
+            return RedisHashStateUpdater(
+                self._redis_client, self._async_redis_client, machine_id, mirror=mirror
+            )
+        return RedisStateUpdater(
+            self._redis_client, self._async_redis_client, machine_id, mirror=mirror
+        )
+
+    def get_state_server(
+        self,
+        publisher: AbstractPublisher,
+        machine_id: MachineId = DEFAULT_MACHINE_ID,
+        policy: Policy = DEFAULT_POLICY,
+        maxsize: int = DEFAULT_MAXSIZE,
+    ) -> RedisStateServer | RedisStreamStateServer:
+        # redis fans the notifications out to every subscribed connection itself, so
+        # the policy of the in process hub does not apply
+        mirror = self._get_mirror(machine_id)
+        if config.get_redis_state_transport() == "streams":
+            return RedisStreamStateServer(
+                publisher,
+                self._redis_client,
+                machine_id,
+                config.get_redis_stream_group(),
+                mirror=mirror,
+            )
+        state_updater = self.get_state_updater(machine_id)
+        return RedisStateServer(
+            publisher, self._async_redis_client, state_updater, machine_id, mirror
+        )
+
+
+class SqliteFactory(AbstractFactory):
+
+    def get_state_updater(
+        self, machine_id: MachineId = DEFAULT_MACHINE_ID
+    ) -> SqliteStateUpdater:
+        return SqliteStateUpdater(machine_id)
 
-    def get_state_server(self, publisher: AbstractPublisher) -> RedisStateServer:
-        redis_producer = self._redis_client.pubsub()
-        state_updater = self.get_state_updater()
-        return RedisStateServer(publisher, redis_producer, state_updater)
+    def get_state_server(
+        self,
+        publisher: AbstractPublisher,
+        machine_id: MachineId = DEFAULT_MACHINE_ID,
+        policy: Policy = DEFAULT_POLICY,
+        maxsize: int = DEFAULT_MAXSIZE,
+    ) -> SqliteStateServer:
+        state_updater = self.get_state_updater(machine_id)
+        return SqliteStateServer(publisher, state_updater, machine_id, policy, maxsize)
 
 
 _factory: None | AbstractFactory = None
@@ -78,16 +191,23 @@ def _get_factory():
     if _factory is None:
         if os.getenv("USE_REDIS_FOR_STATE_SERVER"):
             _factory = Redisfactory()
+        elif os.getenv("USE_SQLITE_FOR_STATE_SERVER"):
+            _factory = SqliteFactory()
         else:
             _factory = DefaultFactory()
     return _factory
 
 
-def get_state_server(publisher: AbstractPublisher) -> AbstractStateServer:
+def get_state_server(
+    publisher: AbstractPublisher,
+    machine_id: MachineId = DEFAULT_MACHINE_ID,
+    policy: Policy = DEFAULT_POLICY,
+    maxsize: int = DEFAULT_MAXSIZE,
+) -> AbstractStateServer:
     factory = _get_factory()
-    return factory.get_state_server(publisher)
+    return factory.get_state_server(publisher, machine_id, policy, maxsize)
 
 
-def get_state_updater() -> AbstractStateUpdater:
+def get_state_updater(machine_id: MachineId = DEFAULT_MACHINE_ID) -> AbstractStateUpdater:
     factory = _get_factory()
-    return factory.get_state_updater()
+    return factory.get_state_updater(machine_id)
@@ -1,3 +1,13 @@
+from .file_state_server import FileStateServer
 from .file_stateupdater import InFileStateUpdater
+from .journal_stateupdater import JournalStateUpdater
+from .mmap_stateupdater import MmapStateUpdater
+from .watcher import FileWatcher
 
-__all__ = ["InFileStateUpdater"]
+__all__ = [
+    "FileStateServer",
+    "FileWatcher",
+    "InFileStateUpdater",
+    "JournalStateUpdater",
+    "MmapStateUpdater",
+]
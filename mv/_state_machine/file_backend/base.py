@@ -1,3 +1,166 @@
-from ..stateupdater import StateUpdater, State
+from functools import cached_property
+import json
+import os
+from pathlib import Path
+from threading import Lock
+from time import time
+from typing import IO, Any
+from uuid import uuid4
 
-__all__ = ["StateUpdater", "State"]
+from ..stateupdater import StateUpdater, State, DEFAULT_MACHINE_ID, MachineId
+from ..state_notifier import get_state_notifier
+from .. import config
+from .flock import async_file_lock, file_lock
+
+
+class WatchableStateUpdater(StateUpdater):
+    # a state kept in files that other processes may write too: their writes are published
+    # here by calling publish_changes whenever one of watched_paths changed (see
+    # FileStateServer), the writes of this process publish their states themselves.
+    # A command in flight is marked in a file next to the state, see begin_command.
+
+    _path: Path
+    _lock_path: Path
+
+    def __init__(self, machine_id: MachineId = DEFAULT_MACHINE_ID) -> None:
+        super().__init__(machine_id)
+        self._notifier = get_state_notifier(machine_id)
+        # the token of the command in flight of this updater
+        self._command_token: None | str = None
+        # the marker last parsed, kept open for the same reason as the state file of
+        # InFileStateUpdater
+        self._command_cache_lock = Lock()
+        self._cached_command: tuple[tuple[int, int, int], dict[str, Any]] = ((0, 0, 0), {})
+        self._cached_command_file: IO[bytes] | None = None
+
+    @property
+    def watched_paths(self) -> tuple[Path, Path]:
+        # writers close the lock file after every write
+        return (self._path, self._lock_path)
+
+    def publish_changes(self) -> bool:
+        return self._notifier.publish_if_changed(self.get_state)
+
+    @cached_property
+    def _command_path(self) -> Path:
+        return self._path.with_name(f".{self._path.name}.command")
+
+    def _parse_command(self) -> None | dict[str, Any]:
+        try:
+            file = self._command_path.open("rb")
+        except FileNotFoundError:
+            return None
+        try:
+            marker = json.loads(file.read())
+            stat = os.fstat(file.fileno())
+        except BaseException:
+            file.close()
+            raise
+        with self._command_cache_lock:
+            previous = self._cached_command_file
+            self._cached_command = ((stat.st_ino, stat.st_mtime_ns, stat.st_size), marker)
+            self._cached_command_file = file
+        if previous is not None:
+            previous.close()
+        return marker
+
+    def _read_command(self) -> None | dict[str, Any]:
+        # the command in flight, None if there is none or its lease ran out; the marker is
+        # parsed again only when a stat tells it was replaced
+        try:
+            stat = os.stat(self._command_path)
+        except FileNotFoundError:
+            return None
+        key, marker = self._cached_command
+        if (stat.st_ino, stat.st_mtime_ns, stat.st_size) != key:
+            marker = self._parse_command()
+        return marker if marker is not None and marker["expires_at"] > time() else None
+
+    def _write_command(self, marker: dict[str, Any]):
+        # only called whilst holding the file lock, so the temporary file is not shared
+        temp_path = self._command_path.with_name(f"{self._command_path.name}.tmp")
+        temp_path.write_text(json.dumps(marker))
+        os.replace(temp_path, self._command_path)
+
+    def _remove_command(self):
+        # called whilst holding the file lock
+        self._command_path.unlink(missing_ok=True)
+
+    def _begin_command(self, command: str) -> bool:
+        # called whilst holding the file lock
+        if self._read_command() is not None:
+            return False
+        token = uuid4().hex
+        self._write_command(
+            {
+                "command": command,
+                "token": token,
+                "pid": os.getpid(),
+                "expires_at": time() + config.get_command_lease(),
+            }
+        )
+        self._command_token = token
+        return True
+
+    def _end_command(self):
+        # called whilst holding the file lock
+        marker = self._read_command()
+        if marker is not None and marker["token"] == self._command_token:
+            self._remove_command()
+        self._command_token = None
+
+    @property
+    def leases_commands(self) -> bool:
+        return True
+
+    def begin_command(self, command: str) -> bool:
+        with file_lock(self._lock_path):
+            return self._begin_command(command)
+
+    async def async_begin_command(self, command: str) -> bool:
+        async with async_file_lock(self._lock_path):
+            return self._begin_command(command)
+
+    def renew_command(self) -> bool:
+        with file_lock(self._lock_path):
+            marker = self._read_command()
+            if marker is None or marker["token"] != self._command_token:
+                return False
+            # the marker read is the one cached, so it is not changed in place
+            self._write_command({**marker, "expires_at": time() + config.get_command_lease()})
+            return True
+
+    def end_command(self):
+        with file_lock(self._lock_path):
+            self._end_command()
+
+    async def async_end_command(self):
+        async with async_file_lock(self._lock_path):
+            self._end_command()
+
+    def _abort_command(self):
+        # called whilst holding the file lock; a command of this updater is over too
+        self._remove_command()
+        self._command_token = None
+
+    def abort_command(self):
+        with file_lock(self._lock_path):
+            self._abort_command()
+
+    async def async_abort_command(self):
+        async with async_file_lock(self._lock_path):
+            self._abort_command()
+
+    def command_lost(self) -> bool:
+        # called whilst updating the state, so under the file lock
+        if self._command_token is None:
+            return False
+        marker = self._read_command()
+        return marker is None or marker["token"] != self._command_token
+
+    def command_in_flight(self) -> bool:
+        # the marker is replaced in a single rename, so it is read without the lock
+        return self._read_command() is not None
+
+
+__all__ = ["StateUpdater", "WatchableStateUpdater", "State", "DEFAULT_MACHINE_ID", "MachineId"]
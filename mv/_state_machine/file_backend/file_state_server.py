@@ -0,0 +1,68 @@
+from pathlib import Path
+from threading import Lock
+
+from ..base import AbstractPublisher, DEFAULT_MACHINE_ID, MachineId
+from ..event_hub import DEFAULT_MAXSIZE, DEFAULT_POLICY, Policy
+from ..state_server import StateServer
+from .. import config
+from .base import WatchableStateUpdater
+from .watcher import FileWatcher
+
+_watchers: dict[tuple[Path, bool], FileWatcher] = {}
+_watchers_lock = Lock()
+
+
+def _start_watching(updater: WatchableStateUpdater, interval: float, use_inotify: bool):
+    # the watcher of the directory looks every interval of the first server that started it
+    paths = updater.watched_paths
+    key = (paths[0].parent.resolve(), use_inotify)
+    with _watchers_lock:
+        if key in _watchers:
+            _watchers[key].add(paths, updater.publish_changes)
+            return
+        watcher = FileWatcher(paths, updater.publish_changes, interval, use_inotify)
+        watcher.start()
+        _watchers[key] = watcher
+
+
+def _stop_watching(updater: WatchableStateUpdater, use_inotify: bool):
+    key = (updater.watched_paths[0].parent.resolve(), use_inotify)
+    with _watchers_lock:
+        if not _watchers[key].remove(updater.publish_changes):
+            _watchers.pop(key).stop()
+
+
+class FileStateServer(StateServer):
+    # also publishes the states other processes write to the files of the machine, found
+    # by the watcher of their directory (which the servers of the machines there share),
+    # so that several servers can share the file and all push every change
+
+    def __init__(
+        self,
+        publisher: AbstractPublisher,
+        state_updater: WatchableStateUpdater,
+        machine_id: MachineId = DEFAULT_MACHINE_ID,
+        policy: Policy = DEFAULT_POLICY,
+        maxsize: int = DEFAULT_MAXSIZE,
+        watch: str | None = None,
+        interval: float | None = None,
+    ):
+        super().__init__(publisher, state_updater, machine_id, policy, maxsize)
+        self._watched_updater = state_updater
+        watch = watch or config.get_state_file_watch()
+        self._use_inotify = watch != "poll"
+        self._interval = config.get_state_file_poll_interval() if interval is None else interval
+        self._watching = False
+
+    def start_server(self):
+        super().start_server()
+        _start_watching(self._watched_updater, self._interval, self._use_inotify)
+        self._watching = True
+        # takes note of the state to tell the changes from, once no change can be missed
+        self._watched_updater.publish_changes()
+
+    def stop_server(self):
+        if self._watching:
+            _stop_watching(self._watched_updater, self._use_inotify)
+            self._watching = False
+        super().stop_server()
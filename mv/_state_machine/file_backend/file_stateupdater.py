@@ -1,80 +1,137 @@
 from contextlib import asynccontextmanager, contextmanager
 import json
+import os
 from pathlib import Path
 from threading import Lock
-from time import sleep
-from .base import StateUpdater, State
-from .state_control import (
-    state_write_lock,
-    cntrl_set_state_changed,
-    async_state_write_lock,
-)
+from typing import IO
+from urllib.parse import quote
+from ..inmem_backend.memstate import FrozenState
+from .base import WatchableStateUpdater, State, DEFAULT_MACHINE_ID, MachineId
+from .flock import async_file_lock, file_lock
+from .state_control import state_write_lock, async_state_write_lock
 
 
-class InFileStateUpdater(StateUpdater):
-    _path = Path(".build/state.json")
+def get_state_path(machine_id: MachineId = DEFAULT_MACHINE_ID) -> Path:
+    if machine_id == DEFAULT_MACHINE_ID:
+        return Path(".build/state.json")
+    # ids such as tango device names contain "/" so they are quoted into a single file name
+    return Path(f".build/state_{quote(machine_id, safe='')}.json")
 
-    def __init__(self) -> None:
-        self._file_read_lock = Lock()
-        if not self._path.exists():
-            if not (dir := self._path.parent).exists():
-                dir.mkdir()
-            self._write({})
 
-    def _write(self, state: dict[str, State]):
-        with self._file_read_lock:
-            with self._path.open("w") as file:
-                json.dump(state, file)
+class InFileStateUpdater(WatchableStateUpdater):
+    # the state file can be shared by several processes (e.g. uvicorn workers): writers
+    # take an advisory lock on a file next to it and replace the state file with a new one
+    # in a single rename, so readers never see it half written and need no lock.
+    # The parsed state is kept and read again only when a stat of the file tells it was
+    # replaced or changed; the file last parsed is kept open so that its inode can not be
+    # reused by a later state file, which would look unchanged
 
-    def _read(self):
-        with self._file_read_lock:
-            try:
-                with self._path.open("r") as file:
-                    return json.load(file)
-            except Exception:
-                # attempt again if failed the first time
-                sleep(2)
-                with self._path.open("r") as file:
-                    return json.load(file)
+    def __init__(self, machine_id: MachineId = DEFAULT_MACHINE_ID) -> None:
+        super().__init__(machine_id)
+        self._path = get_state_path(machine_id)
+        # the state file itself is replaced on every write so the lock is on another file
+        self._lock_path = self._path.with_name(f".{self._path.name}.lock")
+        self._temp_path = self._path.with_name(f".{self._path.name}.tmp")
+        self._cache_lock = Lock()
+        self._cached: tuple[tuple[int, int, int], FrozenState] = ((0, 0, 0), FrozenState())
+        self._cached_file: IO[bytes] | None = None
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        with file_lock(self._lock_path):
+            if not self._path.exists():
+                self._write({})
 
-    def get_state(self):
+    def _keep(self, file: IO[bytes], state: dict[str, State]) -> FrozenState:
+        stat = os.fstat(file.fileno())
+        snapshot = FrozenState(state)
+        with self._cache_lock:
+            previous = self._cached_file
+            self._cached = ((stat.st_ino, stat.st_mtime_ns, stat.st_size), snapshot)
+            self._cached_file = file
+        if previous is not None:
+            previous.close()
+        return snapshot
+
+    def _write(self, state: dict[str, State]) -> FrozenState:
+        # only called whilst holding the file lock, so the temporary file is not shared
+        file = self._temp_path.open("wb")
+        try:
+            file.write(json.dumps(state).encode())
+            file.flush()
+            os.replace(self._temp_path, self._path)
+        except BaseException:
+            file.close()
+            raise
+        # what was written is what the next read would parse
+        return self._keep(file, state)
+
+    def _read(self) -> FrozenState:
+        key, cached = self._cached
+        try:
+            stat = os.stat(self._path)
+        except FileNotFoundError:
+            return FrozenState()
+        if (stat.st_ino, stat.st_mtime_ns, stat.st_size) == key:
+            return cached
+        try:
+            file = self._path.open("rb")
+        except FileNotFoundError:
+            return FrozenState()
+        try:
+            state = json.loads(file.read())
+        except BaseException:
+            file.close()
+            raise
+        # keyed by the stat of the file parsed, which may be newer than the one above
+        return self._keep(file, state)
+
+    def get_state(self) -> FrozenState:
         return self._read()
 
     def reset_state(self) -> None:
-        self._write({})
+        with file_lock(self._lock_path), self._notifier.writing():
+            self._notifier.seen(self._write({}))
 
     @contextmanager
     def update_state(self):
         # only one thread at a time can write or update the state
         # after a write, a signal is sent indicating the state has changed
         # once the signal is sent the update state lock is released
-        with state_write_lock():
-            state = self._read()
-            state = state if state else {}
+        with state_write_lock(self._machine_id), file_lock(self._lock_path):
             # we copy the state so that it can be red statically whilst being updated
+            state = dict(self._read())
             yield state
-            self._write(state)
-            cntrl_set_state_changed(state)
+            with self._notifier.writing():
+                self._notifier.publish(self._write(state))
 
     @asynccontextmanager
     async def async_update_state(self):
         # only one thread at a time can write or update the state
         # after a write, a signal is sent indicating the state has changed
         # once the signal is sent the update state lock is released
-        async with async_state_write_lock():
-            state = self._read()
-            state = state if state else {}
+        async with async_state_write_lock(self._machine_id), async_file_lock(self._lock_path):
             # we copy the state so that it can be red statically whilst being updated
+            state = dict(self._read())
             yield state
-            self._write(state)
-            cntrl_set_state_changed(state)
+            with self._notifier.writing():
+                self._notifier.publish(self._write(state))
 
     @contextmanager
     def atomic(self):
         original_state = self._read()
-        original_state = original_state if original_state else {}
         try:
             yield
         except Exception as exception:
-            self._write(original_state)
+            with file_lock(self._lock_path), self._notifier.writing():
+                self._notifier.seen(self._write(original_state))
+            raise exception
+
+    @asynccontextmanager
+    async def async_atomic(self):
+        original_state = self._read()
+        try:
+            yield
+        except Exception as exception:
+            async with async_file_lock(self._lock_path):
+                with self._notifier.writing():
+                    self._notifier.seen(self._write(original_state))
             raise exception
@@ -0,0 +1,28 @@
+import asyncio
+from contextlib import asynccontextmanager, contextmanager
+import fcntl
+from pathlib import Path
+
+# how often an async writer tries again for a file lock held by another process
+LOCK_RETRY_INTERVAL = 0.005
+
+
+@contextmanager
+def file_lock(path: Path):
+    # an advisory lock shared by every process using the file; flock excludes every other
+    # open file, so threads of this process too
+    with path.open("a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+@asynccontextmanager
+async def async_file_lock(path: Path):
+    with path.open("a") as lock_file:
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                await asyncio.sleep(LOCK_RETRY_INTERVAL)
+        yield
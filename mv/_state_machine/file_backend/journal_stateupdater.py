@@ -0,0 +1,300 @@
+from contextlib import asynccontextmanager, contextmanager
+import json
+import logging
+import os
+from pathlib import Path
+import struct
+from threading import Lock, Timer
+from time import time
+from typing import Any, Iterator
+from urllib.parse import quote
+import zlib
+
+from ..inmem_backend.memstate import FrozenState
+from .. import config
+from .base import WatchableStateUpdater, DEFAULT_MACHINE_ID, MachineId
+from .flock import async_file_lock, file_lock
+from .state_control import state_write_lock, async_state_write_lock
+
+logger = logging.getLogger()
+
+# every record is prefixed with the length and crc32 of its (json) payload, so a record
+# torn by a crash is recognised and dropped when the journal is replayed
+HEADER = struct.Struct(">II")
+
+_MISSING = object()
+
+
+def get_journal_path(machine_id: MachineId = DEFAULT_MACHINE_ID) -> Path:
+    if machine_id == DEFAULT_MACHINE_ID:
+        return Path(".build/journal.log")
+    return Path(f".build/journal_{quote(machine_id, safe='')}.log")
+
+
+def encode_record(record: dict[str, Any]) -> bytes:
+    payload = json.dumps(record, separators=(",", ":")).encode()
+    return HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def decode_records(data: bytes) -> tuple[list[dict[str, Any]], int]:
+    # the complete records at the start of data and the number of bytes they take up
+    records = []
+    offset = 0
+    while offset + HEADER.size <= len(data):
+        length, crc = HEADER.unpack_from(data, offset)
+        end = offset + HEADER.size + length
+        payload = data[offset + HEADER.size:end]
+        if end > len(data) or zlib.crc32(payload) != crc:
+            break
+        records.append(json.loads(payload))
+        offset = end
+    return records, offset
+
+
+def apply_record(state: dict[str, Any], record: dict[str, Any]):
+    state.update(record.get("set", {}))
+    for key in record.get("del", []):
+        state.pop(key, None)
+
+
+class JournalStateUpdater(WatchableStateUpdater):
+    # appends the changes of every write as a record to a journal, so a write costs as
+    # much as its changes and the journal is a history of the transitions. Every
+    # compact_every records the state is saved as a snapshot and the journal started
+    # again (the old one is kept, see keep); the state is the snapshot with the journal
+    # replayed on top. Records are synced to disk in batches, see fsync_interval.
+    # Like the json file the journal can be shared by processes: writers take a file lock
+    # and every process applies the records appended by the others before using its state.
+
+    def __init__(
+        self,
+        machine_id: MachineId = DEFAULT_MACHINE_ID,
+        fsync_interval: float | None = None,
+        compact_every: int | None = None,
+        keep: int | None = None,
+    ) -> None:
+        super().__init__(machine_id)
+        self._path = get_journal_path(machine_id)
+        self._snapshot_path = self._path.with_suffix(".snapshot")
+        self._lock_path = self._path.with_name(f".{self._path.name}.lock")
+        if fsync_interval is None:
+            fsync_interval = config.get_state_journal_fsync_interval()
+        self._fsync_interval = fsync_interval
+        self._compact_every = compact_every or config.get_state_journal_compact_every()
+        self._keep = config.get_state_journal_keep() if keep is None else keep
+        # guards the state this process has caught up with (readers take no file lock)
+        self._cache_lock = Lock()
+        self._state = FrozenState()
+        self._inode = 0
+        self._offset = 0
+        # records in the journal since the snapshot
+        self._records = 0
+        self._journal_fd: None | int = None
+        self._sync_lock = Lock()
+        self._sync_pending = False
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        with file_lock(self._lock_path):
+            if not self._path.exists():
+                self._path.touch()
+            self._reload()
+
+    @property
+    def version(self) -> int:
+        # the sequence number of the last record applied
+        return self._state.version
+
+    def _archive_path(self, last_seq: int) -> Path:
+        return self._path.with_name(f"{self._path.stem}.{last_seq:012d}.log")
+
+    def _archives(self) -> list[Path]:
+        return sorted(self._path.parent.glob(f"{self._path.stem}.*.log"))
+
+    def _load_snapshot(self) -> FrozenState:
+        try:
+            snapshot = json.loads(self._snapshot_path.read_bytes())
+        except FileNotFoundError:
+            return FrozenState()
+        return FrozenState(snapshot["state"], snapshot["seq"])
+
+    def _replay(self, state: FrozenState, offset: int, repair: bool) -> bool:
+        # applies the records from offset on, False if the journal was compacted in the
+        # meantime. A torn record at the end is cut off when holding the file lock (readers
+        # may just see a record being appended)
+        with self._path.open("rb") as journal:
+            if os.fstat(journal.fileno()).st_ino != self._inode:
+                return False
+            journal.seek(offset)
+            data = journal.read()
+        records, used = decode_records(data)
+        if repair and used < len(data):
+            logger.warning(f"dropping a torn record at the end of {self._path}")
+            os.truncate(self._path, offset + used)
+        if records:
+            replayed = dict(state)
+            version = state.version
+            for record in records:
+                # records already in the snapshot are skipped
+                if record["seq"] > version:
+                    apply_record(replayed, record)
+                    version = record["seq"]
+            state = FrozenState(replayed, version)
+        self._offset = offset + used
+        self._records += len(records)
+        self._state = state
+        return True
+
+    def _reload(self):
+        # the snapshot and the journal only go together whilst holding the file lock
+        self._inode = os.stat(self._path).st_ino
+        self._records = 0
+        self._replay(self._load_snapshot(), 0, repair=True)
+
+    def _catch_up(self, locked: bool = False) -> FrozenState:
+        # applies the records appended by other processes, a stat tells if there are any
+        stat = os.stat(self._path)
+        if stat.st_ino == self._inode and stat.st_size == self._offset:
+            return self._state
+        with self._cache_lock:
+            if stat.st_ino == self._inode and self._replay(self._state, self._offset, locked):
+                return self._state
+        if locked:
+            with self._cache_lock:
+                self._reload()
+        else:
+            # the file lock is taken first, as by the writers
+            with file_lock(self._lock_path), self._cache_lock:
+                self._reload()
+        return self._state
+
+    def _journal(self) -> int:
+        if self._journal_fd is None or os.fstat(self._journal_fd).st_ino != self._inode:
+            if self._journal_fd is not None:
+                os.close(self._journal_fd)
+            self._journal_fd = os.open(self._path, os.O_WRONLY | os.O_APPEND)
+        return self._journal_fd
+
+    def _sync(self):
+        with self._sync_lock:
+            self._sync_pending = False
+            fd = self._journal_fd
+        if fd is not None:
+            try:
+                os.fsync(fd)
+            except OSError:
+                # closed by a compaction, which synced it
+                pass
+
+    def _schedule_sync(self):
+        # records appended within fsync_interval of one another share a single fsync
+        if self._fsync_interval <= 0:
+            self._sync()
+            return
+        with self._sync_lock:
+            if self._sync_pending:
+                return
+            self._sync_pending = True
+        timer = Timer(self._fsync_interval, self._sync)
+        timer.daemon = True
+        timer.start()
+
+    def _write_file(self, path: Path, data: bytes):
+        temp_path = path.with_name(f".{path.name}.tmp")
+        with temp_path.open("wb") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, path)
+
+    def _compact(self):
+        # the state becomes the snapshot and the journal is started again, the old one
+        # is kept as part of the history; called whilst holding the file lock
+        state = self._state
+        snapshot = {"seq": state.version, "state": dict(state)}
+        self._write_file(self._snapshot_path, json.dumps(snapshot).encode())
+        if self._keep > 0:
+            os.link(self._path, self._archive_path(state.version))
+            for archive in self._archives()[:-self._keep]:
+                archive.unlink()
+        self._write_file(self._path, b"")
+        self._sync()
+        self._inode = os.stat(self._path).st_ino
+        self._offset = 0
+        self._records = 0
+
+    def _append(self, state: dict[str, Any]) -> FrozenState:
+        # called whilst holding the file lock, after catching up
+        current = self._state
+        changed = {
+            key: value for key, value in state.items() if current.get(key, _MISSING) != value
+        }
+        removed = [key for key in current if key not in state]
+        if not changed and not removed:
+            return current
+        record: dict[str, Any] = {"seq": current.version + 1, "at": time()}
+        if changed:
+            record["set"] = changed
+        if removed:
+            record["del"] = removed
+        data = encode_record(record)
+        os.write(self._journal(), data)
+        with self._cache_lock:
+            self._offset += len(data)
+            self._records += 1
+            self._state = FrozenState(state, record["seq"])
+        if self._records >= self._compact_every:
+            self._compact()
+        else:
+            self._schedule_sync()
+        return self._state
+
+    def history(self) -> Iterator[dict[str, Any]]:
+        # the records of the journals kept and the current one, oldest first
+        for path in [*self._archives(), self._path]:
+            records, _ = decode_records(path.read_bytes())
+            yield from records
+
+    def get_state(self) -> FrozenState:
+        return self._catch_up()
+
+    def reset_state(self) -> None:
+        with self.update_state() as state:
+            state.clear()
+
+    @contextmanager
+    def update_state(self):
+        with state_write_lock(self._machine_id), file_lock(self._lock_path):
+            state = dict(self._catch_up(locked=True))
+            yield state
+            with self._notifier.writing():
+                self._notifier.publish(self._append(state))
+
+    @asynccontextmanager
+    async def async_update_state(self):
+        async with async_state_write_lock(self._machine_id), async_file_lock(self._lock_path):
+            state = dict(self._catch_up(locked=True))
+            yield state
+            with self._notifier.writing():
+                self._notifier.publish(self._append(state))
+
+    @contextmanager
+    def atomic(self):
+        # rolled back with a record undoing the changes, the state is not read again
+        original_state = self._catch_up()
+        try:
+            yield
+        except Exception as exception:
+            with self.update_state() as state:
+                state.clear()
+                state.update(original_state)
+            raise exception
+
+    @asynccontextmanager
+    async def async_atomic(self):
+        original_state = self._catch_up()
+        try:
+            yield
+        except Exception as exception:
+            async with self.async_update_state() as state:
+                state.clear()
+                state.update(original_state)
+            raise exception
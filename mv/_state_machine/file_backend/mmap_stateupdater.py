@@ -0,0 +1,223 @@
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+import json
+import mmap
+import os
+from pathlib import Path
+import struct
+from time import sleep, time
+from typing import Any
+from urllib.parse import quote
+
+from ..inmem_backend.memstate import FrozenState
+from .base import WatchableStateUpdater, DEFAULT_MACHINE_ID, MachineId
+from .flock import async_file_lock, file_lock
+from .state_control import state_write_lock, async_state_write_lock
+
+# the state is a fixed size record mapped into every process using it: a sequence number
+# (odd whilst a write is in progress), the version, a code for state and obs_state and the
+# length of the json of any other attributes, which follows the header. The command in
+# flight (when its lease runs out and its token, a zero time if there is none) is kept at
+# the end of the page, apart from the state
+SEQ = struct.Struct("<Q")
+HEADER = struct.Struct("<QQBBxxI")
+SIZE = mmap.PAGESIZE
+COMMAND = struct.Struct("<d16s")
+COMMAND_OFFSET = SIZE - COMMAND.size
+EXPIRES_AT = struct.Struct("<d")
+EXTRAS_SIZE = COMMAND_OFFSET - HEADER.size
+
+# codes of state and obs_state, the values are numbered from 2 on in this order (so new
+# values go at the end); values that are not listed are kept with the other attributes
+ABSENT = 0
+NONE = 1
+IN_EXTRAS = 255
+STATES = ("ON", "OFF", "BUSY")
+OBS_STATES = (
+    "EMPTY",
+    "RESOURCING",
+    "IDLE",
+    "CONFIGURING",
+    "READY",
+    "SCANNING",
+    "BUSY",
+    "ABORTED",
+)
+CODED = {"state": STATES, "obs_state": OBS_STATES}
+
+# how many times a reader looks again for a write to finish before it takes the lock, a
+# sequence number that stays odd was left by a writer that died half way
+SPIN_LIMIT = 10_000
+
+
+def get_mmap_path(machine_id: MachineId = DEFAULT_MACHINE_ID) -> Path:
+    if machine_id == DEFAULT_MACHINE_ID:
+        return Path(".build/state.mmap")
+    return Path(f".build/state_{quote(machine_id, safe='')}.mmap")
+
+
+def _encode(value: Any, values: tuple[str, ...]) -> int:
+    if value is None:
+        return NONE
+    if value in values:
+        return values.index(value) + 2
+    return IN_EXTRAS
+
+
+def _decode(code: int, values: tuple[str, ...]) -> Any:
+    return None if code == NONE else values[code - 2]
+
+
+class MmapStateUpdater(WatchableStateUpdater):
+    # keeps the state in a memory mapped file with a seqlock: writers (holding a file lock,
+    # so they may be in any process) make the sequence number odd whilst writing and
+    # readers retry until they read the same even number before and after the record.
+    # Reading state or obs_state takes a few loads from memory and no system call, the
+    # decoded state is kept until the sequence number changes.
+    # The mapping is written back to the file by the system, which survives the process
+    # but not a power cut.
+
+    def __init__(self, machine_id: MachineId = DEFAULT_MACHINE_ID) -> None:
+        super().__init__(machine_id)
+        self._path = get_mmap_path(machine_id)
+        self._lock_path = self._path.with_name(f".{self._path.name}.lock")
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        with file_lock(self._lock_path):
+            fd = os.open(self._path, os.O_RDWR | os.O_CREAT)
+            try:
+                if os.fstat(fd).st_size < SIZE:
+                    # zeros read as an empty state
+                    os.ftruncate(fd, SIZE)
+                self._map = mmap.mmap(fd, SIZE)
+            finally:
+                os.close(fd)
+        self._cached: tuple[int, FrozenState] = (-1, FrozenState())
+
+    def _read_record(self, locked: bool) -> tuple[int, tuple[int, int, int, int], bytes]:
+        for _ in range(0 if locked else SPIN_LIMIT):
+            (seq,) = SEQ.unpack_from(self._map)
+            if seq & 1:
+                # let the writer finish
+                sleep(0)
+                continue
+            _, version, state, obs_state, extras_length = HEADER.unpack_from(self._map)
+            extras = self._map[HEADER.size:HEADER.size + extras_length]
+            if SEQ.unpack_from(self._map)[0] == seq:
+                return seq, (version, state, obs_state, extras_length), extras
+        with nullcontext() if locked else file_lock(self._lock_path):
+            # nobody writes whilst the lock is held, whatever the sequence number says
+            seq, version, state, obs_state, extras_length = HEADER.unpack_from(self._map)
+            extras = self._map[HEADER.size:HEADER.size + extras_length]
+            return seq, (version, state, obs_state, extras_length), extras
+
+    def _read(self, locked: bool = False) -> FrozenState:
+        seq, cached = self._cached
+        if SEQ.unpack_from(self._map)[0] == seq:
+            return cached
+        seq, (version, *codes, _), extras = self._read_record(locked)
+        state: dict[str, Any] = {}
+        for (attribute, values), code in zip(CODED.items(), codes):
+            if code not in (ABSENT, IN_EXTRAS):
+                state[attribute] = _decode(code, values)
+        if extras:
+            state.update(json.loads(extras))
+        snapshot = FrozenState(state, version)
+        self._cached = (seq, snapshot)
+        return snapshot
+
+    def _write(self, state: dict[str, Any]) -> FrozenState:
+        # called whilst holding the file lock
+        codes = [
+            _encode(state[attribute], values) if attribute in state else ABSENT
+            for attribute, values in CODED.items()
+        ]
+        extras = {
+            key: value
+            for key, value in state.items()
+            if key not in CODED or codes[list(CODED).index(key)] == IN_EXTRAS
+        }
+        extras_bytes = json.dumps(extras).encode() if extras else b""
+        if len(extras_bytes) > EXTRAS_SIZE:
+            raise ValueError(
+                f"the state takes {len(extras_bytes)} bytes, only {EXTRAS_SIZE} fit"
+            )
+        seq, version, *_ = HEADER.unpack_from(self._map)
+        # an odd number was left by a writer that died half way
+        seq += seq & 1
+        SEQ.pack_into(self._map, 0, seq + 1)
+        self._map[HEADER.size:HEADER.size + len(extras_bytes)] = extras_bytes
+        HEADER.pack_into(self._map, 0, seq + 1, version + 1, *codes, len(extras_bytes))
+        SEQ.pack_into(self._map, 0, seq + 2)
+        snapshot = FrozenState(state, version + 1)
+        self._cached = (seq + 2, snapshot)
+        return snapshot
+
+    def _read_command(self) -> None | dict[str, Any]:
+        # the token is only looked at whilst holding the file lock, so reading it along
+        # with a lease being renewed does no harm
+        expires_at, token = COMMAND.unpack_from(self._map, COMMAND_OFFSET)
+        if expires_at <= time():
+            return None
+        return {"token": token.hex(), "expires_at": expires_at}
+
+    def _write_command(self, marker: dict[str, Any]):
+        # called whilst holding the file lock
+        COMMAND.pack_into(
+            self._map, COMMAND_OFFSET, marker["expires_at"], bytes.fromhex(marker["token"])
+        )
+
+    def _remove_command(self):
+        # called whilst holding the file lock
+        EXPIRES_AT.pack_into(self._map, COMMAND_OFFSET, 0.0)
+
+    def command_in_flight(self) -> bool:
+        (expires_at,) = EXPIRES_AT.unpack_from(self._map, COMMAND_OFFSET)
+        return expires_at > time()
+
+    @property
+    def version(self) -> int:
+        return HEADER.unpack_from(self._map)[1]
+
+    def get_state(self) -> FrozenState:
+        return self._read()
+
+    def reset_state(self) -> None:
+        with self.update_state() as state:
+            state.clear()
+
+    @contextmanager
+    def update_state(self):
+        with state_write_lock(self._machine_id), file_lock(self._lock_path):
+            state = dict(self._read(locked=True))
+            yield state
+            with self._notifier.writing():
+                self._notifier.publish(self._write(state))
+
+    @asynccontextmanager
+    async def async_update_state(self):
+        async with async_state_write_lock(self._machine_id), async_file_lock(self._lock_path):
+            state = dict(self._read(locked=True))
+            yield state
+            with self._notifier.writing():
+                self._notifier.publish(self._write(state))
+
+    @contextmanager
+    def atomic(self):
+        original_state = self._read()
+        try:
+            yield
+        except Exception as exception:
+            with self.update_state() as state:
+                state.clear()
+                state.update(original_state)
+            raise exception
+
+    @asynccontextmanager
+    async def async_atomic(self):
+        original_state = self._read()
+        try:
+            yield
+        except Exception as exception:
+            async with self.async_update_state() as state:
+                state.clear()
+                state.update(original_state)
+            raise exception
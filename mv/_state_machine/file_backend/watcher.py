@@ -0,0 +1,132 @@
+import ctypes
+import logging
+import os
+from pathlib import Path
+import select
+import struct
+from threading import Event, Lock, Thread
+from typing import Any, Callable, Iterator, Sequence
+
+logger = logging.getLogger()
+
+# how often the files are looked at where there is no inotify
+POLL_INTERVAL = 0.1
+
+# from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x08
+IN_MOVED_TO = 0x80
+EVENT = struct.Struct("iIII")
+
+
+def _inotify(directory: Path) -> None | int:
+    # an inotify descriptor watching directory, None where linux inotify is not available
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+def _event_names(data: bytes) -> Iterator[bytes]:
+    offset = 0
+    while offset + EVENT.size <= len(data):
+        *_, length = EVENT.unpack_from(data, offset)
+        offset += EVENT.size
+        yield data[offset:offset + length].rstrip(b"\0")
+        offset += length
+
+
+class FileWatcher:
+    # calls on_change after any of the files (in a single directory) was written or
+    # replaced: woken by inotify on linux, so an idle watcher costs nothing, looking every
+    # interval seconds elsewhere (or if use_inotify is False). Events that arrive together
+    # make a single call. Other files of the directory can be added with an on_change of
+    # their own, so that a single watcher serves the whole directory.
+
+    def __init__(
+        self,
+        paths: Sequence[Path],
+        on_change: Callable[[], Any],
+        interval: float = POLL_INTERVAL,
+        use_inotify: bool = True,
+    ) -> None:
+        self._directory = paths[0].parent
+        self._lock = Lock()
+        self._watched: dict[Callable[[], Any], set[bytes]] = {}
+        self.add(paths, on_change)
+        self._interval = interval
+        self._use_inotify = use_inotify
+        self._stopped = Event()
+        self._thread: None | Thread = None
+        self._wake: None | int = None
+        self.using_inotify = False
+
+    def add(self, paths: Sequence[Path], on_change: Callable[[], Any]):
+        with self._lock:
+            self._watched[on_change] = {os.fsencode(path.name) for path in paths}
+
+    def remove(self, on_change: Callable[[], Any]) -> bool:
+        # whether any file is still watched
+        with self._lock:
+            del self._watched[on_change]
+            return bool(self._watched)
+
+    def _changed(self, names: None | set[bytes] = None):
+        # names None calls every on_change
+        with self._lock:
+            calls = [
+                on_change
+                for on_change, watched in self._watched.items()
+                if names is None or watched & names
+            ]
+        for on_change in calls:
+            try:
+                on_change()
+            except Exception as exception:
+                logger.exception(
+                    f"failed to handle a change of {self._directory}: {exception!r}"
+                )
+
+    def _poll(self):
+        while not self._stopped.wait(self._interval):
+            self._changed()
+
+    def _watch(self, fd: int, wake: int):
+        try:
+            while True:
+                ready, _, _ = select.select([fd, wake], [], [])
+                if wake in ready:
+                    return
+                data = os.read(fd, 64 * 1024)
+                self._changed(set(_event_names(data)))
+        finally:
+            os.close(fd)
+            os.close(wake)
+
+    def start(self):
+        fd = _inotify(self._directory) if self._use_inotify else None
+        self.using_inotify = fd is not None
+        if fd is None:
+            self._thread = Thread(target=self._poll, daemon=True, name="file-watcher")
+        else:
+            wake, self._wake = os.pipe()
+            self._thread = Thread(
+                target=self._watch, args=(fd, wake), daemon=True, name="file-watcher"
+            )
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._wake is not None:
+            os.write(self._wake, b"\0")
+        if self._thread is not None:
+            self._thread.join(1)
+        if self._wake is not None:
+            os.close(self._wake)
+            self._wake = None
@@ -1,3 +1,3 @@
-from ..stateupdater import State, StateUpdater, CombinedState
+from ..stateupdater import State, StateUpdater, CombinedState, DEFAULT_MACHINE_ID, MachineId
 
-__all__ = ["State", "StateUpdater", "CombinedState"]
+__all__ = ["State", "StateUpdater", "CombinedState", "DEFAULT_MACHINE_ID", "MachineId"]
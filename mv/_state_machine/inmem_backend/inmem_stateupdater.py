@@ -6,7 +6,7 @@ from .state_control import (
     cntrl_set_state_changed,
     async_state_write_lock,
 )
-from .memstate import get_state, set_state
+from .memstate import FrozenState, get_state, get_version, has_changed_since, set_state
 
 
 class InMemStateUpdater(StateUpdater):
@@ -16,37 +16,53 @@ class InMemStateUpdater(StateUpdater):
         # only one thread at a time can write or update the state
         # after a write, a signal is sent indicating the state has changed
         # once the signal is sent the update state lock is released
-        with state_write_lock():
-            state = get_state()
-            # we copy the state so that it can be red statically whilst being updated
+        with state_write_lock(self._machine_id):
+            # readers keep seeing the current snapshot whilst a copy of it is updated
+            state = dict(get_state(self._machine_id))
             yield state
-            set_state(state)
-            cntrl_set_state_changed(state)
+            snapshot = set_state(state, self._machine_id)
+            cntrl_set_state_changed(snapshot, self._machine_id)
 
     @asynccontextmanager
     async def async_update_state(self):
         # only one thread at a time can write or update the state
         # after a write, a signal is sent indicating the state has changed
         # once the signal is sent the update state lock is released
-        async with async_state_write_lock():
-            state = get_state()
-            # we copy the state so that it can be red statically whilst being updated
+        async with async_state_write_lock(self._machine_id):
+            # readers keep seeing the current snapshot whilst a copy of it is updated
+            state = dict(get_state(self._machine_id))
             yield state
-            set_state(state)
-            cntrl_set_state_changed(state)
+            snapshot = set_state(state, self._machine_id)
+            cntrl_set_state_changed(snapshot, self._machine_id)
 
     @contextmanager
     def atomic(self):
-        original_state = get_state()
+        original_state = get_state(self._machine_id)
         try:
             yield
         except Exception as exception:
-            set_state(original_state)
+            set_state(original_state, self._machine_id)
             raise exception
 
-    def get_state(self):
-        read_state = get_state()
-        return read_state
+    @asynccontextmanager
+    async def async_atomic(self):
+        original_state = get_state(self._machine_id)
+        try:
+            yield
+        except Exception as exception:
+            set_state(original_state, self._machine_id)
+            raise exception
+
+    def get_state(self) -> FrozenState:
+        # the snapshot is immutable so it is handed out without copying
+        return get_state(self._machine_id)
+
+    @property
+    def version(self) -> int:
+        return get_version(self._machine_id)
+
+    def has_changed_since(self, version: int) -> bool:
+        return has_changed_since(version, self._machine_id)
 
     def reset_state(self):
         with self.update_state() as state:
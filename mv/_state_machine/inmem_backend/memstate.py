@@ -1,16 +1,66 @@
-from copy import deepcopy
+from itertools import count
+from threading import Lock
+from typing import Any, Mapping, NoReturn
 
-from .base import CombinedState
+from .base import CombinedState, DEFAULT_MACHINE_ID, MachineId
 
-_state: CombinedState = {}
 
+class FrozenState(dict):
+    # a read only snapshot of the state of a machine, a write never changes a snapshot
+    # in place but swaps in a new one with a higher version, so readers can keep a
+    # reference to it without copying
 
-def get_state():
-    global _state
-    state_copy = deepcopy(_state)
-    return state_copy
+    __slots__ = ("version",)
 
+    def __init__(self, state: Mapping[str, Any] = (), version: int = 0) -> None:
+        super().__init__(state)
+        self.version = version
 
-def set_state(state: CombinedState):
-    global _state
-    _state = state
+    def _read_only(self, *args: Any, **kwargs: Any) -> NoReturn:
+        raise TypeError("state snapshots are read only, use update_state to change them")
+
+    __setitem__ = __delitem__ = __ior__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def __copy__(self) -> "FrozenState":
+        return self
+
+    def __deepcopy__(self, memo: dict) -> "FrozenState":
+        return self
+
+    def __reduce__(self):
+        return FrozenState, (dict(self), self.version)
+
+    def __repr__(self) -> str:
+        return f"FrozenState({dict.__repr__(self)}, version={self.version})"
+
+
+_EMPTY = FrozenState()
+
+_versions = count(1)
+
+# only writers take the lock, so that the version and the swap happen together
+_swap_lock = Lock()
+
+_states: dict[MachineId, FrozenState] = {}
+
+
+def get_state(machine_id: MachineId = DEFAULT_MACHINE_ID) -> FrozenState:
+    return _states.get(machine_id, _EMPTY)
+
+
+def set_state(
+    state: CombinedState | Mapping[str, Any], machine_id: MachineId = DEFAULT_MACHINE_ID
+) -> FrozenState:
+    with _swap_lock:
+        snapshot = FrozenState(state, next(_versions))
+        _states[machine_id] = snapshot
+    return snapshot
+
+
+def get_version(machine_id: MachineId = DEFAULT_MACHINE_ID) -> int:
+    return get_state(machine_id).version
+
+
+def has_changed_since(version: int, machine_id: MachineId = DEFAULT_MACHINE_ID) -> bool:
+    return get_state(machine_id).version != version
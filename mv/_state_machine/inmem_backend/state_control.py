@@ -1,12 +1,12 @@
 from ..state_control import (
-    get_state_control_signals,
+    subscribe_state_changes,
     cntrl_set_state_changed,
     state_write_lock,
     async_state_write_lock,
 )
 
 __all__ = [
-    "get_state_control_signals",
+    "subscribe_state_changes",
     "cntrl_set_state_changed",
     "state_write_lock",
     "async_state_write_lock",
@@ -0,0 +1,74 @@
+import logging
+from threading import Condition, Thread
+from typing import Callable
+
+from .base import AbstractStateUpdater
+from . import config
+
+logger = logging.getLogger(__name__)
+
+
+class LeaseKeeper:
+    # renews the leases of the commands in flight in this process (see
+    # AbstractStateUpdater.begin_command) from a single thread, every third of the lease.
+    # It runs on real time whatever the clock of the scheduler, as the leases run out in
+    # the backend on real time too. A command whose lease is found lost (e.g. aborted by
+    # another process) is cancelled through on_lost.
+
+    def __init__(self, lease: float | None = None) -> None:
+        # as configured when None
+        self._lease = lease
+        self._held: dict[AbstractStateUpdater, Callable[[], None]] = {}
+        self._condition = Condition()
+        self._thread: None | Thread = None
+
+    def hold(self, updater: AbstractStateUpdater, on_lost: Callable[[], None] = lambda: None):
+        if not updater.leases_commands:
+            return
+        with self._condition:
+            self._held[updater] = on_lost
+            if self._thread is None:
+                self._thread = Thread(target=self._run, daemon=True, name="lease-keeper")
+                self._thread.start()
+
+    def drop(self, updater: AbstractStateUpdater):
+        with self._condition:
+            self._held.pop(updater, None)
+
+    def _renew(self, updater: AbstractStateUpdater, on_lost: Callable[[], None]):
+        try:
+            if updater.renew_command():
+                return
+            logger.warning(f"a command in flight lost its lease ({updater!r})")
+        except Exception as exception:
+            # tried again on the next round, the lease may still be good till then
+            logger.warning(f"failed to renew the lease of {updater}: {exception!r}")
+            return
+        self.drop(updater)
+        try:
+            on_lost()
+        except Exception:
+            logger.exception(f"failed to cancel the command that lost its lease ({updater!r})")
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self._held:
+                    # started again by the next hold
+                    self._thread = None
+                    return
+                lease = config.get_command_lease() if self._lease is None else self._lease
+                self._condition.wait(lease / 3)
+                held = list(self._held.items())
+            for updater, on_lost in held:
+                self._renew(updater, on_lost)
+
+
+_lease_keeper: None | LeaseKeeper = None
+
+
+def get_lease_keeper() -> LeaseKeeper:
+    global _lease_keeper
+    if _lease_keeper is None:
+        _lease_keeper = LeaseKeeper()
+    return _lease_keeper
@@ -1,5 +1,14 @@
 from .redis_state_server import RedisStateServer
+from .redis_stream_state_server import RedisStreamStateServer
 from .redis_stateupdater import RedisStateUpdater
+from .redis_hash_stateupdater import RedisHashStateUpdater
+from .mirror import StateMirror
 
 
-__all__ = ["RedisStateServer", "RedisStateUpdater"]
+__all__ = [
+    "RedisHashStateUpdater",
+    "RedisStateServer",
+    "RedisStreamStateServer",
+    "RedisStateUpdater",
+    "StateMirror",
+]
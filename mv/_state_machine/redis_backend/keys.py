@@ -0,0 +1,42 @@
+from .base import DEFAULT_MACHINE_ID, MachineId
+from .. import config
+
+# the default machine keeps the original (unsuffixed) key names so that state written by
+# earlier single machine deployments is still picked up
+
+
+def _suffixed(name: str, machine_id: MachineId) -> str:
+    name = f"{config.get_redis_key_prefix()}{name}"
+    if machine_id == DEFAULT_MACHINE_ID:
+        return name
+    return f"{name}:{machine_id}"
+
+
+def state_key(machine_id: MachineId = DEFAULT_MACHINE_ID) -> str:
+    return _suffixed("state", machine_id)
+
+
+def hash_key(machine_id: MachineId = DEFAULT_MACHINE_ID) -> str:
+    # the state in the hash layout, a field per attribute
+    return _suffixed("state_fields", machine_id)
+
+
+def version_key(machine_id: MachineId = DEFAULT_MACHINE_ID) -> str:
+    return _suffixed("state_version", machine_id)
+
+
+def lock_key(machine_id: MachineId = DEFAULT_MACHINE_ID) -> str:
+    return _suffixed("_state_write_lock", machine_id)
+
+
+def command_key(machine_id: MachineId = DEFAULT_MACHINE_ID) -> str:
+    # the lease of the command in flight
+    return _suffixed("_command_lease", machine_id)
+
+
+def state_channel(machine_id: MachineId = DEFAULT_MACHINE_ID) -> str:
+    return _suffixed("state_control_signals", machine_id)
+
+
+def stream_key(machine_id: MachineId = DEFAULT_MACHINE_ID) -> str:
+    return _suffixed("state_events", machine_id)
@@ -0,0 +1,323 @@
+import asyncio
+import logging
+from threading import Lock
+from time import monotonic, sleep
+from typing import Any
+import redis
+import redis.asyncio as asyncio_redis
+
+logger = logging.getLogger()
+
+# the lock is taken with a fencing token, a number that grows with every acquisition, as
+# its value. Only the holder of that token extends or releases it and writes fenced by it
+# (see check) fail once somebody else took the lock, e.g. after the lease of a holder
+# that stalled ran out.
+ACQUIRE = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+local token = redis.call('INCR', KEYS[2])
+redis.call('SET', KEYS[1], token, 'PX', ARGV[1])
+return token
+"""
+
+EXTEND = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+RELEASE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# takes the lock from whoever holds it: the holder can neither extend nor release it nor
+# write fenced by it any more, and the tokens handed out before are never valid again
+BREAK = """
+redis.call('DEL', KEYS[1])
+return redis.call('INCR', KEYS[2])
+"""
+
+# how long an acquisition waits before trying again
+RETRY_INTERVAL = 0.01
+
+
+class LeaseLost(Exception):
+    pass
+
+
+class LeaseMetrics:
+    # how a lock was used by this process, shared by the sync and async locks of a machine
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self.acquired = 0
+        # acquisitions that had to wait for another holder and the time spent waiting
+        self.contended = 0
+        self.waited = 0.0
+        self.held = 0.0
+        self.longest_hold = 0.0
+        self.renewed = 0
+        # leases that ran out (or were taken over) whilst held
+        self.lost = 0
+
+    def record_acquired(self, waited: float, contended: bool):
+        with self._lock:
+            self.acquired += 1
+            self.contended += contended
+            self.waited += waited
+
+    def record_released(self, held: float):
+        with self._lock:
+            self.held += held
+            self.longest_hold = max(self.longest_hold, held)
+
+    def record_renewed(self, renewed: bool):
+        with self._lock:
+            if renewed:
+                self.renewed += 1
+            else:
+                self.lost += 1
+
+    def as_dict(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "acquired": self.acquired,
+                "contended": self.contended,
+                "waited": self.waited,
+                "held": self.held,
+                "longest_hold": self.longest_hold,
+                "renewed": self.renewed,
+                "lost": self.lost,
+            }
+
+
+class _Lease:
+
+    def __init__(self, name: str, lease: float, metrics: LeaseMetrics | None) -> None:
+        self.name = name
+        self.fence_key = f"{name}:fence"
+        self.lease = lease
+        self.metrics = metrics or LeaseMetrics()
+        # the fencing token of the current acquisition, 0 when not held
+        self.token = 0
+        self._acquired_at = 0.0
+
+    @property
+    def _lease_ms(self) -> int:
+        return int(self.lease * 1000)
+
+    def _lost(self):
+        self.metrics.record_renewed(False)
+        logger.warning(f"lost the lease on {self.name} (token {self.token})")
+
+    def _check(self, holder: Any):
+        if int(holder or 0) != self.token:
+            raise LeaseLost(f"{self.name} is no longer held with token {self.token}")
+
+    def fenced_out(self) -> LeaseLost:
+        # for a write refused as the lease is no longer held with this token
+        self._lost()
+        return LeaseLost(f"{self.name} is no longer held with token {self.token}")
+
+
+class LeaseLock(_Lease):
+    # a redis lock with a lease, which bounds how long a holder that died keeps others
+    # waiting; it is only held around a write, so it is not renewed
+
+    def __init__(
+        self,
+        redis_client: redis.Redis,
+        name: str,
+        lease: float = 10.0,
+        metrics: LeaseMetrics | None = None,
+    ) -> None:
+        super().__init__(name, lease, metrics)
+        self._redis_client = redis_client
+        self._acquire = redis_client.register_script(ACQUIRE)
+        self._extend = redis_client.register_script(EXTEND)
+        self._release = redis_client.register_script(RELEASE)
+
+    def acquire(self, timeout: float | None = None) -> bool:
+        start = monotonic()
+        contended = False
+        while not (
+            token := int(self._acquire(keys=[self.name, self.fence_key], args=[self._lease_ms]))
+        ):
+            contended = True
+            if timeout is not None and monotonic() - start >= timeout:
+                return False
+            sleep(RETRY_INTERVAL)
+        self.token = token
+        self._acquired_at = monotonic()
+        self.metrics.record_acquired(self._acquired_at - start, contended)
+        return True
+
+    def release(self):
+        self.metrics.record_released(monotonic() - self._acquired_at)
+        token, self.token = self.token, 0
+        if not self._release(keys=[self.name], args=[token]):
+            logger.warning(f"{self.name} was no longer held with token {token} on release")
+
+    def check(self, client: Any):
+        # raises LeaseLost unless the lock is still held with this token; called on a
+        # pipeline watching the lock, the write queued on it is fenced by the token
+        self._check(client.get(self.name))
+
+    def locked(self) -> bool:
+        return bool(self._redis_client.exists(self.name))
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args: Any):
+        self.release()
+
+
+class AsyncLeaseLock(_Lease):
+
+    def __init__(
+        self,
+        redis_client: asyncio_redis.Redis,
+        name: str,
+        lease: float = 10.0,
+        metrics: LeaseMetrics | None = None,
+    ) -> None:
+        super().__init__(name, lease, metrics)
+        self._redis_client = redis_client
+        self._acquire = redis_client.register_script(ACQUIRE)
+        self._extend = redis_client.register_script(EXTEND)
+        self._release = redis_client.register_script(RELEASE)
+
+    async def acquire(self, timeout: float | None = None) -> bool:
+        start = monotonic()
+        contended = False
+        while not (
+            token := int(
+                await self._acquire(keys=[self.name, self.fence_key], args=[self._lease_ms])
+            )
+        ):
+            contended = True
+            if timeout is not None and monotonic() - start >= timeout:
+                return False
+            await asyncio.sleep(RETRY_INTERVAL)
+        self.token = token
+        self._acquired_at = monotonic()
+        self.metrics.record_acquired(self._acquired_at - start, contended)
+        return True
+
+    async def release(self):
+        self.metrics.record_released(monotonic() - self._acquired_at)
+        token, self.token = self.token, 0
+        if not await self._release(keys=[self.name], args=[token]):
+            logger.warning(f"{self.name} was no longer held with token {token} on release")
+
+    async def check(self, client: Any):
+        self._check(await client.get(self.name))
+
+    async def locked(self) -> bool:
+        return bool(await self._redis_client.exists(self.name))
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *args: Any):
+        await self.release()
+
+
+class CommandLease(_Lease):
+    # the lease of the command in flight on a machine, taken (without waiting, a machine
+    # runs one command at a time) and given back on either client, and renewed on the
+    # blocking one by the thread renewing the leases of every command in flight (see
+    # LeaseKeeper). The writes of the command are fenced by its token.
+
+    def __init__(
+        self,
+        redis_client: redis.Redis,
+        async_redis_client: asyncio_redis.Redis,
+        name: str,
+        lease: float = 10.0,
+        metrics: LeaseMetrics | None = None,
+    ) -> None:
+        super().__init__(name, lease, metrics)
+        self._redis_client = redis_client
+        self._async_redis_client = async_redis_client
+        self._acquire = redis_client.register_script(ACQUIRE)
+        self._async_acquire = async_redis_client.register_script(ACQUIRE)
+        self._extend = redis_client.register_script(EXTEND)
+        self._release = redis_client.register_script(RELEASE)
+        self._async_release = async_redis_client.register_script(RELEASE)
+        self._break = redis_client.register_script(BREAK)
+        self._async_break = async_redis_client.register_script(BREAK)
+
+    def _acquired(self, token: int) -> bool:
+        if not token:
+            return False
+        self.token = token
+        self._acquired_at = monotonic()
+        self.metrics.record_acquired(0, False)
+        return True
+
+    def acquire(self) -> bool:
+        return self._acquired(
+            int(self._acquire(keys=[self.name, self.fence_key], args=[self._lease_ms]))
+        )
+
+    async def async_acquire(self) -> bool:
+        return self._acquired(
+            int(
+                await self._async_acquire(
+                    keys=[self.name, self.fence_key], args=[self._lease_ms]
+                )
+            )
+        )
+
+    def renew(self) -> bool:
+        # extends the lease by another lease, False if it ran out in the meantime
+        if not self._extend(keys=[self.name], args=[self.token, self._lease_ms]):
+            self._lost()
+            return False
+        self.metrics.record_renewed(True)
+        return True
+
+    def _released(self) -> int:
+        self.metrics.record_released(monotonic() - self._acquired_at)
+        token, self.token = self.token, 0
+        return token
+
+    def release(self):
+        token = self._released()
+        if not self._release(keys=[self.name], args=[token]):
+            logger.warning(f"{self.name} was no longer held with token {token} on release")
+
+    async def async_release(self):
+        token = self._released()
+        if not await self._async_release(keys=[self.name], args=[token]):
+            logger.warning(f"{self.name} was no longer held with token {token} on release")
+
+    def break_lease(self):
+        # e.g. for an abort, whichever replica holds the lease
+        self._break(keys=[self.name, self.fence_key])
+        self.token = 0
+
+    async def async_break_lease(self):
+        await self._async_break(keys=[self.name, self.fence_key])
+        self.token = 0
+
+    def check(self, client: Any):
+        self._check(client.get(self.name))
+
+    async def async_check(self, client: Any):
+        self._check(await client.get(self.name))
+
+    def locked(self) -> bool:
+        return bool(self._redis_client.exists(self.name))
+
+    async def async_locked(self) -> bool:
+        return bool(await self._async_redis_client.exists(self.name))
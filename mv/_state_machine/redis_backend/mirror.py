@@ -0,0 +1,181 @@
+import asyncio
+import json
+import logging
+from math import inf
+from threading import Lock, Thread
+from time import monotonic
+from typing import Any, Literal
+import redis.asyncio as asyncio_redis
+
+from ..inmem_backend.memstate import FrozenState
+from .base import DEFAULT_MACHINE_ID, MachineId
+from .keys import hash_key, state_channel, state_key, stream_key, version_key
+
+logger = logging.getLogger()
+
+RETRY_DELAY = 1.0
+
+
+class StateMirror:
+    # a local copy of the state of a machine, kept up to date from the versioned states
+    # published on every write so that reads need not go to redis. The copy is only used
+    # whilst the listener heard from redis within max_age seconds (it pings redis when
+    # there is nothing to hear, and checks the version then), reads fall back to redis
+    # otherwise. A mirror that was stopped is not started again.
+
+    def __init__(
+        self,
+        async_redis_client: asyncio_redis.Redis,
+        machine_id: MachineId = DEFAULT_MACHINE_ID,
+        transport: Literal["pubsub", "streams"] = "pubsub",
+        max_age: float = 1.0,
+        layout: Literal["json", "hash"] = "json",
+    ) -> None:
+        # connections are bound to the loop they were made on, so the mirror makes its own
+        pool = async_redis_client.connection_pool
+        self._pool_class = type(pool)
+        self._pool_kwargs = {"connection_class": pool.connection_class, **pool.connection_kwargs}
+        self._machine_id = machine_id
+        self._transport = transport
+        self.max_age = max_age
+        self._layout = layout
+        self._lock = Lock()
+        self._state: None | FrozenState = None
+        self._confirmed_at = -inf
+        self._thread: None | Thread = None
+        self._loop: None | asyncio.AbstractEventLoop = None
+        self._task: None | asyncio.Task = None
+        self._stopped = False
+
+    @property
+    def stopped(self) -> bool:
+        return self._stopped
+
+    @property
+    def version(self) -> int:
+        return self._state.version if self._state is not None else 0
+
+    def get(self) -> None | FrozenState:
+        # the state, or None if it may be older than max_age
+        if self._thread is None:
+            self.start()
+        if monotonic() - self._confirmed_at > self.max_age:
+            return None
+        return self._state
+
+    def offer(self, version: int, state: dict[str, Any]):
+        # keeps the newest state, whether heard from redis or written by this process
+        with self._lock:
+            if self._state is None or version > self._state.version:
+                self._state = FrozenState(state, version)
+
+    def _confirm(self):
+        self._confirmed_at = monotonic()
+
+    async def _revalidate(self, client: asyncio_redis.Redis):
+        # hearing nothing only means nothing was published: a write that was not (by a
+        # writer of an older release, or straight to redis) is only seen in the version
+        checked_at = monotonic()
+        version = await client.get(version_key(self._machine_id))
+        if int(version or 0) > self.version:
+            await self._load(client)
+        self._confirmed_at = checked_at
+
+    async def _load(self, client: asyncio_redis.Redis):
+        if self._layout == "hash":
+            async with client.pipeline() as pipe:
+                pipe.hgetall(hash_key(self._machine_id))
+                pipe.get(version_key(self._machine_id))
+                fields, version = await pipe.execute()
+            state = {field.decode(): json.loads(value) for field, value in fields.items()}
+            self.offer(int(version or 0), state)
+            return
+        state_str, version = await client.mget(
+            state_key(self._machine_id), version_key(self._machine_id)
+        )
+        self.offer(int(version or 0), json.loads(state_str) if state_str else {})
+
+    async def _follow_channel(self, client: asyncio_redis.Redis):
+        pubsub = client.pubsub()
+        try:
+            await pubsub.subscribe(state_channel(self._machine_id))
+            # loaded after subscribing so that no write falls in between
+            await self._load(client)
+            self._confirm()
+            while True:
+                message = await pubsub.get_message(
+                    ignore_subscribe_messages=True, timeout=self.max_age / 2
+                )
+                if message is None:
+                    await pubsub.ping()
+                    continue
+                if message["type"] == "pong":
+                    await self._revalidate(client)
+                    continue
+                self._confirm()
+                if message["type"] != "message":
+                    continue
+                if message["data"] == b"STATE_CHANGED":
+                    await self._load(client)
+                    continue
+                published = json.loads(message["data"])
+                self.offer(published["version"], published["state"])
+        finally:
+            await pubsub.aclose()
+
+    async def _follow_stream(self, client: asyncio_redis.Redis):
+        key = stream_key(self._machine_id)
+        newest = await client.xrevrange(key, count=1)
+        last_id = newest[0][0] if newest else "0-0"
+        await self._load(client)
+        self._confirm()
+        while True:
+            entries = await client.xread(
+                {key: last_id}, count=100, block=int(self.max_age * 500)
+            )
+            if not entries:
+                await self._revalidate(client)
+                continue
+            self._confirm()
+            for _, events in entries:
+                for event_id, fields in events:
+                    self.offer(int(fields[b"version"]), json.loads(fields[b"state"]))
+                    last_id = event_id
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._task = asyncio.current_task()
+        client = asyncio_redis.Redis(connection_pool=self._pool_class(**self._pool_kwargs))
+        follow = self._follow_stream if self._transport == "streams" else self._follow_channel
+        try:
+            while True:
+                try:
+                    await follow(client)
+                except (asyncio_redis.ConnectionError, asyncio_redis.TimeoutError) as exception:
+                    logger.warning(f"state mirror lost redis, retrying: {exception!r}")
+                    await asyncio.sleep(RETRY_DELAY)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            await client.aclose(close_connection_pool=True)
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None or self._stopped:
+                return
+            self._thread = Thread(
+                target=asyncio.run, args=(self._serve(),), daemon=True, name="state-mirror"
+            )
+        self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+        if self._loop and self._task:
+            try:
+                self._loop.call_soon_threadsafe(self._task.cancel)
+            except RuntimeError:
+                pass
+        if self._thread:
+            self._thread.join(1)
+        self._confirmed_at = -inf
@@ -0,0 +1,402 @@
+import json
+import logging
+from typing import Any, cast
+from redis.exceptions import ResponseError, WatchError
+
+from ..base import Attribute
+from .base import DEFAULT_MACHINE_ID, MachineId
+from .keys import hash_key
+from .mirror import StateMirror
+from .redis_stateupdater import (
+    AsyncRedis,
+    Layout,
+    MAX_CONFLICT_RETRIES,
+    Redis,
+    RedisStateUpdater,
+    StateConflict,
+    Transport,
+    UpdateMode,
+    _as_bytes,
+)
+
+logger = logging.getLogger()
+
+# the hash layout version of the compare and set: only the fields an update changed are
+# compared with what the update read and written, after which the version (KEYS[3]) is
+# bumped and the state handed to the state servers as in the json layout, with the list
+# of the changed fields (ARGV[3]) added. ARGV[4] is the number of fields set, each given as
+# field, expected and new value, followed by field and expected of every field removed;
+# a missing field is expected as ''. Returns the version and the state written. As in the
+# json layout, the write of a command in flight is refused (-1) unless its lease (KEYS[5])
+# is still held with its token (ARGV[5]).
+UPDATE_FIELDS = """
+if ARGV[5] ~= '' and redis.call('GET', KEYS[5]) ~= ARGV[5] then
+    return -1
+end
+local removed_from = 6 + 3 * tonumber(ARGV[4])
+for i = 6, removed_from - 1, 3 do
+    if (redis.call('HGET', KEYS[1], ARGV[i]) or '') ~= ARGV[i + 1] then
+        return 0
+    end
+end
+for i = removed_from, #ARGV, 2 do
+    if (redis.call('HGET', KEYS[1], ARGV[i]) or '') ~= ARGV[i + 1] then
+        return 0
+    end
+end
+for i = 6, removed_from - 1, 3 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 2])
+end
+for i = removed_from, #ARGV, 2 do
+    redis.call('HDEL', KEYS[1], ARGV[i])
+end
+local version = redis.call('INCR', KEYS[3])
+local fields = redis.call('HGETALL', KEYS[1])
+local members = {}
+for i = 1, #fields, 2 do
+    members[#members + 1] = cjson.encode(fields[i]) .. ': ' .. fields[i + 1]
+end
+local state = '{' .. table.concat(members, ', ') .. '}'
+if ARGV[1] == 'pubsub' then
+    redis.call(
+        'PUBLISH', KEYS[2],
+        '{"version": ' .. version .. ', "state": ' .. state .. ', "changed": ' .. ARGV[3] .. '}'
+    )
+elseif ARGV[1] == 'streams' then
+    redis.call(
+        'XADD', KEYS[4], 'MAXLEN', '~', ARGV[2], '*',
+        'version', version, 'state', state, 'changed', ARGV[3]
+    )
+end
+return {version, state}
+"""
+
+Fields = dict[str, bytes]
+
+
+def _fields(replied: dict[Any, Any]) -> Fields:
+    # the fields of the hash by name, with their (json) values as stored
+    return {
+        field.decode() if isinstance(field, bytes) else field: _as_bytes(value)
+        for field, value in replied.items()
+    }
+
+
+def _decoded(fields: Fields) -> dict[str, Any]:
+    return {field: json.loads(value) for field, value in fields.items()}
+
+
+def _split(state_str: Any) -> dict[str, str]:
+    # a state in the json layout as the fields of the hash
+    return {field: json.dumps(value) for field, value in json.loads(state_str).items()}
+
+
+def _state_str(fields: Fields) -> str:
+    # the state as the script builds it, without decoding the values
+    members = (f"{json.dumps(field)}: {value.decode()}" for field, value in fields.items())
+    return "{" + ", ".join(members) + "}"
+
+
+def _changes(read: Fields, state: dict[str, Any]) -> tuple[dict[str, str], list[str]]:
+    # the fields an update set (to their json values) and the fields it removed
+    changed = {}
+    for field, value in state.items():
+        encoded = json.dumps(value)
+        if read.get(field) != encoded.encode():
+            changed[field] = encoded
+    removed = [field for field in read if field not in state]
+    return changed, removed
+
+
+def _check(read: Fields, touched: list[str], current: list[Any]):
+    for field, value in zip(touched, current):
+        if _as_bytes(value) != read.get(field, b""):
+            raise StateConflict(f"{field} was changed whilst being updated")
+
+
+class RedisHashStateUpdater(RedisStateUpdater):
+    # a field per attribute in a hash per machine: an update writes only the fields it
+    # changed (and conflicts only with updates of the same fields) and a reader of one
+    # attribute fetches just that field. A state left in the json layout is moved into
+    # the hash when first used.
+
+    _layout: Layout = "hash"
+
+    def __init__(
+        self,
+        redis_client: Redis,
+        async_redis_client: AsyncRedis,
+        machine_id: MachineId = DEFAULT_MACHINE_ID,
+        mode: UpdateMode | None = None,
+        transport: Transport | None = None,
+        mirror_max_age: float | None = None,
+        mirror: None | StateMirror = None,
+    ):
+        super().__init__(
+            redis_client, async_redis_client, machine_id, mode, transport, mirror_max_age, mirror
+        )
+        self._hash_key = hash_key(machine_id)
+        self._script_keys[0] = self._hash_key
+        self._migrated = False
+        self._update_fields = self._redis_client.register_script(UPDATE_FIELDS)
+        self._async_update_fields = self._async_redis_client.register_script(UPDATE_FIELDS)
+
+    def migrate(self) -> bool:
+        # moves a state written in the json layout into the hash, True if there was one
+        with self._redis_client.pipeline() as pipe:
+            try:
+                pipe.watch(self._state_key, self._hash_key)
+                state_str = pipe.get(self._state_key)
+                if state_str is None or pipe.exists(self._hash_key):
+                    return False
+                fields = _split(state_str)
+                pipe.multi()
+                if fields:
+                    pipe.hset(self._hash_key, mapping=fields)
+                # or an emptied hash (which redis removes) would bring it back
+                pipe.delete(self._state_key)
+                pipe.execute()
+            except WatchError:
+                # moved by someone else in the meantime
+                return False
+        logger.info(f"moved the state of {self._machine_id} into {self._hash_key}")
+        return True
+
+    async def async_migrate(self) -> bool:
+        async with self._async_redis_client.pipeline() as pipe:
+            try:
+                await pipe.watch(self._state_key, self._hash_key)
+                state_str = await pipe.get(self._state_key)
+                if state_str is None or await pipe.exists(self._hash_key):
+                    return False
+                fields = _split(state_str)
+                pipe.multi()
+                if fields:
+                    pipe.hset(self._hash_key, mapping=fields)
+                pipe.delete(self._state_key)
+                await pipe.execute()
+            except WatchError:
+                return False
+        logger.info(f"moved the state of {self._machine_id} into {self._hash_key}")
+        return True
+
+    def _ensure_migrated(self):
+        if not self._migrated:
+            self.migrate()
+            self._migrated = True
+
+    async def _async_ensure_migrated(self):
+        if not self._migrated:
+            await self.async_migrate()
+            self._migrated = True
+
+    def _read(self) -> tuple[Fields, dict[str, Any]]:
+        self._ensure_migrated()
+        fields = _fields(self._redis_client.hgetall(self._hash_key))
+        return fields, _decoded(fields)
+
+    async def _async_read(self) -> tuple[Fields, dict[str, Any]]:
+        await self._async_ensure_migrated()
+        fields = _fields(await self._async_redis_client.hgetall(self._hash_key))
+        return fields, _decoded(fields)
+
+    def _script_args(self, read: Fields, changed: dict[str, str], removed: list[str]):
+        args: list[Any] = [
+            self._publishes,
+            self._maxlen,
+            json.dumps([*changed, *removed]),
+            len(changed),
+            self._fence_token,
+        ]
+        for field, value in changed.items():
+            args.extend((field, read.get(field, b""), value))
+        for field in removed:
+            args.extend((field, read[field]))
+        return args
+
+    def _applied(
+        self, current: Fields, read: Fields, changed: dict[str, str], removed: list[str]
+    ) -> None | Fields:
+        # the fields after the update, None if one it changed is no longer as it was read
+        for field in [*changed, *removed]:
+            if current.get(field, b"") != read.get(field, b""):
+                return None
+        current.update((field, value.encode()) for field, value in changed.items())
+        for field in removed:
+            del current[field]
+        return current
+
+    def _try_set_fields(
+        self, read: Fields, changed: dict[str, str], removed: list[str]
+    ) -> None | tuple[int, str]:
+        # the version and state written, None if a field changed was written meanwhile
+        if self._mode == "script":
+            try:
+                written = self._update_fields(
+                    keys=self._script_keys, args=self._script_args(read, changed, removed)
+                )
+                if written == -1:
+                    raise self._command_lease.fenced_out()
+                if not written:
+                    return None
+                return int(written[0]), _as_bytes(written[1]).decode()
+            except ResponseError as exception:
+                self._fall_back(exception)
+        with self._redis_client.pipeline() as pipe:
+            try:
+                pipe.watch(self._hash_key, self._version_key, *self._fence)
+                self._check_fence(pipe)
+                current = self._applied(
+                    _fields(pipe.hgetall(self._hash_key)), read, changed, removed
+                )
+                if current is None:
+                    return None
+                version = int(cast(Any, pipe.get(self._version_key)) or 0) + 1
+                state_str = _state_str(current)
+                pipe.multi()
+                if changed:
+                    pipe.hset(self._hash_key, mapping=changed)
+                if removed:
+                    pipe.hdel(self._hash_key, *removed)
+                pipe.set(self._version_key, version)
+                if self._publishes:
+                    self._notify(pipe, version, state_str, json.dumps([*changed, *removed]))
+                pipe.execute()
+                return version, state_str
+            except WatchError:
+                # a field this update did not change may have been written
+                return None
+
+    async def _async_try_set_fields(
+        self, read: Fields, changed: dict[str, str], removed: list[str]
+    ) -> None | tuple[int, str]:
+        if self._mode == "script":
+            try:
+                written = await self._async_update_fields(
+                    keys=self._script_keys, args=self._script_args(read, changed, removed)
+                )
+                if written == -1:
+                    raise self._command_lease.fenced_out()
+                if not written:
+                    return None
+                return int(written[0]), _as_bytes(written[1]).decode()
+            except ResponseError as exception:
+                self._fall_back(exception)
+        async with self._async_redis_client.pipeline() as pipe:
+            try:
+                await pipe.watch(self._hash_key, self._version_key, *self._fence)
+                await self._async_check_fence(pipe)
+                current = self._applied(
+                    _fields(await pipe.hgetall(self._hash_key)), read, changed, removed
+                )
+                if current is None:
+                    return None
+                version = int(await pipe.get(self._version_key) or 0) + 1
+                state_str = _state_str(current)
+                pipe.multi()
+                if changed:
+                    pipe.hset(self._hash_key, mapping=changed)
+                if removed:
+                    pipe.hdel(self._hash_key, *removed)
+                pipe.set(self._version_key, version)
+                if self._publishes:
+                    self._notify(pipe, version, state_str, json.dumps([*changed, *removed]))
+                await pipe.execute()
+                return version, state_str
+            except WatchError:
+                return None
+
+    def _written_fields(self, version: int, state_str: str):
+        # the state is only decoded when someone in this process needs it
+        if self._is_fake or self._mirror:
+            self._written(json.loads(state_str), version)
+
+    def _commit(self, read: Fields, state: dict[str, Any]):
+        # writes of other fields don't conflict, so there is nothing to rebase: a retry
+        # only follows a transaction that failed on a write of another field
+        changed, removed = _changes(read, state)
+        touched = [*changed, *removed]
+        for _ in range(MAX_CONFLICT_RETRIES + 1):
+            if written := self._try_set_fields(read, changed, removed):
+                self._written_fields(*written)
+                return
+            if touched:
+                _check(read, touched, self._redis_client.hmget(self._hash_key, touched))
+        raise StateConflict(
+            f"state kept changing whilst being updated, gave up after {MAX_CONFLICT_RETRIES}"
+            " retries"
+        )
+
+    async def _async_commit(self, read: Fields, state: dict[str, Any]):
+        changed, removed = _changes(read, state)
+        touched = [*changed, *removed]
+        for _ in range(MAX_CONFLICT_RETRIES + 1):
+            if written := await self._async_try_set_fields(read, changed, removed):
+                self._written_fields(*written)
+                return
+            if touched:
+                _check(
+                    read, touched, await self._async_redis_client.hmget(self._hash_key, touched)
+                )
+        raise StateConflict(
+            f"state kept changing whilst being updated, gave up after {MAX_CONFLICT_RETRIES}"
+            " retries"
+        )
+
+    def _write_locked(self, read: Fields, state: dict[str, Any]) -> int:
+        changed, removed = _changes(read, state)
+        with self._fenced() as pipe:
+            if changed:
+                pipe.hset(self._hash_key, mapping=changed)
+            if removed:
+                pipe.hdel(self._hash_key, *removed)
+            pipe.incr(self._version_key)
+            version = cast(int, pipe.execute()[-1])
+        if self._publishes:
+            self._notify(
+                self._redis_client,
+                version,
+                json.dumps(state),
+                json.dumps([*changed, *removed]),
+            )
+        return version
+
+    async def _async_write_locked(self, read: Fields, state: dict[str, Any]) -> int:
+        changed, removed = _changes(read, state)
+        async with self._async_fenced() as pipe:
+            if changed:
+                pipe.hset(self._hash_key, mapping=changed)
+            if removed:
+                pipe.hdel(self._hash_key, *removed)
+            pipe.incr(self._version_key)
+            version = (await pipe.execute())[-1]
+        if self._publishes:
+            await self._notify(
+                self._async_redis_client,
+                version,
+                json.dumps(state),
+                json.dumps([*changed, *removed]),
+            )
+        return version
+
+    def get_state(self):
+        self._ensure_migrated()
+        return super().get_state()
+
+    async def async_get_state(self):
+        await self._async_ensure_migrated()
+        return await super().async_get_state()
+
+    def get_attribute(self, attribute: Attribute):
+        self._ensure_migrated()
+        if self._mirror and (state := self._mirror.get()) is not None:
+            return state.get(attribute)
+        value = self._redis_client.hget(self._hash_key, attribute)
+        return json.loads(value) if value is not None else None
+
+    async def async_get_attribute(self, attribute: Attribute):
+        await self._async_ensure_migrated()
+        if self._mirror and (state := self._mirror.get()) is not None:
+            return state.get(attribute)
+        value = await self._async_redis_client.hget(self._hash_key, attribute)
+        return json.loads(value) if value is not None else None
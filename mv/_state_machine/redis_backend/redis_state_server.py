@@ -1,48 +1,111 @@
-from threading import Event
-from redis.client import PubSub, PubSubWorkerThread
-from .base import AbstractPublisher, AbstractStateServer, AbstractStateUpdater
+import asyncio
+import json
+import logging
+from threading import Event, Thread
+import redis.asyncio as asyncio_redis
+from .base import (
+    AbstractPublisher,
+    AbstractStateServer,
+    AbstractStateUpdater,
+    DEFAULT_MACHINE_ID,
+    MachineId,
+)
+from .keys import state_channel
+from .mirror import StateMirror
 
-from .state import get_state_control_signals
+logger = logging.getLogger()
+
+# how long starting the server waits for the subscription to be in place
+SUBSCRIBE_TIMEOUT = 5.0
 
 
 class RedisStateServer(AbstractStateServer):
+    # listens on the channel of the machine with the asyncio client on a loop of its own,
+    # waiting on the socket rather than polling it, so an idle server costs nothing and a
+    # notification is handled as soon as it arrives. Connections are bound to the loop
+    # they were made on, so it makes a client of its own there, like StateMirror.
 
     def __init__(
         self,
         publisher: AbstractPublisher,
-        redis_producer: PubSub,
+        async_redis_client: asyncio_redis.Redis,
         state_updater: AbstractStateUpdater,
+        machine_id: MachineId = DEFAULT_MACHINE_ID,
+        mirror: None | StateMirror = None,
     ):
         self._publisher = publisher
         self._started_flag = Event()
-        self._server_thread: None | PubSubWorkerThread = None
+        self._server_thread: None | Thread = None
+        self._loop: None | asyncio.AbstractEventLoop = None
+        self._task: None | asyncio.Task = None
         self._updater = state_updater
-        self._redis_producer = redis_producer
+        pool = async_redis_client.connection_pool
+        self._pool_class = type(pool)
+        self._pool_kwargs = {"connection_class": pool.connection_class, **pool.connection_kwargs}
+        self._machine_id = machine_id
+        # the version of the last state published
+        self.version = 0
+        # the mirror of the machine in this process, stopped with the server
+        self._mirror = mirror
 
-    def _server(self):
-        while True:
-            self._started_flag.set()
-            signal = get_state_control_signals()
-            if signal == "STATE_CHANGED":
-                state = self._updater.get_state()
-                self._publisher.publish(state)
-            else:
-                self._started_flag.clear()
-                return
+    def _handler(self, message: dict):
+        # every write publishes the new state with its version, so it is forwarded without
+        # reading it back (which could also return a later write)
+        data = message["data"]
+        if data == b"STATE_CHANGED":
+            # sent by writers from before the state was published
+            self._publisher.publish(self._updater.get_state())
+            return
+        published = json.loads(data)
+        self.version = published["version"]
+        self._publisher.publish(published["state"])
 
-    def _parse_message(self, message: dict):
-        return message["data"].decode("utf-8")
+    async def _listen(self, pubsub: asyncio_redis.client.PubSub):
+        try:
+            await pubsub.subscribe(state_channel(self._machine_id))
+        finally:
+            self._started_flag.set()
+        while True:
+            message = await pubsub.get_message(
+                ignore_subscribe_messages=True, timeout=None
+            )
+            if message is None:
+                continue
+            try:
+                self._handler(message)
+            except Exception as exception:
+                logger.exception(f"failed to publish {message}: {exception!r}")
 
-    def _handler(self, message: dict):
-        signal = self._parse_message(message)
-        if signal == "STATE_CHANGED":
-            state = self._updater.get_state()
-            self._publisher.publish(state)
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._task = asyncio.current_task()
+        client = asyncio_redis.Redis(connection_pool=self._pool_class(**self._pool_kwargs))
+        pubsub = client.pubsub()
+        try:
+            await self._listen(pubsub)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            await pubsub.aclose()
+            await client.aclose(close_connection_pool=True)
 
     def start_server(self):
-        self._redis_producer.subscribe(**{"state_control_signals": self._handler})
-        self._server_thread = self._redis_producer.run_in_thread(sleep_time=0.001)
+        self._started_flag.clear()
+        self._server_thread = Thread(
+            target=asyncio.run, args=(self._serve(),), daemon=True, name="redis-listener"
+        )
+        self._server_thread.start()
+        # no change published after starting is missed
+        self._started_flag.wait(SUBSCRIBE_TIMEOUT)
 
     def stop_server(self):
+        if self._loop and self._task:
+            try:
+                self._loop.call_soon_threadsafe(self._task.cancel)
+            except RuntimeError:
+                # the loop already ended
+                pass
         if self._server_thread:
-            self._server_thread.stop()
+            self._server_thread.join(1)
+        if self._mirror:
+            self._mirror.stop()
@@ -1,97 +1,537 @@
 from contextlib import asynccontextmanager, contextmanager
 import json
-from typing import Any, cast
+import logging
+from typing import Any, Literal, cast
 import redis
-from redis.lock import Lock as RedisLock
+from redis.exceptions import ResponseError, WatchError
 import redis.asyncio as asyncio_redis
 import fakeredis
 
-from .state import cntrl_set_state_changed, state_write_lock
+from .state import async_state_write_lock, cntrl_set_state_changed, state_write_lock
 
-from .base import AbstractStateUpdater
+from .base import AbstractStateUpdater, DEFAULT_MACHINE_ID, MachineId
+from .lease import AsyncLeaseLock, CommandLease, LeaseLock, LeaseLost, LeaseMetrics
+from .mirror import StateMirror
+from .keys import command_key, lock_key, state_channel, state_key, stream_key, version_key
+from .. import config
+
+logger = logging.getLogger()
 
 Redis = fakeredis.FakeRedis | redis.Redis
 AsyncRedis = fakeredis.FakeAsyncRedis | asyncio_redis.Redis
 
+UpdateMode = Literal["script", "transaction", "lock"]
+Transport = Literal["pubsub", "streams"]
+Layout = Literal["json", "hash"]
+
+# writes the state (KEYS[1]), bumps its version (KEYS[3]) and hands both to the state
+# servers, published on a channel (KEYS[2]) or appended to a stream (KEYS[4]) trimmed to
+# about ARGV[4] entries, in one round trip; but only if the state is still the one the
+# update started from (ARGV[1]). An empty state removes the key, as an emptied hash is
+# removed in the hash layout. The messages are built the same way as below. A write of a
+# command in flight is refused (-1) unless the command still holds its lease (KEYS[5])
+# with its token (ARGV[5]).
+COMPARE_AND_SET = """
+if ARGV[5] ~= '' and redis.call('GET', KEYS[5]) ~= ARGV[5] then
+    return -1
+end
+local current = redis.call('GET', KEYS[1]) or ''
+if current ~= ARGV[1] then
+    return 0
+end
+if ARGV[2] == '{}' then
+    redis.call('DEL', KEYS[1])
+else
+    redis.call('SET', KEYS[1], ARGV[2])
+end
+local version = redis.call('INCR', KEYS[3])
+if ARGV[3] == 'pubsub' then
+    redis.call('PUBLISH', KEYS[2], '{"version": ' .. version .. ', "state": ' .. ARGV[2] .. '}')
+elseif ARGV[3] == 'streams' then
+    redis.call(
+        'XADD', KEYS[4], 'MAXLEN', '~', ARGV[4], '*', 'version', version, 'state', ARGV[2]
+    )
+end
+return version
+"""
+
+# an update that finds the state written by someone else since it was read is retried
+# on top of the new state this many times, as long as the other writer changed
+# different attributes (otherwise StateConflict is raised right away)
+MAX_CONFLICT_RETRIES = 5
+
+_MISSING = object()
+
+
+class StateConflict(Exception):
+    pass
+
+
+def _store(pipe: Any, key: str, state_str: str):
+    # queues the write of the state in a transaction, see COMPARE_AND_SET
+    if state_str == "{}":
+        pipe.delete(key)
+    else:
+        pipe.set(key, state_str)
+
+
+def payload(version: int, state_str: str, changed: str | None = None) -> str:
+    # the message published on every write, so that subscribers need not read the state,
+    # with the (json) list of the attributes written if the layout knows them
+    if changed is None:
+        return f'{{"version": {version}, "state": {state_str}}}'
+    return f'{{"version": {version}, "state": {state_str}, "changed": {changed}}}'
+
+
+def _loads(state_str: Any) -> dict[str, Any]:
+    return json.loads(state_str) if state_str else {}
+
+
+def _as_bytes(state_str: Any) -> bytes:
+    # replies are bytes unless the client decodes them, a missing state compares as b""
+    if isinstance(state_str, str):
+        return state_str.encode()
+    return state_str or b""
+
+
+def _rebase(read: dict[str, Any], written: dict[str, Any], current: dict[str, Any]):
+    # replays the changes an update made to the state it read on the current state
+    removed = [key for key in read if key not in written]
+    changed = {key: value for key, value in written.items() if read.get(key, _MISSING) != value}
+    for key in [*removed, *changed]:
+        if current.get(key, _MISSING) != read.get(key, _MISSING):
+            raise StateConflict(f"{key} was changed to {current.get(key)} whilst being updated")
+    rebased = {key: value for key, value in current.items() if key not in removed}
+    rebased.update(changed)
+    return rebased
+
 
 class RedisStateUpdater(AbstractStateUpdater):
+    # the whole state as one json string
+
+    _layout: Layout = "json"
 
-    def __init__(self, redis_client: Redis, async_redis_client: AsyncRedis):
+    def __init__(
+        self,
+        redis_client: Redis,
+        async_redis_client: AsyncRedis,
+        machine_id: MachineId = DEFAULT_MACHINE_ID,
+        mode: UpdateMode | None = None,
+        transport: Transport | None = None,
+        mirror_max_age: float | None = None,
+        mirror: None | StateMirror = None,
+    ):
         self._redis_client = redis_client
         self._async_redis_client = async_redis_client
-        self._state_write_lock: RedisLock = self._redis_client.lock(
-            "_state_write_lock", timeout=30
+        self._machine_id = machine_id
+        self._state_key = state_key(machine_id)
+        self._channel = state_channel(machine_id)
+        self._version_key = version_key(machine_id)
+        self._stream_key = stream_key(machine_id)
+        self._mode = cast(UpdateMode, mode or config.get_redis_update_mode())
+        self._transport = cast(Transport, transport or config.get_redis_state_transport())
+        self._maxlen = config.get_redis_stream_maxlen()
+        # a command in flight holds a lease for as long as it runs, which fences its
+        # writes and tells the other replicas the machine is busy
+        self._command_lease = CommandLease(
+            self._redis_client,
+            self._async_redis_client,
+            command_key(machine_id),
+            config.get_command_lease(),
+        )
+        self._script_keys = [
+            self._state_key,
+            self._channel,
+            self._version_key,
+            self._stream_key,
+            self._command_lease.name,
+        ]
+        # the lock of the lock mode is only held around a write, the lease bounds how long
+        # a replica that died holding it blocks the others
+        lease = config.get_redis_lock_lease()
+        self._lock_metrics = LeaseMetrics()
+        self._state_write_lock = LeaseLock(
+            self._redis_client, lock_key(machine_id), lease, self._lock_metrics
+        )
+        self._async_state_write_lock = AsyncLeaseLock(
+            self._async_redis_client, lock_key(machine_id), lease, self._lock_metrics
+        )
+        if mirror_max_age is None:
+            mirror_max_age = config.get_redis_mirror_max_age()
+        # fake redis lives in this process and publishes on the hub instead
+        self._mirror: None | StateMirror = None
+        if mirror is not None:
+            # shared with the other updaters of the machine, see Redisfactory
+            self._mirror = mirror
+        elif mirror_max_age > 0 and not self._is_fake:
+            self._mirror = StateMirror(
+                self._async_redis_client,
+                machine_id,
+                self._transport,
+                mirror_max_age,
+                self._layout,
+            )
+        self._compare_and_set = self._redis_client.register_script(COMPARE_AND_SET)
+        self._async_compare_and_set = self._async_redis_client.register_script(
+            COMPARE_AND_SET
         )
 
+    @property
+    def machine_id(self) -> MachineId:
+        return self._machine_id
+
+    @property
+    def mode(self) -> UpdateMode:
+        return self._mode
+
+    @property
+    def _is_fake(self) -> bool:
+        return isinstance(self._redis_client, fakeredis.FakeRedis)
+
     @contextmanager
     def _write_lock(self):
-        if isinstance(self._redis_client, fakeredis.FakeRedis):
-            with state_write_lock():
+        if self._is_fake:
+            with state_write_lock(self._machine_id):
                 yield
-        else:
+        elif self._mode == "lock":
             with self._state_write_lock:
                 yield
+        else:
+            yield
 
-    def _publish_state_changed(self, state: Any):
-        if isinstance(self._redis_client, fakeredis.FakeRedis):
-            cntrl_set_state_changed(state)
+    @asynccontextmanager
+    async def _async_write_lock(self):
+        if self._is_fake:
+            async with async_state_write_lock(self._machine_id):
+                yield
+        elif self._mode == "lock":
+            async with self._async_state_write_lock:
+                yield
         else:
-            self._redis_client.publish("state_control_signals", "STATE_CHANGED")
+            yield
+
+    @property
+    def lock_metrics(self) -> LeaseMetrics:
+        return self._lock_metrics
+
+    @property
+    def _fence(self) -> list[str]:
+        # the writes of a command in flight only go through whilst it holds its lease
+        return [self._command_lease.name] if self._command_lease.token else []
+
+    @property
+    def _fence_token(self) -> int | str:
+        return self._command_lease.token or ""
+
+    def _check_fence(self, pipe: Any):
+        # called on a pipeline watching the keys of _fence
+        if self._command_lease.token:
+            self._command_lease.check(pipe)
+
+    async def _async_check_fence(self, pipe: Any):
+        if self._command_lease.token:
+            await self._command_lease.async_check(pipe)
+
+    @contextmanager
+    def _fenced(self):
+        # a transaction that is only executed whilst this process still holds the lock
+        # (and the lease of the command it writes for), so that a holder whose lease ran
+        # out cannot write over the next one
+        with self._redis_client.pipeline() as pipe:
+            if self._is_fake:
+                yield pipe
+                return
+            try:
+                pipe.watch(self._state_write_lock.name, *self._fence)
+                self._state_write_lock.check(pipe)
+                self._check_fence(pipe)
+                pipe.multi()
+                yield pipe
+            except WatchError as exception:
+                raise LeaseLost(f"{self._state_write_lock.name} was taken over") from exception
+
+    @asynccontextmanager
+    async def _async_fenced(self):
+        async with self._async_redis_client.pipeline() as pipe:
+            if self._is_fake:
+                yield pipe
+                return
+            try:
+                await pipe.watch(self._async_state_write_lock.name, *self._fence)
+                await self._async_state_write_lock.check(pipe)
+                await self._async_check_fence(pipe)
+                pipe.multi()
+                yield pipe
+            except WatchError as exception:
+                raise LeaseLost(
+                    f"{self._async_state_write_lock.name} was taken over"
+                ) from exception
+
+    @property
+    def transport(self) -> Transport:
+        return self._transport
+
+    @property
+    def _publishes(self) -> str:
+        # fake redis only lives in this process, its state servers listen on the hub
+        return "" if self._is_fake else self._transport
+
+    def _notify(
+        self, client: Any, version: int, state_str: str, changed: str | None = None
+    ) -> Any:
+        # client is a redis client (of which the async one returns an awaitable) or a
+        # pipeline in a transaction
+        if self._transport == "streams":
+            fields: dict[str, Any] = {"version": version, "state": state_str}
+            if changed is not None:
+                fields["changed"] = changed
+            return client.xadd(
+                self._stream_key, fields, maxlen=self._maxlen, approximate=True
+            )
+        return client.publish(self._channel, payload(version, state_str, changed))
+
+    def _fall_back(self, exception: ResponseError):
+        # e.g. managed servers that disable EVAL
+        logger.warning(f"redis refused the update script ({exception}), using WATCH/MULTI")
+        self._mode = "transaction"
+
+    def _set_args(self, expected: bytes, state_str: str) -> list[Any]:
+        return [expected, state_str, self._publishes, self._maxlen, self._fence_token]
+
+    def _try_set(self, expected: bytes, state_str: str) -> int:
+        # the version written, 0 if the state was not the expected one
+        if self._mode == "script":
+            try:
+                version = self._compare_and_set(
+                    keys=self._script_keys, args=self._set_args(expected, state_str)
+                )
+            except ResponseError as exception:
+                self._fall_back(exception)
+            else:
+                if version == -1:
+                    raise self._command_lease.fenced_out()
+                return version
+        with self._redis_client.pipeline() as pipe:
+            try:
+                pipe.watch(self._state_key, self._version_key, *self._fence)
+                self._check_fence(pipe)
+                current, version = pipe.mget(self._state_key, self._version_key)
+                if _as_bytes(current) != expected:
+                    return 0
+                version = int(version or 0) + 1
+                pipe.multi()
+                _store(pipe, self._state_key, state_str)
+                pipe.set(self._version_key, version)
+                if self._publishes:
+                    self._notify(pipe, version, state_str)
+                pipe.execute()
+                return version
+            except WatchError:
+                return 0
+
+    async def _async_try_set(self, expected: bytes, state_str: str) -> int:
+        if self._mode == "script":
+            try:
+                version = await self._async_compare_and_set(
+                    keys=self._script_keys, args=self._set_args(expected, state_str)
+                )
+            except ResponseError as exception:
+                self._fall_back(exception)
+            else:
+                if version == -1:
+                    raise self._command_lease.fenced_out()
+                return version
+        async with self._async_redis_client.pipeline() as pipe:
+            try:
+                await pipe.watch(self._state_key, self._version_key, *self._fence)
+                await self._async_check_fence(pipe)
+                current, version = await pipe.mget(self._state_key, self._version_key)
+                if _as_bytes(current) != expected:
+                    return 0
+                version = int(version or 0) + 1
+                pipe.multi()
+                _store(pipe, self._state_key, state_str)
+                pipe.set(self._version_key, version)
+                if self._publishes:
+                    self._notify(pipe, version, state_str)
+                await pipe.execute()
+                return version
+            except WatchError:
+                return 0
+
+    def _written(self, state: dict[str, Any], version: int):
+        if self._is_fake:
+            cntrl_set_state_changed(state, self._machine_id)
+        if self._mirror:
+            # reads see this process' own writes straight away
+            self._mirror.offer(version, state)
+
+    def _commit(self, state_str: Any, state: dict[str, Any]):
+        read = _loads(state_str)
+        for _ in range(MAX_CONFLICT_RETRIES + 1):
+            if version := self._try_set(_as_bytes(state_str), json.dumps(state)):
+                self._written(state, version)
+                return
+            state_str = self._redis_client.get(self._state_key)
+            current = _loads(state_str)
+            state = _rebase(read, state, current)
+            read = current
+        raise StateConflict(
+            f"state kept changing whilst being updated, gave up after {MAX_CONFLICT_RETRIES}"
+            " retries"
+        )
+
+    async def _async_commit(self, state_str: Any, state: dict[str, Any]):
+        read = _loads(state_str)
+        for _ in range(MAX_CONFLICT_RETRIES + 1):
+            if version := await self._async_try_set(_as_bytes(state_str), json.dumps(state)):
+                self._written(state, version)
+                return
+            state_str = await self._async_redis_client.get(self._state_key)
+            current = _loads(state_str)
+            state = _rebase(read, state, current)
+            read = current
+        raise StateConflict(
+            f"state kept changing whilst being updated, gave up after {MAX_CONFLICT_RETRIES}"
+            " retries"
+        )
+
+    def _read(self) -> tuple[Any, dict[str, Any]]:
+        # the state as stored, which a write compares against, and the state itself
+        state_str = self._redis_client.get(self._state_key)
+        return state_str, _loads(state_str)
+
+    async def _async_read(self) -> tuple[Any, dict[str, Any]]:
+        state_str = await self._async_redis_client.get(self._state_key)
+        return state_str, _loads(state_str)
+
+    def _write_locked(self, read: Any, state: dict[str, Any]) -> int:
+        # the write of the lock mode, nobody else writes whilst the lock is held
+        state_str = json.dumps(state)
+        with self._fenced() as pipe:
+            _store(pipe, self._state_key, state_str)
+            pipe.incr(self._version_key)
+            version = cast(int, pipe.execute()[-1])
+        if self._publishes:
+            self._notify(self._redis_client, version, state_str)
+        return version
+
+    async def _async_write_locked(self, read: Any, state: dict[str, Any]) -> int:
+        state_str = json.dumps(state)
+        async with self._async_fenced() as pipe:
+            _store(pipe, self._state_key, state_str)
+            pipe.incr(self._version_key)
+            version = (await pipe.execute())[-1]
+        if self._publishes:
+            await self._notify(self._async_redis_client, version, state_str)
+        return version
 
     @contextmanager
     def update_state(self):
-        # only one thread at a time can write or update the state
-        # after a write, a signal is sent indicating the state has changed
-        # once the signal is sent the update state lock is released
+        # the state is read, changed by the caller and then written back (and the state
+        # servers notified) in a single round trip, provided nobody else wrote it in the
+        # meantime (see MAX_CONFLICT_RETRIES)
         with self._write_lock():
-            state_str = self._redis_client.get("state")
-            if state_str:
-                state = json.loads(cast(str, state_str))
-            else:
-                state = {}
-            # we copy the state so that it can be red statically whilst being updated
+            read, state = self._read()
             yield state
-            state_str = json.dumps(state)
-            self._redis_client.set("state", state_str)
-            self._publish_state_changed(state)
+            if self._mode == "lock":
+                self._written(state, self._write_locked(read, state))
+            else:
+                self._commit(read, state)
 
     @asynccontextmanager
     async def async_update_state(self):
-        # only one thread at a time can write or update the state
-        # after a write, a signal is sent indicating the state has changed
-        # once the signal is sent the update state lock is released
-        with self._state_write_lock:
-            state_str = await self._async_redis_client.get("state")
-            if state_str:
-                state = json.loads(cast(str, state_str))
-            else:
-                state = {}
-            # we copy the state so that it can be red statically whilst being updated
+        async with self._async_write_lock():
+            read, state = await self._async_read()
             yield state
-            state_str = json.dumps(state)
-            await self._async_redis_client.set("state", state_str)
-            self._publish_state_changed(state)
+            if self._mode == "lock":
+                self._written(state, await self._async_write_locked(read, state))
+            else:
+                await self._async_commit(read, state)
 
     @contextmanager
     def atomic(self):
-        state_str = self._redis_client.get("state")
+        # a failure is rolled back by a write like any other (versioned and handed to the
+        # state servers) of the state from before
+        _, original_state = self._read()
         try:
             yield
         except Exception as exception:
-            self._redis_client.set("state", cast(str, state_str))
+            with self.update_state() as state:
+                state.clear()
+                state.update(original_state)
             raise exception
 
+    @asynccontextmanager
+    async def async_atomic(self):
+        _, original_state = await self._async_read()
+        try:
+            yield
+        except Exception as exception:
+            async with self.async_update_state() as state:
+                state.clear()
+                state.update(original_state)
+            raise exception
+
+    @property
+    def mirror(self) -> None | StateMirror:
+        return self._mirror
+
     def get_state(self):
-        state_str = self._redis_client.get("state")
-        if state_str:
-            read_state = json.loads(cast(str, state_str))
-        else:
-            read_state = {}
-        return read_state
+        if self._mirror and (state := self._mirror.get()) is not None:
+            return state
+        return self._read()[1]
+
+    async def async_get_state(self):
+        if self._mirror and (state := self._mirror.get()) is not None:
+            return state
+        return (await self._async_read())[1]
 
     def reset_state(self):
         with self.update_state() as state:
             state.clear()
 
+    # fake redis only lives in this process, where the scheduler tracks the commands
+    @property
+    def leases_commands(self) -> bool:
+        return not self._is_fake
+
+    def begin_command(self, command: str) -> bool:
+        return self._is_fake or self._command_lease.acquire()
+
+    async def async_begin_command(self, command: str) -> bool:
+        return self._is_fake or await self._command_lease.async_acquire()
+
+    def renew_command(self) -> bool:
+        return self._is_fake or self._command_lease.renew()
+
+    def end_command(self):
+        if self._command_lease.token:
+            self._command_lease.release()
+
+    async def async_end_command(self):
+        if self._command_lease.token:
+            await self._command_lease.async_release()
+
+    # the writes of a command whose lease was broken are refused by the fence
+    def abort_command(self):
+        if not self._is_fake:
+            self._command_lease.break_lease()
+
+    async def async_abort_command(self):
+        if not self._is_fake:
+            await self._command_lease.async_break_lease()
+
+    def command_in_flight(self) -> bool:
+        return not self._is_fake and self._command_lease.locked()
+
+    @property
+    def command_metrics(self) -> LeaseMetrics:
+        return self._command_lease.metrics
+
     def state_machine_is_busy(self) -> bool:
-        return self._state_write_lock.locked()
+        # a command in flight on any replica holds the lease of the machine
+        return self.command_in_flight()
+
+    async def async_state_machine_is_busy(self) -> bool:
+        return not self._is_fake and await self._command_lease.async_locked()
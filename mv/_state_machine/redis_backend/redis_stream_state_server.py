@@ -0,0 +1,124 @@
+import json
+import logging
+from threading import Event, Thread
+from typing import Any
+import redis
+from redis.exceptions import ResponseError
+import fakeredis
+from .base import (
+    AbstractPublisher,
+    AbstractStateServer,
+    DEFAULT_MACHINE_ID,
+    MachineId,
+)
+from .keys import stream_key
+from .mirror import StateMirror
+
+logger = logging.getLogger()
+
+Redis = fakeredis.FakeRedis | redis.Redis
+
+# how long a read waits for new events, i.e. how long stopping the server can take
+BLOCK_MS = 200
+BATCH = 100
+RETRY_DELAY = 1.0
+
+
+class RedisStreamStateServer(AbstractStateServer):
+    # reads the state changes from the event log of the machine rather than a channel:
+    # a reader that stalls (or loses its connection) carries on from the last event it
+    # delivered, as long as that is still within the (trimmed) log. A reader in a
+    # consumer group resumes from where the group left off, also after a restart; every
+    # reader needs a group of its own as a group splits the events among its readers.
+
+    def __init__(
+        self,
+        publisher: AbstractPublisher,
+        redis_client: Redis,
+        machine_id: MachineId = DEFAULT_MACHINE_ID,
+        group: str | None = None,
+        last_id: str = "$",
+        mirror: None | StateMirror = None,
+    ):
+        self._publisher = publisher
+        self._redis_client = redis_client
+        self._machine_id = machine_id
+        self._stream_key = stream_key(machine_id)
+        self._group = group
+        # the group is the reader's own, so a fixed consumer name gets it back the events
+        # it had not acknowledged before a restart
+        self._consumer = "reader"
+        self._stop = Event()
+        self._server_thread: None | Thread = None
+        # the id of the last event delivered, "$" for the events added from now on
+        self.last_id = last_id
+        # the mirror of the machine in this process, stopped with the server
+        self._mirror = mirror
+
+    def _join_group(self):
+        try:
+            self._redis_client.xgroup_create(
+                self._stream_key, self._group, id=self.last_id, mkstream=True
+            )
+        except ResponseError as exception:
+            if "BUSYGROUP" not in str(exception):
+                raise
+
+    def _resolve_last_id(self):
+        # "$" means the newest event at the time of every read, events added in between
+        # reads would be missed so it is pinned down to an id once
+        if self.last_id == "$":
+            newest = self._redis_client.xrevrange(self._stream_key, count=1)
+            self.last_id = newest[0][0].decode() if newest else "0-0"
+
+    def _read(self, pending: bool) -> list[Any]:
+        if self._group is None:
+            return self._redis_client.xread(
+                {self._stream_key: self.last_id}, count=BATCH, block=BLOCK_MS
+            )
+        # first the events delivered to this reader before but not acknowledged
+        return self._redis_client.xreadgroup(
+            self._group,
+            self._consumer,
+            {self._stream_key: "0" if pending else ">"},
+            count=BATCH,
+            block=None if pending else BLOCK_MS,
+        )
+
+    def _deliver(self, entries: list[Any]) -> int:
+        delivered = 0
+        for _, events in entries:
+            for event_id, fields in events:
+                self._publisher.publish(json.loads(fields[b"state"]))
+                self.last_id = event_id.decode()
+                if self._group is not None:
+                    self._redis_client.xack(self._stream_key, self._group, event_id)
+                delivered += 1
+        return delivered
+
+    def _server(self):
+        pending = self._group is not None
+        while not self._stop.is_set():
+            try:
+                delivered = self._deliver(self._read(pending))
+                if pending and not delivered:
+                    pending = False
+            except redis.ConnectionError as exception:
+                logger.warning(f"reading state events failed, retrying: {exception!r}")
+                self._stop.wait(RETRY_DELAY)
+
+    def start_server(self):
+        if self._group is None:
+            self._resolve_last_id()
+        else:
+            self._join_group()
+        self._stop.clear()
+        self._server_thread = Thread(target=self._server, daemon=True)
+        self._server_thread.start()
+
+    def stop_server(self):
+        self._stop.set()
+        if self._server_thread:
+            self._server_thread.join(1)
+        if self._mirror:
+            self._mirror.stop()
@@ -0,0 +1,49 @@
+from threading import Lock
+from typing import Callable, Generic, TypeVar
+
+from .base import DEFAULT_MACHINE_ID, MachineId
+
+M = TypeVar("M")
+
+
+class StateMachineRegistry(Generic[M]):
+    # lookups of existing machines are a plain dict read, the registry lock is only
+    # taken when a machine gets created or removed
+
+    def __init__(self, machine_factory: Callable[[MachineId], M]) -> None:
+        self._machine_factory = machine_factory
+        self._machines: dict[MachineId, M] = {}
+        self._lock = Lock()
+
+    def get(self, machine_id: MachineId = DEFAULT_MACHINE_ID) -> M:
+        try:
+            return self._machines[machine_id]
+        except KeyError:
+            with self._lock:
+                if machine_id not in self._machines:
+                    self._machines[machine_id] = self._machine_factory(machine_id)
+                return self._machines[machine_id]
+
+    def replace(self, machine_id: MachineId = DEFAULT_MACHINE_ID) -> M:
+        with self._lock:
+            machine = self._machine_factory(machine_id)
+            self._machines[machine_id] = machine
+            return machine
+
+    def remove(self, machine_id: MachineId = DEFAULT_MACHINE_ID):
+        with self._lock:
+            self._machines.pop(machine_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._machines.clear()
+
+    @property
+    def machine_ids(self) -> list[MachineId]:
+        return list(self._machines)
+
+    def __contains__(self, machine_id: MachineId) -> bool:
+        return machine_id in self._machines
+
+    def __len__(self) -> int:
+        return len(self._machines)
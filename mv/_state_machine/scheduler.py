@@ -0,0 +1,327 @@
+import asyncio
+from heapq import heappop, heappush
+from itertools import count
+import logging
+from threading import Condition, Event, Thread
+from typing import Callable, Sequence
+
+from .base import MachineId
+from .clock import Clock, ClockBusyError, get_clock, set_clock
+from .transitions import Phase
+
+logger = logging.getLogger(__name__)
+
+
+class CommandInFlight(Exception):
+    pass
+
+
+class CommandCancelled(Exception):
+    pass
+
+
+class Timer:
+
+    def __init__(self, due: float, callback: Callable[[], None]) -> None:
+        self.due = due
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class ScheduledCommand:
+    # an in flight command: the phases still to be applied and the timer of the next
+    # delayed phase, which can be inspected and cancelled while the command is pending
+
+    def __init__(
+        self,
+        scheduler: "TransitionScheduler",
+        machine_id: MachineId,
+        command: str,
+        phases: Sequence[Phase],
+    ) -> None:
+        self._scheduler = scheduler
+        self.machine_id = machine_id
+        self.command = command
+        self.phases = list(phases)
+        self.phase_index = 0
+        self._timer: None | Timer = None
+        self._wake_sleeper: None | Callable[[], None] = None
+        # called once when the command finishes or is cancelled, before it counts as done
+        self._on_done: None | Callable[[], None] = None
+        self._cancelled = False
+        self._exception: None | BaseException = None
+        self._done = Event()
+
+    def __repr__(self) -> str:
+        return (
+            f"ScheduledCommand({self.machine_id!r}, {self.command!r}, "
+            f"phase={self.phase_index}/{len(self.phases)}, due={self.due})"
+        )
+
+    @property
+    def due(self) -> float | None:
+        if self._timer and not self._timer.cancelled and not self.done:
+            return self._timer.due
+        return None
+
+    @property
+    def next_phase(self) -> Phase | None:
+        if self.phase_index < len(self.phases):
+            return self.phases[self.phase_index]
+        return None
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled
+
+    @property
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def cancel(self) -> bool:
+        return self._scheduler.cancel(self)
+
+    def wait(self, timeout: float | None = None) -> bool:
+        finished = self._done.wait(timeout)
+        if self._exception:
+            raise self._exception
+        return finished
+
+    async def async_sleep(self, delay: float):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake(cancel: bool = False):
+            def resolve():
+                if future.done():
+                    return
+                if cancel:
+                    future.cancel()
+                else:
+                    future.set_result(None)
+
+            loop.call_soon_threadsafe(resolve)
+
+        self._wake_sleeper = lambda: wake(cancel=True)
+        try:
+            # cancelled whilst it was not sleeping, e.g. whilst writing the phase before
+            if self._cancelled:
+                raise CommandCancelled(f"{self.command} cancelled")
+            self._timer = self._scheduler.call_later(delay, wake)
+            await future
+        except asyncio.CancelledError as error:
+            if self._cancelled:
+                raise CommandCancelled(f"{self.command} cancelled") from error
+            raise
+        finally:
+            self._wake_sleeper = None
+
+
+class TransitionScheduler:
+    # a single thread fires the timers of all delayed phases (ordered on a heap by due
+    # time and submission order), so the number of threads stays the same however many
+    # commands are in flight
+
+    def __init__(self, clock: Clock | None = None) -> None:
+        self._clock = clock if clock else get_clock()
+        self._clock.subscribe(self.wake)
+        self._timers: list[tuple[float, int, Timer]] = []
+        self._sequence = count()
+        self._commands: dict[MachineId, ScheduledCommand] = {}
+        self._condition = Condition()
+        self._thread: None | Thread = None
+
+    @property
+    def clock(self) -> Clock:
+        return self._clock
+
+    def set_clock(self, clock: Clock):
+        # timers keep their due times, so switching clocks is refused whilst commands
+        # are in flight, their delays being measured on the time base of the old clock
+        with self._condition:
+            if self._commands:
+                raise ClockBusyError(
+                    f"the clock can not be switched whilst {len(self._commands)} "
+                    "commands are in flight"
+                )
+            self._clock.unsubscribe(self.wake)
+            self._clock = clock
+            self._clock.subscribe(self.wake)
+            self._condition.notify()
+
+    def now(self) -> float:
+        return self._clock.now()
+
+    def _ensure_started(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = Thread(target=self._run, daemon=True, name="transition-scheduler")
+            self._thread.start()
+
+    def wake(self):
+        # re-evaluate the due timers, e.g. after the clock was moved
+        with self._condition:
+            self._condition.notify()
+
+    def call_later(self, delay: float | None, callback: Callable[[], None]) -> Timer:
+        with self._condition:
+            timer = Timer(self._clock.now() + max(delay or 0, 0), callback)
+            heappush(self._timers, (timer.due, next(self._sequence), timer))
+            self._ensure_started()
+            self._condition.notify()
+        return timer
+
+    def _next_due_timer(self) -> Timer:
+        with self._condition:
+            while True:
+                now = self._clock.now()
+                while self._timers and self._timers[0][2].cancelled:
+                    heappop(self._timers)
+                if self._timers and self._timers[0][0] <= now:
+                    return heappop(self._timers)[2]
+                timeout = self._clock.timeout(self._timers[0][0] - now) if self._timers else None
+                self._condition.wait(timeout)
+
+    def _run(self):
+        while True:
+            timer = self._next_due_timer()
+            try:
+                timer.callback()
+            except Exception:
+                logger.exception("scheduled transition failed")
+
+    def register(
+        self, machine_id: MachineId, command: str, phases: Sequence[Phase]
+    ) -> ScheduledCommand:
+        with self._condition:
+            if in_flight := self._commands.get(machine_id):
+                raise CommandInFlight(
+                    f"{command} not allowed whilst {in_flight.command} is in flight"
+                )
+            scheduled = ScheduledCommand(self, machine_id, command, phases)
+            self._commands[machine_id] = scheduled
+            return scheduled
+
+    def finish(self, scheduled: ScheduledCommand, exception: None | BaseException = None):
+        with self._condition:
+            if self._commands.get(scheduled.machine_id) is scheduled:
+                del self._commands[scheduled.machine_id]
+            on_done, scheduled._on_done = scheduled._on_done, None
+        if on_done:
+            on_done()
+        scheduled._exception = exception
+        scheduled._done.set()
+
+    def submit(
+        self,
+        machine_id: MachineId,
+        command: str,
+        phases: Sequence[Phase],
+        apply_phase: Callable[[Phase], None],
+        on_error: None | Callable[[ScheduledCommand, Exception], None] = None,
+        on_done: None | Callable[[], None] = None,
+    ) -> ScheduledCommand:
+        # phases without a delay are applied straight away by the caller, the first
+        # delayed phase is handed over to the scheduler thread
+        scheduled = self.register(machine_id, command, phases)
+        scheduled._on_done = on_done
+        self._step(scheduled, apply_phase, on_error, delay_elapsed=False)
+        return scheduled
+
+    def _step(
+        self,
+        scheduled: ScheduledCommand,
+        apply_phase: Callable[[Phase], None],
+        on_error: None | Callable[[ScheduledCommand, Exception], None],
+        delay_elapsed: bool,
+    ):
+        try:
+            while (phase := scheduled.next_phase) is not None:
+                if scheduled.cancelled:
+                    return
+                if phase.delay and not delay_elapsed:
+                    scheduled._timer = self.call_later(
+                        phase.delay,
+                        lambda: self._step(scheduled, apply_phase, on_error, True),
+                    )
+                    return
+                delay_elapsed = False
+                apply_phase(phase)
+                scheduled.phase_index += 1
+        except CommandCancelled:
+            # the phase was preempted, the state it found is left as is
+            scheduled._cancelled = True
+            self.finish(scheduled)
+            return
+        except Exception as exception:
+            # commands that were only submitted are not waited on, so the log is the only
+            # trace of their failure that is seen
+            logger.exception(f"{scheduled.command} of {scheduled.machine_id} failed")
+            try:
+                if on_error:
+                    on_error(scheduled, exception)
+            finally:
+                self.finish(scheduled, exception)
+            return
+        self.finish(scheduled)
+
+    def cancel(self, scheduled: ScheduledCommand) -> bool:
+        with self._condition:
+            if scheduled.done or scheduled.cancelled:
+                return False
+            scheduled._cancelled = True
+            if scheduled._timer:
+                scheduled._timer.cancel()
+            # the machine is free for a new command straight away
+            if self._commands.get(scheduled.machine_id) is scheduled:
+                del self._commands[scheduled.machine_id]
+            self._condition.notify()
+        if scheduled._wake_sleeper:
+            # async commands finish themselves once their sleep is interrupted
+            scheduled._wake_sleeper()
+        else:
+            self.finish(scheduled)
+        return True
+
+    def cancel_machine(self, machine_id: MachineId) -> ScheduledCommand | None:
+        if scheduled := self._commands.get(machine_id):
+            if self.cancel(scheduled):
+                return scheduled
+        return None
+
+    def in_flight(self, machine_id: MachineId | None = None) -> list[ScheduledCommand]:
+        with self._condition:
+            if machine_id is None:
+                return list(self._commands.values())
+            if scheduled := self._commands.get(machine_id):
+                return [scheduled]
+            return []
+
+    def is_busy(self, machine_id: MachineId) -> bool:
+        return machine_id in self._commands
+
+
+_scheduler: None | TransitionScheduler = None
+
+
+def inject_scheduler(scheduler: TransitionScheduler | None):
+    global _scheduler
+    _scheduler = scheduler
+
+
+def get_scheduler() -> TransitionScheduler:
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = TransitionScheduler()
+    return _scheduler
+
+
+def use_clock(clock: Clock):
+    get_scheduler().set_clock(clock)
+    set_clock(clock)
+
+
+def advance_clock(seconds: float):
+    get_scheduler().clock.advance(seconds)
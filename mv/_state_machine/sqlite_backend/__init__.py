@@ -0,0 +1,8 @@
+from .sqlite_state_server import SqliteStateServer
+from .sqlite_stateupdater import SqliteStateUpdater
+
+
+__all__ = [
+    "SqliteStateServer",
+    "SqliteStateUpdater",
+]
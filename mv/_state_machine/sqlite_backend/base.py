@@ -0,0 +1,15 @@
+from ..base import (
+    AbstractPublisher,
+    AbstractStateServer,
+    AbstractStateUpdater,
+    DEFAULT_MACHINE_ID,
+    MachineId,
+)
+
+__all__ = [
+    "AbstractPublisher",
+    "AbstractStateServer",
+    "AbstractStateUpdater",
+    "DEFAULT_MACHINE_ID",
+    "MachineId",
+]
@@ -0,0 +1,127 @@
+import logging
+from pathlib import Path
+import sqlite3
+from threading import Event, Lock, Thread
+
+from ..event_hub import DEFAULT_MAXSIZE, DEFAULT_POLICY, Policy
+from ..state_server import StateServer
+from .. import config
+from .base import AbstractPublisher, DEFAULT_MACHINE_ID, MachineId
+from .sqlite_stateupdater import SqliteStateUpdater
+
+logger = logging.getLogger()
+
+
+def _data_version(connection: sqlite3.Connection) -> int:
+    return connection.execute("PRAGMA data_version").fetchone()[0]
+
+
+class DataVersionPoller:
+    # one per database: the data_version of a connection of its own changes with every
+    # commit made by any other connection, which a poll every interval seconds reads
+    # without reading the database. On a change every updater added has the state of its
+    # machine published if it changed.
+
+    def __init__(self, interval: float) -> None:
+        self._interval = interval
+        self._lock = Lock()
+        self._updaters: list[SqliteStateUpdater] = []
+        self._stopped = Event()
+        self._thread: None | Thread = None
+
+    def _publish_changes(self):
+        with self._lock:
+            updaters = list(self._updaters)
+        for updater in updaters:
+            try:
+                updater.publish_changes()
+            except Exception as exception:
+                logger.exception(f"failed to publish a change: {exception!r}")
+
+    def _poll(self, connection: sqlite3.Connection, data_version: int):
+        try:
+            while not self._stopped.wait(self._interval):
+                latest = _data_version(connection)
+                if latest == data_version:
+                    continue
+                data_version = latest
+                self._publish_changes()
+        finally:
+            connection.close()
+
+    def add(self, updater: SqliteStateUpdater):
+        with self._lock:
+            if self._thread is None:
+                connection = updater.connect()
+                # read before taking note of the state, so that no commit falls in between
+                data_version = _data_version(connection)
+                self._thread = Thread(
+                    target=self._poll,
+                    args=(connection, data_version),
+                    daemon=True,
+                    name="sqlite-poller",
+                )
+                self._thread.start()
+            self._updaters.append(updater)
+        updater.publish_changes()
+
+    def remove(self, updater: SqliteStateUpdater) -> bool:
+        # stops polling once no updater is left, which it tells
+        with self._lock:
+            self._updaters.remove(updater)
+            if self._updaters:
+                return False
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(1)
+        return True
+
+
+_pollers: dict[Path, DataVersionPoller] = {}
+_pollers_lock = Lock()
+
+
+def _start_polling(updater: SqliteStateUpdater, interval: float):
+    # the poller of the database polls every interval of the first server that started it
+    path = updater.path.resolve()
+    with _pollers_lock:
+        if path not in _pollers:
+            _pollers[path] = DataVersionPoller(interval)
+        _pollers[path].add(updater)
+
+
+def _stop_polling(updater: SqliteStateUpdater):
+    path = updater.path.resolve()
+    with _pollers_lock:
+        if _pollers[path].remove(updater):
+            del _pollers[path]
+
+
+class SqliteStateServer(StateServer):
+    # also publishes the states other processes commit to the database, told by the
+    # DataVersionPoller of the database, which the servers of its machines share
+
+    def __init__(
+        self,
+        publisher: AbstractPublisher,
+        state_updater: SqliteStateUpdater,
+        machine_id: MachineId = DEFAULT_MACHINE_ID,
+        policy: Policy = DEFAULT_POLICY,
+        maxsize: int = DEFAULT_MAXSIZE,
+        interval: float | None = None,
+    ):
+        super().__init__(publisher, state_updater, machine_id, policy, maxsize)
+        self._sqlite_updater = state_updater
+        self._interval = config.get_sqlite_poll_interval() if interval is None else interval
+        self._polling = False
+
+    def start_server(self):
+        super().start_server()
+        _start_polling(self._sqlite_updater, self._interval)
+        self._polling = True
+
+    def stop_server(self):
+        if self._polling:
+            _stop_polling(self._sqlite_updater)
+            self._polling = False
+        super().stop_server()
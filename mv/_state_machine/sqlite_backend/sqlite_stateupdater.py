@@ -0,0 +1,356 @@
+import asyncio
+from contextlib import asynccontextmanager, contextmanager
+import json
+from pathlib import Path
+import sqlite3
+from threading import Lock
+from time import time
+from typing import Any, Iterator
+from uuid import uuid4
+
+from ..inmem_backend.memstate import FrozenState
+from .. import config
+from ..state_notifier import get_state_notifier
+from ..stateupdater import StateUpdater
+from .base import DEFAULT_MACHINE_ID, MachineId
+from .state_control import state_write_lock, async_state_write_lock
+
+# a row per machine with its current state, a row per write with what it changed and a
+# row per machine with a command in flight
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS machines (
+    machine_id TEXT PRIMARY KEY,
+    version INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS transitions (
+    machine_id TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    at REAL NOT NULL,
+    changes TEXT NOT NULL,
+    PRIMARY KEY (machine_id, version)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS commands (
+    machine_id TEXT PRIMARY KEY,
+    command TEXT NOT NULL,
+    token TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+"""
+
+# the state is only sent (and parsed) if it is not the version already read
+READ = """
+SELECT version, CASE WHEN version = ? THEN NULL ELSE state END
+FROM machines WHERE machine_id = ?
+"""
+
+# how often an async writer tries again for the database held by another writer
+LOCK_RETRY_INTERVAL = 0.005
+
+_MISSING = object()
+
+
+def connect(path: Path, busy_timeout: float) -> sqlite3.Connection:
+    # transactions are begun and ended explicitly; in WAL mode readers never wait for a
+    # writer, and commits are synced with the checkpoints rather than one by one (so a
+    # power cut may lose the last ones but never corrupts the database)
+    connection = sqlite3.connect(
+        path, timeout=busy_timeout, isolation_level=None, check_same_thread=False
+    )
+    connection.execute("PRAGMA journal_mode = WAL")
+    connection.execute("PRAGMA synchronous = NORMAL")
+    return connection
+
+
+class SqliteStateUpdater(StateUpdater):
+    # keeps the states of the machines in a sqlite database, which every process on the
+    # node can share: a write takes the write lock of the database (BEGIN IMMEDIATE) for
+    # as long as update_state is held, so writes of other processes are never lost, and
+    # records what it changed as a transition. Reads take no lock and parse the state
+    # only when it changed. A command in flight is marked in the commands table, see
+    # begin_command.
+
+    def __init__(
+        self,
+        machine_id: MachineId = DEFAULT_MACHINE_ID,
+        path: Path | str | None = None,
+        history_keep: int | None = None,
+    ) -> None:
+        super().__init__(machine_id)
+        self._path = Path(path or config.get_sqlite_path())
+        self._busy_timeout = config.get_sqlite_busy_timeout()
+        # transitions kept per machine, 0 keeps them all
+        self._keep = config.get_sqlite_history_keep() if history_keep is None else history_keep
+        self._notifier = get_state_notifier(machine_id)
+        # connections are used by one thread at a time and kept for reuse
+        self._pool: list[sqlite3.Connection] = []
+        self._pool_lock = Lock()
+        self._cached = FrozenState()
+        # the token of the command in flight of this updater
+        self._command_token: None | str = None
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connection() as connection:
+            connection.executescript(SCHEMA)
+
+    @property
+    def path(self) -> Path:
+        return self._path
+
+    def connect(self) -> sqlite3.Connection:
+        return connect(self._path, self._busy_timeout)
+
+    @contextmanager
+    def _connection(self) -> Iterator[sqlite3.Connection]:
+        with self._pool_lock:
+            connection = self._pool.pop() if self._pool else None
+        if connection is None:
+            connection = self.connect()
+        try:
+            yield connection
+        finally:
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+            with self._pool_lock:
+                self._pool.append(connection)
+
+    def _read(self, connection: sqlite3.Connection) -> FrozenState:
+        cached = self._cached
+        row = connection.execute(READ, (cached.version, self._machine_id)).fetchone()
+        if row is None:
+            return FrozenState()
+        version, state = row
+        if state is None:
+            return cached
+        snapshot = FrozenState(json.loads(state), version)
+        self._cached = snapshot
+        return snapshot
+
+    def _write(
+        self, connection: sqlite3.Connection, current: FrozenState, state: dict[str, Any]
+    ) -> FrozenState:
+        # called within a write transaction
+        changed = {
+            key: value for key, value in state.items() if current.get(key, _MISSING) != value
+        }
+        removed = [key for key in current if key not in state]
+        if not changed and not removed:
+            return current
+        changes: dict[str, Any] = {}
+        if changed:
+            changes["set"] = changed
+        if removed:
+            changes["del"] = removed
+        version = current.version + 1
+        at = time()
+        connection.execute(
+            "INSERT OR REPLACE INTO machines VALUES (?, ?, ?, ?)",
+            (self._machine_id, version, json.dumps(state), at),
+        )
+        connection.execute(
+            "INSERT INTO transitions VALUES (?, ?, ?, ?)",
+            (self._machine_id, version, at, json.dumps(changes)),
+        )
+        if self._keep > 0:
+            connection.execute(
+                "DELETE FROM transitions WHERE machine_id = ? AND version <= ?",
+                (self._machine_id, version - self._keep),
+            )
+        return FrozenState(state, version)
+
+    @contextmanager
+    def _transaction(self, connection: sqlite3.Connection):
+        # called after beginning the write transaction, which it ends
+        try:
+            current = self._read(connection)
+            state = dict(current)
+            yield state
+            with self._notifier.writing():
+                snapshot = self._write(connection, current, state)
+                connection.execute("COMMIT")
+                self._cached = snapshot
+                self._notifier.publish(snapshot)
+        finally:
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+
+    async def _async_begin(self, connection: sqlite3.Connection):
+        # does not wait for the database in sqlite, which would hold up the event loop
+        connection.execute("PRAGMA busy_timeout = 0")
+        try:
+            while True:
+                try:
+                    connection.execute("BEGIN IMMEDIATE")
+                    return
+                except sqlite3.OperationalError as exception:
+                    if "locked" not in str(exception):
+                        raise
+                await asyncio.sleep(LOCK_RETRY_INTERVAL)
+        finally:
+            connection.execute(f"PRAGMA busy_timeout = {int(self._busy_timeout * 1000)}")
+
+    def _begin_command(self, connection: sqlite3.Connection, command: str) -> bool:
+        # called after beginning the write transaction, which it ends
+        try:
+            row = connection.execute(
+                "SELECT 1 FROM commands WHERE machine_id = ? AND expires_at > ?",
+                (self._machine_id, time()),
+            ).fetchone()
+            if row is not None:
+                return False
+            token = uuid4().hex
+            connection.execute(
+                "INSERT OR REPLACE INTO commands VALUES (?, ?, ?, ?)",
+                (self._machine_id, command, token, time() + config.get_command_lease()),
+            )
+            connection.execute("COMMIT")
+            self._command_token = token
+            return True
+        finally:
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+
+    @property
+    def leases_commands(self) -> bool:
+        return True
+
+    def begin_command(self, command: str) -> bool:
+        with self._connection() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            return self._begin_command(connection, command)
+
+    async def async_begin_command(self, command: str) -> bool:
+        with self._connection() as connection:
+            await self._async_begin(connection)
+            return self._begin_command(connection, command)
+
+    def renew_command(self) -> bool:
+        now = time()
+        with self._connection() as connection:
+            cursor = connection.execute(
+                "UPDATE commands SET expires_at = ? "
+                "WHERE machine_id = ? AND token = ? AND expires_at > ?",
+                (now + config.get_command_lease(), self._machine_id, self._command_token, now),
+            )
+            return cursor.rowcount == 1
+
+    def _end_command(self, connection: sqlite3.Connection):
+        # called after beginning the write transaction, which it ends
+        connection.execute(
+            "DELETE FROM commands WHERE machine_id = ? AND token = ?",
+            (self._machine_id, self._command_token),
+        )
+        connection.execute("COMMIT")
+        self._command_token = None
+
+    def end_command(self):
+        with self._connection() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            self._end_command(connection)
+
+    async def async_end_command(self):
+        with self._connection() as connection:
+            await self._async_begin(connection)
+            self._end_command(connection)
+
+    def _abort_command(self, connection: sqlite3.Connection):
+        # called after beginning the write transaction, which it ends; a command of this
+        # updater is over too
+        connection.execute("DELETE FROM commands WHERE machine_id = ?", (self._machine_id,))
+        connection.execute("COMMIT")
+        self._command_token = None
+
+    def abort_command(self):
+        with self._connection() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            self._abort_command(connection)
+
+    async def async_abort_command(self):
+        with self._connection() as connection:
+            await self._async_begin(connection)
+            self._abort_command(connection)
+
+    def command_lost(self) -> bool:
+        # called whilst updating the state, when no other process can commit
+        if self._command_token is None:
+            return False
+        with self._connection() as connection:
+            row = connection.execute(
+                "SELECT 1 FROM commands WHERE machine_id = ? AND token = ? AND expires_at > ?",
+                (self._machine_id, self._command_token, time()),
+            ).fetchone()
+        return row is None
+
+    def command_in_flight(self) -> bool:
+        with self._connection() as connection:
+            row = connection.execute(
+                "SELECT 1 FROM commands WHERE machine_id = ? AND expires_at > ?",
+                (self._machine_id, time()),
+            ).fetchone()
+        return row is not None
+
+    @property
+    def version(self) -> int:
+        return self.get_state().version
+
+    def history(self) -> Iterator[dict[str, Any]]:
+        # the transitions kept, oldest first
+        with self._connection() as connection:
+            rows = connection.execute(
+                "SELECT version, at, changes FROM transitions WHERE machine_id = ? "
+                "ORDER BY version",
+                (self._machine_id,),
+            ).fetchall()
+        for version, at, changes in rows:
+            yield {"version": version, "at": at, **json.loads(changes)}
+
+    def publish_changes(self) -> bool:
+        # publishes the state if another process changed it, see SqliteStateServer
+        return self._notifier.publish_if_changed(self.get_state)
+
+    def get_state(self) -> FrozenState:
+        with self._connection() as connection:
+            return self._read(connection)
+
+    def reset_state(self) -> None:
+        with self.update_state() as state:
+            state.clear()
+
+    @contextmanager
+    def update_state(self):
+        with state_write_lock(self._machine_id), self._connection() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            with self._transaction(connection) as state:
+                yield state
+
+    @asynccontextmanager
+    async def async_update_state(self):
+        async with async_state_write_lock(self._machine_id):
+            with self._connection() as connection:
+                await self._async_begin(connection)
+                with self._transaction(connection) as state:
+                    yield state
+
+    @contextmanager
+    def atomic(self):
+        # the changes in between are seen by others as they are made, so a failure is
+        # rolled back by a transaction of its own that restores the state from before
+        original_state = self.get_state()
+        try:
+            yield
+        except Exception as exception:
+            with self.update_state() as state:
+                state.clear()
+                state.update(original_state)
+            raise exception
+
+    @asynccontextmanager
+    async def async_atomic(self):
+        original_state = self.get_state()
+        try:
+            yield
+        except Exception as exception:
+            async with self.async_update_state() as state:
+                state.clear()
+                state.update(original_state)
+            raise exception
@@ -0,0 +1,9 @@
+from ..state_control import (
+    state_write_lock,
+    async_state_write_lock,
+)
+
+__all__ = [
+    "state_write_lock",
+    "async_state_write_lock",
+]
@@ -1,41 +1,73 @@
-from queue import Queue
 import asyncio
 from contextlib import asynccontextmanager, contextmanager
 from threading import Lock
-from typing import Any, Literal
+from typing import Any, Callable, TypeVar
 
+from .base import DEFAULT_MACHINE_ID, MachineId
+from .event_hub import DEFAULT_MAXSIZE, DEFAULT_POLICY, EventHub, Policy, Subscription
 
-Signal = Literal["STOP", "STATE_CHANGED"]
 
-_state_control_signals = Queue[tuple[Signal, Any]]()
+T = TypeVar("T")
 
-_state_write_lock = Lock()
-_async_state_write_lock = asyncio.Lock()
+# every machine gets its own event hub and write locks, created lazily on first use;
+# lookups are plain dict reads so only the (rare) creation takes _registry_lock
+_registry_lock = Lock()
 
+_event_hubs: dict[MachineId, EventHub[Any]] = {}
 
-def cntrl_set_state_changed(state: Any):
-    _state_control_signals.put_nowait(("STATE_CHANGED", state))
+_state_write_locks: dict[MachineId, Lock] = {}
+_async_state_write_locks: dict[MachineId, asyncio.Lock] = {}
 
 
-def cntrl_set_server_stop():
-    _state_control_signals.put_nowait(("STOP", None))
+def _get_or_create(
+    registry: dict[MachineId, T], machine_id: MachineId, factory: Callable[[], T]
+) -> T:
+    try:
+        return registry[machine_id]
+    except KeyError:
+        with _registry_lock:
+            if machine_id not in registry:
+                registry[machine_id] = factory()
+            return registry[machine_id]
 
 
-def state_is_locked():
-    return _async_state_write_lock.locked() or _state_write_lock.locked()
+def get_event_hub(machine_id: MachineId = DEFAULT_MACHINE_ID) -> EventHub[Any]:
+    return _get_or_create(_event_hubs, machine_id, EventHub)
+
+
+def _get_state_write_lock(machine_id: MachineId) -> Lock:
+    return _get_or_create(_state_write_locks, machine_id, Lock)
+
+
+def _get_async_state_write_lock(machine_id: MachineId) -> asyncio.Lock:
+    return _get_or_create(_async_state_write_locks, machine_id, asyncio.Lock)
+
+
+def cntrl_set_state_changed(state: Any, machine_id: MachineId = DEFAULT_MACHINE_ID):
+    get_event_hub(machine_id).publish(state)
+
+
+def state_is_locked(machine_id: MachineId = DEFAULT_MACHINE_ID):
+    async_lock = _get_async_state_write_lock(machine_id)
+    return async_lock.locked() or _get_state_write_lock(machine_id).locked()
 
 
 @contextmanager
-def state_write_lock():
-    with _state_write_lock:
+def state_write_lock(machine_id: MachineId = DEFAULT_MACHINE_ID):
+    with _get_state_write_lock(machine_id):
         yield
 
 
 @asynccontextmanager
-async def async_state_write_lock():
-    async with _async_state_write_lock:
+async def async_state_write_lock(machine_id: MachineId = DEFAULT_MACHINE_ID):
+    async with _get_async_state_write_lock(machine_id):
         yield
 
 
-def get_state_control_signals():
-    return _state_control_signals.get()
+def subscribe_state_changes(
+    machine_id: MachineId = DEFAULT_MACHINE_ID,
+    maxsize: int = DEFAULT_MAXSIZE,
+    policy: Policy = DEFAULT_POLICY,
+) -> Subscription[Any]:
+    # every subscription receives every state change published after it was made
+    return get_event_hub(machine_id).subscribe(maxsize, policy)
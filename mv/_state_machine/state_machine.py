@@ -1,10 +1,23 @@
-import asyncio
-from contextlib import contextmanager
-from time import sleep
+from contextlib import asynccontextmanager, contextmanager
 from typing import Any, Callable, ParamSpec, TypeVar, Concatenate
 
-from .base import AbstractPublisher, State, ObsState
+from .base import (
+    AbstractPublisher,
+    Attribute,
+    CombinedState,
+    State,
+    ObsState,
+    DEFAULT_MACHINE_ID,
+    MachineId,
+)
+from .event_hub import DEFAULT_MAXSIZE, DEFAULT_POLICY, Policy
 from .factory import get_state_updater, get_state_server
+from .lease_keeper import get_lease_keeper
+from .redis_backend.lease import LeaseLost
+from .redis_backend.redis_stateupdater import StateConflict
+from .registry import StateMachineRegistry
+from .scheduler import CommandCancelled, CommandInFlight, ScheduledCommand, get_scheduler
+from .transitions import Phase, TransitionTable, Verdict, guarded
 
 P = ParamSpec("P")
 T = TypeVar("T")
@@ -14,97 +27,18 @@ class StateMachineBusyError(Exception):
     pass
 
 
-def wraps(func: Any, wrapper: Any):
-    def __get_inner_name():
-        if hasattr(func, "__get_inner_name"):
-            return func.__get_inner_name()
-        return func.__name__
-
-    wrapper.__get_inner_name = __get_inner_name
-
-
 def get_name(func: Any):
     if hasattr(func, "__get_inner_name"):
         return func.__get_inner_name()
     return func.__name__
 
 
-def check_busy(method: Callable[P, T]) -> Callable[P, T]:
-
-    def wrapper(*args: P.args, **kwds: P.kwargs) -> T:
-        updater = get_state_updater()
-        if updater.state_machine_is_busy():
-            method_name = get_name(method)
-            raise StateMachineBusyError(
-                f"{method_name} not allowed when state machine is busy"
-            )
-        return method(*args, **kwds)
-
-    wraps(method, wrapper)
-
-    return wrapper
-
-
 class CommandNotAllowed(Exception):
     pass
 
 
-def is_allowed(method: Callable[Concatenate["StateMachine", P], T]) -> Callable[P, T]:
-
-    def wrapper(self: "StateMachine", *args: P.args, **kwds: P.kwargs) -> T:
-        method_name = get_name(method)
-        if method_name in self.allowed_commands:
-            return method(self, *args, **kwds)
-        raise CommandNotAllowed(
-            f"{method_name} not allowed when obs_state is {self.obs_state}"
-        )
-
-    wraps(method, wrapper)
-
-    return wrapper
-
-
-def ignore_if_in_state(state: State):
-    def inner(method: Callable[Concatenate["StateMachine", P], T]) -> Callable[P, T]:
-
-        def wrapper(self: "StateMachine", *args: P.args, **kwds: P.kwargs) -> T:
-            if self.state == state:
-                return
-            return method(self, *args, **kwds)
-
-        wraps(method, wrapper)
-
-        return wrapper
-
-    return inner
-
-
-def ignore_if_in_obs_state(obs_state: ObsState):
-    def inner(method: Callable[Concatenate["StateMachine", P], T]) -> Callable[P, T]:
-
-        def wrapper(self: "StateMachine", *args: P.args, **kwds: P.kwargs) -> T:
-            if self.obs_state == obs_state:
-                return
-            return method(self, *args, **kwds)
-
-        wraps(method, wrapper)
-
-        return wrapper
-
-    return inner
-
-
-def must_be_on(method: Callable[Concatenate["StateMachine", P], T]) -> Callable[P, T]:
-
-    def wrapper(self: "StateMachine", *args: P.args, **kwds: P.kwargs) -> T:
-        if self.state == "ON":
-            return method(self, *args, **kwds)
-        method_name = get_name(method)
-        raise CommandNotAllowed(f"{method_name} not allowed when state is {self.state}")
-
-    wraps(method, wrapper)
-
-    return wrapper
+def _config_delay(config: dict[str, Any] | None) -> float | None:
+    return config.get("delay") if config else None
 
 
 class StateMachine:
@@ -121,12 +55,37 @@ class StateMachine:
         "CONFIGURING": ["abort"],
         "READY": ["scan", "clear_config", "configure"],
         "SCANNING": ["abort"],
+        "BUSY": ["abort"],
+        "ABORTED": [],
     }
 
-    def __init__(self) -> None:
-        self._state: None | State = None
-        self._obs_state: None | ObsState = None
-        self._updater = get_state_updater()
+    _ignore_if_in: dict[str, tuple[Attribute, State | ObsState]] = {
+        "switch_on": ("state", "ON"),
+        "switch_off": ("state", "OFF"),
+        "assign_resources": ("obs_state", "IDLE"),
+        "release_resources": ("obs_state", "EMPTY"),
+        "clear_config": ("obs_state", "IDLE"),
+        "scan": ("obs_state", "SCANNING"),
+    }
+
+    _must_be_on = [
+        "assign_resources",
+        "release_resources",
+        "configure",
+        "clear_config",
+        "scan",
+        "abort",
+    ]
+
+    _transitions = TransitionTable(_allowed_commands, _ignore_if_in, _must_be_on)
+
+    def __init__(self, machine_id: MachineId = DEFAULT_MACHINE_ID) -> None:
+        self._machine_id = machine_id
+        self._updater = get_state_updater(machine_id)
+
+    @property
+    def machine_id(self) -> MachineId:
+        return self._machine_id
 
     def reset_state(self):
         self._updater.reset_state()
@@ -138,131 +97,242 @@ class StateMachine:
     def allowed_commands(self) -> list[str]:
         return self._allowed_commands.get(self.obs_state)
 
+    def _is_busy(self) -> bool:
+        # a command in flight in this process, or in another sharing the backend
+        return get_scheduler().is_busy(self._machine_id) or self._updater.state_machine_is_busy()
+
+    def _judge(self, command: str, state: CombinedState, busy: Callable[[], bool]) -> Verdict:
+        verdict = self._transitions.check(command, state)
+        if verdict == "IGNORE":
+            return verdict
+        if verdict == "NOT_ON":
+            raise CommandNotAllowed(
+                f"{command} not allowed when state is {state.get('state')}"
+            )
+        if busy():
+            raise StateMachineBusyError(
+                f"{command} not allowed when state machine is busy"
+            )
+        if verdict == "NOT_ALLOWED":
+            raise CommandNotAllowed(
+                f"{command} not allowed when obs_state is {state.get('obs_state')}"
+            )
+        return verdict
+
+    def _check_transition(
+        self, command: str, check_busy: bool = True
+    ) -> tuple[Verdict, CombinedState]:
+        state = self._updater.get_state()
+        busy = self._is_busy if check_busy else lambda: False
+        return self._judge(command, state, busy), state
+
     @contextmanager
-    def _update(self, delay: float | None = None):
+    def _update(self):
         with self._updater.update_state() as state:
-            if delay:
-                sleep(delay)
-            self._state = state.get("state") if state else None
-            self._obs_state = state.get("obs_state") if state else None
-            yield
-            state["state"] = self._state
-            state["obs_state"] = self._obs_state
+            yield state
+            state.setdefault("state", None)
+            state.setdefault("obs_state", None)
+
+    def _apply(self, phase: Phase):
+        try:
+            with self._update() as state:
+                if phase.is_preempted(state):
+                    raise CommandCancelled(f"phase {phase.changes} preempted by {state}")
+                if self._updater.command_lost():
+                    raise CommandCancelled(f"phase {phase.changes} of an aborted command")
+                state.update(phase.changes)
+        except LeaseLost as exception:
+            # the write was fenced out, the command was aborted by another replica
+            raise CommandCancelled(f"phase {phase.changes} of an aborted command") from exception
+        except StateConflict as exception:
+            # another replica wrote the state between the read and the write of the phase,
+            # which gives way if that was e.g. an abort
+            if phase.is_preempted(current := self._updater.get_state()):
+                raise CommandCancelled(
+                    f"phase {phase.changes} preempted by {current}"
+                ) from exception
+            raise
+
+    def _restore(self, original_state: CombinedState, scheduled: ScheduledCommand):
+        # rolls a failed command back to the state from before it, unless it wrote nothing
+        # yet or somebody else (e.g. an abort) wrote the state since its last phase
+        failed = scheduled.next_phase
+        if scheduled.phase_index == 0 or failed is None:
+            return
+        try:
+            with self._updater.update_state() as state:
+                if failed.is_preempted(state):
+                    raise CommandCancelled(f"rollback of {scheduled.command} preempted by {state}")
+                state.clear()
+                state.update(original_state)
+        except CommandCancelled:
+            pass
+
+    def _claim(self, command: str):
+        # marks the command in flight in the backend, where other processes see it, which
+        # only one of several processes starting a command at the same time manages to
+        if not self._updater.begin_command(command):
+            raise StateMachineBusyError(f"{command} not allowed whilst a command is in flight")
+        get_lease_keeper().hold(self._updater, self.cancel_pending_command)
+
+    def _release(self):
+        get_lease_keeper().drop(self._updater)
+        self._updater.end_command()
+
+    def _register(self, command: str, phases: list[Phase]) -> ScheduledCommand:
+        try:
+            return get_scheduler().register(self._machine_id, command, phases)
+        except CommandInFlight as exception:
+            raise StateMachineBusyError(*exception.args) from exception
+
+    def submit(self, command: str, *args: Any) -> ScheduledCommand | None:
+        # starts the command without waiting for it: the delayed phases are applied by
+        # the scheduler, the returned handle can be used to inspect, wait or cancel it
+        verdict, original_state = self._check_transition(command)
+        if verdict == "IGNORE":
+            return None
+        phases = guarded(getattr(self, f"_{command}_phases")(*args))
+        self._claim(command)
+        try:
+            return get_scheduler().submit(
+                self._machine_id,
+                command,
+                phases,
+                self._apply,
+                lambda scheduled, _: self._restore(original_state, scheduled),
+                self._release,
+            )
+        except CommandInFlight as exception:
+            self._release()
+            raise StateMachineBusyError(*exception.args) from exception
+
+    def _run(self, command: str, *args: Any):
+        if scheduled := self.submit(command, *args):
+            scheduled.wait()
+
+    @property
+    def pending_command(self) -> ScheduledCommand | None:
+        if in_flight := get_scheduler().in_flight(self._machine_id):
+            return in_flight[0]
+        return None
+
+    def cancel_pending_command(self) -> bool:
+        return get_scheduler().cancel_machine(self._machine_id) is not None
+
+    def _switch_on_phases(self, delay: float | None = None) -> list[Phase]:
+        return [
+            Phase(None, {"state": "BUSY"}),
+            Phase(delay, {"state": "ON", "obs_state": "EMPTY"}),
+        ]
+
+    def _assign_resources_phases(
+        self, delay: float | None = None, config: dict[str, Any] = None
+    ) -> list[Phase]:
+        return [
+            Phase(None, {"obs_state": "BUSY"}),
+            Phase(delay, {"obs_state": "RESOURCING"}),
+            Phase(_config_delay(config), {"obs_state": "IDLE"}),
+        ]
+
+    def _release_resources_phases(
+        self, delay: float | None = None, config: dict[str, Any] = None
+    ) -> list[Phase]:
+        return [
+            Phase(None, {"obs_state": "BUSY"}),
+            Phase(delay, {"obs_state": "RESOURCING"}),
+            Phase(_config_delay(config), {"obs_state": "EMPTY"}),
+        ]
+
+    def _configure_phases(
+        self, delay: float | None = None, config: dict[str, Any] = None
+    ) -> list[Phase]:
+        return [
+            Phase(None, {"obs_state": "BUSY"}),
+            Phase(delay, {"obs_state": "CONFIGURING"}),
+            Phase(_config_delay(config), {"obs_state": "READY"}),
+        ]
+
+    def _clear_config_phases(self, delay: float | None = None) -> list[Phase]:
+        return [
+            Phase(None, {"obs_state": "BUSY"}),
+            Phase(delay, {"obs_state": "IDLE"}),
+        ]
+
+    def _scan_phases(
+        self, delay: float | None = None, config: dict[str, Any] = None
+    ) -> list[Phase]:
+        return [
+            Phase(None, {"obs_state": "BUSY"}),
+            Phase(delay, {"obs_state": "SCANNING"}),
+            Phase(_config_delay(config), {"obs_state": "READY"}),
+        ]
+
+    def _switch_off_phases(self, delay: float | None = None) -> list[Phase]:
+        return [
+            Phase(None, {"state": "BUSY"}),
+            Phase(delay, {"state": "OFF", "obs_state": None}),
+        ]
+
+    def _abort_phases(self) -> list[Phase]:
+        return [
+            Phase(None, {"obs_state": "ABORTED"}),
+            Phase(None, {"obs_state": "IDLE"}),
+        ]
 
-    @ignore_if_in_state("ON")
-    @check_busy
-    @is_allowed
     def switch_on(self, delay: float | None = None):
-        with self._updater.atomic():
-            with self._update():
-                self._state = "BUSY"
-            with self._update(delay):
-                self._state = "ON"
-                self._obs_state = "EMPTY"
+        self._run("switch_on", delay)
 
     def abort(self):
-        raise NotImplementedError()
+        # abort does not wait for the command in flight: its pending phase is cancelled,
+        # its mark in the backend removed (a command of another process then finds it
+        # lost and drops its phases) and the machine moves through ABORTED to IDLE
+        # straight away
+        self._check_transition("abort", check_busy=False)
+        get_scheduler().cancel_machine(self._machine_id)
+        self._updater.abort_command()
+        for phase in self._abort_phases():
+            self._apply(phase)
 
-    @ignore_if_in_obs_state("IDLE")
-    @must_be_on
-    @check_busy
-    @is_allowed
     def assign_resources(
         self, delay: float | None = None, config: dict[str, Any] = None
     ):
-        with self._updater.atomic():
-            with self._update():
-                self._obs_state = "BUSY"
-            with self._update(delay):
-                self._obs_state = "RESOURCING"
-            resourcing_delay = config.get("delay") if config else None
-            with self._update(resourcing_delay):
-                self._obs_state = "IDLE"
-
-    @ignore_if_in_obs_state("EMPTY")
-    @must_be_on
-    @check_busy
-    @is_allowed
+        self._run("assign_resources", delay, config)
+
     def release_resources(
         self, delay: float | None = None, config: dict[str, Any] = None
     ):
-        with self._updater.atomic():
-            with self._update():
-                self._obs_state = "BUSY"
-            with self._update(delay):
-                self._obs_state = "RESOURCING"
-            resourcing_delay = config.get("delay") if config else None
-            with self._update(resourcing_delay):
-                self._obs_state = "EMPTY"
-
-    @must_be_on
-    @check_busy
-    @is_allowed
+        self._run("release_resources", delay, config)
+
     def configure(self, delay: float | None = None, config: dict[str, Any] = None):
-        with self._updater.atomic():
-            with self._update():
-                self._obs_state = "BUSY"
-            with self._update(delay):
-                self._obs_state = "CONFIGURING"
-            confguringing_delay = config.get("delay") if config else None
-            with self._update(confguringing_delay):
-                self._obs_state = "READY"
-
-    @ignore_if_in_obs_state("IDLE")
-    @must_be_on
-    @check_busy
-    @is_allowed
+        self._run("configure", delay, config)
+
     def clear_config(self, delay: float | None = None):
-        with self._updater.atomic():
-            with self._update():
-                self._obs_state = "BUSY"
-            with self._update(delay):
-                self._obs_state = "IDLE"
-
-    @ignore_if_in_obs_state("SCANNING")
-    @must_be_on
-    @check_busy
-    @is_allowed
+        self._run("clear_config", delay)
+
     def scan(self, delay: float | None = None, config: dict[str, Any] = None):
-        with self._updater.atomic():
-            with self._update():
-                self._obs_state = "BUSY"
-            with self._update(delay):
-                self._obs_state = "SCANNING"
-            resourcing_delay = config.get("delay") if config else None
-            with self._update(resourcing_delay):
-                self._obs_state = "READY"
-
-    @ignore_if_in_state("OFF")
-    @check_busy
-    @is_allowed
+        self._run("scan", delay, config)
+
     def switch_off(self, delay: float | None = None):
-        with self._updater.atomic():
-            with self._update():
-                self._state = "BUSY"
-            with self._update(delay):
-                self._state = "OFF"
-                self._obs_state = None
+        self._run("switch_off", delay)
 
     @property
     def state(self):
-        state = self._updater.get_state()
-        return state.get("state")
+        return self._updater.get_attribute("state")
 
     @property
     def obs_state(self):
-        state = self._updater.get_state()
-        return state.get("obs_state")
+        return self._updater.get_attribute("obs_state")
 
     @property
     def busy(self):
+        state = self._updater.get_state()
         return (
-            self._updater.state_machine_is_busy() or
-            self.state == "BUSY" or self._obs_state == "BUSY"
+            self._is_busy() or
+            state.get("state") == "BUSY" or state.get("obs_state") == "BUSY"
         )
 
     def assert_ready(self):
-        if self._updater.state_machine_is_busy():
+        if self._is_busy():
             raise StateMachineBusyError("machine is busy and can not be commanded")
 
     def assert_method_allowed(self, method: Callable[Concatenate["StateMachine", P], T]):
@@ -275,70 +345,168 @@ class StateMachine:
 
 
 class AsyncStateMachine(StateMachine):
+    # the async commands run as coroutines on the event loop: delays are awaited on the
+    # scheduler's timers rather than slept on a worker thread and state is written
+    # through the async updaters
+
+    async def _async_is_busy(self) -> bool:
+        if get_scheduler().is_busy(self._machine_id):
+            return True
+        return await self._updater.async_state_machine_is_busy()
+
+    async def _async_check_transition(
+        self, command: str, check_busy: bool = True
+    ) -> tuple[Verdict, CombinedState]:
+        # as _check_transition but without blocking the loop on the reads
+        state = await self._updater.async_get_state()
+        busy = await self._async_is_busy() if check_busy else False
+        return self._judge(command, state, lambda: busy), state
+
+    async def async_get_state(self) -> CombinedState:
+        return await self._updater.async_get_state()
+
+    async def async_get_attribute(self, attribute: Attribute):
+        return await self._updater.async_get_attribute(attribute)
+
+    @asynccontextmanager
+    async def _async_update(self):
+        async with self._updater.async_update_state() as state:
+            yield state
+            state.setdefault("state", None)
+            state.setdefault("obs_state", None)
+
+    @asynccontextmanager
+    async def _async_claimed(self, scheduled: ScheduledCommand):
+        if not await self._updater.async_begin_command(scheduled.command):
+            raise StateMachineBusyError(
+                f"{scheduled.command} not allowed whilst a command is in flight"
+            )
+        get_lease_keeper().hold(self._updater, scheduled.cancel)
+        try:
+            yield
+        finally:
+            get_lease_keeper().drop(self._updater)
+            await self._updater.async_end_command()
+
+    async def _async_run(self, command: str, phases: list[Phase]):
+        verdict, _ = await self._async_check_transition(command)
+        if verdict == "IGNORE":
+            return
+        phases = guarded(phases)
+        scheduled = self._register(command, phases)
+        try:
+            async with self._async_claimed(scheduled), self._updater.async_atomic():
+                try:
+                    for phase in phases:
+                        if phase.delay:
+                            await scheduled.async_sleep(phase.delay)
+                        if scheduled.cancelled:
+                            return
+                        try:
+                            async with self._async_update() as state:
+                                if phase.is_preempted(state):
+                                    raise CommandCancelled(f"{command} preempted by {state}")
+                                if self._updater.command_lost():
+                                    raise CommandCancelled(f"{command} was aborted")
+                                state.update(phase.changes)
+                        except StateConflict as exception:
+                            # as in _apply
+                            current = await self._updater.async_get_state()
+                            if phase.is_preempted(current):
+                                raise CommandCancelled(
+                                    f"{command} preempted by {current}"
+                                ) from exception
+                            raise
+                        scheduled.phase_index += 1
+                except (CommandCancelled, LeaseLost):
+                    # phases applied before the command got cancelled (or aborted by
+                    # another replica) are kept
+                    return
+        finally:
+            get_scheduler().finish(scheduled)
+
+    async def async_abort(self):
+        await self._async_check_transition("abort", check_busy=False)
+        get_scheduler().cancel_machine(self._machine_id)
+        await self._updater.async_abort_command()
+        for phase in self._abort_phases():
+            async with self._async_update() as state:
+                state.update(phase.changes)
 
     async def async_switch_off(self, delay: float | None = None):
-        await asyncio.to_thread(self.switch_off, delay)
+        await self._async_run("switch_off", self._switch_off_phases(delay))
 
     async def async_switch_on(self, delay: float | None = None):
-        await asyncio.to_thread(self.switch_on, delay)
+        await self._async_run("switch_on", self._switch_on_phases(delay))
 
     async def async_scan(
         self, delay: float | None = None, config: dict[str, Any] = None
     ):
-        await asyncio.to_thread(self.scan, delay, config)
+        await self._async_run("scan", self._scan_phases(delay, config))
 
     async def async_clear_config(self, delay: float | None = None):
-        await asyncio.to_thread(self.clear_config, delay)
+        await self._async_run("clear_config", self._clear_config_phases(delay))
 
     async def async_configure(
         self, delay: float | None = None, config: dict[str, Any] = None
     ):
-        await asyncio.to_thread(self.configure, delay, config)
+        await self._async_run("configure", self._configure_phases(delay, config))
 
     async def async_release_resources(
         self, delay: float | None = None, config: dict[str, Any] = None
     ):
-        await asyncio.to_thread(self.release_resources, delay, config)
+        await self._async_run(
+            "release_resources", self._release_resources_phases(delay, config)
+        )
 
     async def async_assign_resources(
         self, delay: float | None = None, config: dict[str, Any] = None
     ):
-        await asyncio.to_thread(self.assign_resources, delay, config)
+        await self._async_run(
+            "assign_resources", self._assign_resources_phases(delay, config)
+        )
+
+
+_state_machines = StateMachineRegistry(StateMachine)
+
+_async_state_machines = StateMachineRegistry(AsyncStateMachine)
+
 
+def get_state_machine_registry():
+    return _state_machines
 
-_state_machine: None | StateMachine = None
 
-_async_state_machine: None | AsyncStateMachine = None
+def get_async_state_machine_registry():
+    return _async_state_machines
 
 
-def get_state_machine():
-    global _state_machine
-    if _state_machine is None:
-        _state_machine = StateMachine()
-    return _state_machine
+def get_state_machine(machine_id: MachineId = DEFAULT_MACHINE_ID):
+    return _state_machines.get(machine_id)
 
 
-def get_async_state_machine():
-    global _async_state_machine
-    if _async_state_machine is None:
-        _async_state_machine = AsyncStateMachine()
-    return _async_state_machine
+def get_async_state_machine(machine_id: MachineId = DEFAULT_MACHINE_ID):
+    return _async_state_machines.get(machine_id)
 
 
-def reset_state_machine():
-    global _state_machine
-    _state_machine = StateMachine()
-    _state_machine.reset_state()
+def reset_state_machine(machine_id: MachineId = DEFAULT_MACHINE_ID):
+    get_scheduler().cancel_machine(machine_id)
+    state_machine = _state_machines.replace(machine_id)
+    state_machine.reset_state()
 
 
-def reset_async_state_machine():
-    global _async_state_machine
-    _async_state_machine = None
+def reset_async_state_machine(machine_id: MachineId = DEFAULT_MACHINE_ID):
+    get_scheduler().cancel_machine(machine_id)
+    _async_state_machines.remove(machine_id)
 
 
 @contextmanager
-def state_server(publisher: AbstractPublisher):
-    server = get_state_server(publisher)
+def state_server(
+    publisher: AbstractPublisher,
+    machine_id: MachineId = DEFAULT_MACHINE_ID,
+    policy: Policy = DEFAULT_POLICY,
+    maxsize: int = DEFAULT_MAXSIZE,
+):
+    server = get_state_server(publisher, machine_id, policy, maxsize)
     server.start_server()
     yield
     server.stop_server()
@@ -0,0 +1,78 @@
+from contextlib import contextmanager
+from threading import Lock
+from typing import Any, Callable
+
+from .base import DEFAULT_MACHINE_ID, MachineId
+from .state_control import cntrl_set_state_changed
+
+_UNSET = object()
+
+
+class StateNotifier:
+    # publishes every state of a machine once in this process, whether the process wrote
+    # it (and publishes it as part of the write) or a watcher found it was written by
+    # another process sharing the store. One per machine, shared by all its updaters in
+    # the process.
+
+    def __init__(self, machine_id: MachineId = DEFAULT_MACHINE_ID) -> None:
+        self._machine_id = machine_id
+        self._lock = Lock()
+        self._writing = 0
+        # counts the writes of this process, a check that saw a write go by gives way to it
+        self._generation = 0
+        self._published: Any = _UNSET
+
+    @contextmanager
+    def writing(self):
+        # around a write of this process, from before the new state can be read
+        with self._lock:
+            self._writing += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._writing -= 1
+                self._generation += 1
+
+    def publish(self, state: Any):
+        with self._lock:
+            self._published = state
+            cntrl_set_state_changed(state, self._machine_id)
+
+    def seen(self, state: Any):
+        # a state written without being published, so a watcher does not publish it either
+        with self._lock:
+            self._published = state
+
+    def publish_if_changed(self, read: Callable[[], Any]) -> bool:
+        # publishes the state read if it is not the one published last; the first look only
+        # takes note of the state. A write of this process in the meantime publishes a state
+        # that includes any changes found, writes of others after it wake the watcher again.
+        with self._lock:
+            if self._writing:
+                return False
+            generation = self._generation
+        state = read()
+        with self._lock:
+            if self._writing or self._generation != generation:
+                return False
+            if self._published is _UNSET:
+                self._published = state
+                return False
+            if state == self._published:
+                return False
+            self._published = state
+            cntrl_set_state_changed(state, self._machine_id)
+            return True
+
+
+_notifiers_lock = Lock()
+_notifiers: dict[MachineId, StateNotifier] = {}
+
+
+def get_state_notifier(machine_id: MachineId = DEFAULT_MACHINE_ID) -> StateNotifier:
+    try:
+        return _notifiers[machine_id]
+    except KeyError:
+        with _notifiers_lock:
+            return _notifiers.setdefault(machine_id, StateNotifier(machine_id))
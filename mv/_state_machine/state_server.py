@@ -1,34 +1,50 @@
-from threading import Event, Thread
-from .base import AbstractPublisher, AbstractStateServer, AbstractStateUpdater
-from .state_control import get_state_control_signals, cntrl_set_server_stop
+from threading import Thread
+from typing import Any
+from .base import (
+    AbstractPublisher,
+    AbstractStateServer,
+    AbstractStateUpdater,
+    DEFAULT_MACHINE_ID,
+    MachineId,
+)
+from .event_hub import DEFAULT_MAXSIZE, DEFAULT_POLICY, Policy, Subscription
+from .state_control import subscribe_state_changes
 
 
 class StateServer(AbstractStateServer):
 
     def __init__(
-        self, publisher: AbstractPublisher, state_updater: AbstractStateUpdater
+        self,
+        publisher: AbstractPublisher,
+        state_updater: AbstractStateUpdater,
+        machine_id: MachineId = DEFAULT_MACHINE_ID,
+        policy: Policy = DEFAULT_POLICY,
+        maxsize: int = DEFAULT_MAXSIZE,
     ):
         self._publisher = publisher
-        self._started_flag = Event()
         self._server_thread: None | Thread = None
+        self._subscription: None | Subscription[Any] = None
         self._updater = state_updater
+        self._machine_id = machine_id
+        self._policy: Policy = policy
+        self._maxsize = maxsize
 
-    def _server(self):
-        while True:
-            self._started_flag.set()
-            signal, state = get_state_control_signals()
-            if signal == "STATE_CHANGED":
-                self._publisher.publish(state)
-            else:
-                self._started_flag.clear()
-                return
+    def _server(self, subscription: Subscription[Any]):
+        for state in subscription:
+            self._publisher.publish(state)
 
     def start_server(self):
-        self._server_thread = Thread(target=self._server, daemon=True)
+        # subscribing before the thread starts means no change is missed once started
+        self._subscription = subscribe_state_changes(
+            self._machine_id, self._maxsize, self._policy
+        )
+        self._server_thread = Thread(
+            target=self._server, args=(self._subscription,), daemon=True
+        )
         self._server_thread.start()
-        self._started_flag.wait()
 
     def stop_server(self):
-        cntrl_set_server_stop()
+        if self._subscription is not None:
+            self._subscription.close()
         if self._server_thread:
             self._server_thread.join(1)
@@ -2,14 +2,23 @@ from .base import (
     State,
     CombinedState,
     AbstractStateUpdater,
+    DEFAULT_MACHINE_ID,
+    MachineId,
 )
 
 from .state_control import state_is_locked
 
-__all__ = ["State", "StateUpdater", "CombinedState"]
+__all__ = ["State", "StateUpdater", "CombinedState", "DEFAULT_MACHINE_ID", "MachineId"]
 
 
 class StateUpdater(AbstractStateUpdater):
 
+    def __init__(self, machine_id: MachineId = DEFAULT_MACHINE_ID) -> None:
+        self._machine_id = machine_id
+
+    @property
+    def machine_id(self) -> MachineId:
+        return self._machine_id
+
     def state_machine_is_busy(self) -> bool:
-        return state_is_locked()
+        return state_is_locked(self._machine_id) or self.command_in_flight()
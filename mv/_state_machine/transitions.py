@@ -0,0 +1,80 @@
+from itertools import product
+from typing import Iterable, Literal, Mapping, NamedTuple, Sequence, get_args
+
+from .base import Attribute, CombinedState, ObsState, State
+
+Verdict = Literal["RUN", "IGNORE", "NOT_ON", "NOT_ALLOWED"]
+
+StateKey = tuple[str, State | None, ObsState | None]
+
+
+class Phase(NamedTuple):
+    # a command is a sequence of phases, each waiting for its delay before applying
+    # its changes to the state
+    delay: float | None
+    changes: dict[Attribute, State | ObsState | None]
+    expect: dict[Attribute, State | ObsState | None] | None = None
+
+    def is_preempted(self, state: CombinedState) -> bool:
+        if self.expect is None:
+            return False
+        return any(state.get(key) != value for key, value in self.expect.items())
+
+
+def guarded(phases: Sequence[Phase]) -> list[Phase]:
+    # each phase after the first expects to find the state the phase before it wrote, so
+    # a phase that got preempted in the meantime (e.g. by an abort, possibly issued from
+    # another process sharing the backend) is dropped instead of overwriting it
+    result: list[Phase] = []
+    for phase in phases:
+        if result:
+            phase = phase._replace(expect=result[-1].changes)
+        result.append(phase)
+    return result
+
+
+class TransitionTable:
+    # all the per command rules (ignore, must be on, allowed per obs_state) are folded
+    # into a single lookup keyed by (command, state, obs_state) when the table is built,
+    # so that checking a command costs one state read and one dict lookup
+
+    def __init__(
+        self,
+        allowed_commands: Mapping[ObsState | State | None, Iterable[str]],
+        ignore_if_in: Mapping[str, tuple[Attribute, State | ObsState]],
+        must_be_on: Iterable[str],
+    ) -> None:
+        self._allowed_commands = {
+            key: frozenset(commands) for key, commands in allowed_commands.items()
+        }
+        self._ignore_if_in = dict(ignore_if_in)
+        self._must_be_on = frozenset(must_be_on)
+        self._table: dict[StateKey, Verdict] = {}
+        commands = set(self._ignore_if_in) | self._must_be_on
+        for allowed in self._allowed_commands.values():
+            commands |= allowed
+        states = (None, *get_args(State))
+        obs_states = (None, *get_args(ObsState))
+        for key in product(commands, states, obs_states):
+            self._table[key] = self._evaluate(*key)
+
+    def _evaluate(
+        self, command: str, state: State | None, obs_state: ObsState | None
+    ) -> Verdict:
+        if ignore := self._ignore_if_in.get(command):
+            attribute, value = ignore
+            current = state if attribute == "state" else obs_state
+            if current == value:
+                return "IGNORE"
+        if command in self._must_be_on and state != "ON":
+            return "NOT_ON"
+        if command in self._allowed_commands.get(obs_state, ()):
+            return "RUN"
+        return "NOT_ALLOWED"
+
+    def check(self, command: str, state: CombinedState) -> Verdict:
+        key = (command, state.get("state"), state.get("obs_state"))
+        if (verdict := self._table.get(key)) is None:
+            # values outside of the State/ObsState literals are evaluated on the fly
+            verdict = self._evaluate(*key)
+        return verdict
@@ -1,5 +1,13 @@
-from ._server._fast_api_server.data_types import ConfigArgs, DelayArgs
-from ._state_machine.base import CombinedState, State, ObsState
+from ._server._fast_api_server.data_types import ConfigArgs, DelayArgs, SubscribeArgs
+from ._state_machine.base import Attribute, CombinedState, State, ObsState
 
 
-__all__ = ["ConfigArgs", "DelayArgs", "CombinedState", "State", "ObsState"]
+__all__ = [
+    "ConfigArgs",
+    "DelayArgs",
+    "SubscribeArgs",
+    "Attribute",
+    "CombinedState",
+    "State",
+    "ObsState",
+]
@@ -7,7 +7,11 @@ from ._state_machine.state_machine import (
     reset_state_machine,
     get_state_machine,
     get_async_state_machine,
+    reset_async_state_machine,
+    get_state_machine_registry,
+    get_async_state_machine_registry,
     StateMachine,
+    AsyncStateMachine,
     StateMachineBusyError,
     CommandNotAllowed,
 )
@@ -17,9 +21,34 @@ from ._state_machine.base import (
     AbstractStateUpdater,
     CombinedState,
     Attribute,
+    MachineId,
+    DEFAULT_MACHINE_ID,
+)
+from ._state_machine.registry import StateMachineRegistry
+from ._state_machine.scheduler import (
+    ScheduledCommand,
+    TransitionScheduler,
+    get_scheduler,
+    inject_scheduler,
+    use_clock,
+    advance_clock,
+)
+from ._state_machine.clock import (
+    Clock,
+    ClockBusyError,
+    ClockError,
+    RealClock,
+    ScaledClock,
+    VirtualClock,
+    create_clock,
+    get_clock,
 )
 from ._state_machine.factory import set_factory_for_memory_use_only
+from ._state_machine.file_backend.file_state_server import FileStateServer
 from ._state_machine.file_backend.file_stateupdater import InFileStateUpdater
+from ._state_machine.file_backend.journal_stateupdater import JournalStateUpdater
+from ._state_machine.file_backend.mmap_stateupdater import MmapStateUpdater
+from ._state_machine.sqlite_backend import SqliteStateServer, SqliteStateUpdater
 
 
 __all__ = [
@@ -33,13 +62,39 @@ __all__ = [
     "get_state_updater",
     "AbstractStateUpdater",
     "get_state_server",
+    "FileStateServer",
     "InFileStateUpdater",
+    "JournalStateUpdater",
+    "MmapStateUpdater",
+    "SqliteStateServer",
+    "SqliteStateUpdater",
     "set_factory_for_memory_use_only",
     "StateMachine",
+    "AsyncStateMachine",
     "get_state_machine",
     "reset_state_machine",
     "CombinedState",
     "Attribute",
     "CommandNotAllowed",
-    "get_async_state_machine"
+    "get_async_state_machine",
+    "reset_async_state_machine",
+    "get_state_machine_registry",
+    "get_async_state_machine_registry",
+    "StateMachineRegistry",
+    "MachineId",
+    "DEFAULT_MACHINE_ID",
+    "ScheduledCommand",
+    "TransitionScheduler",
+    "get_scheduler",
+    "inject_scheduler",
+    "use_clock",
+    "advance_clock",
+    "Clock",
+    "ClockBusyError",
+    "ClockError",
+    "RealClock",
+    "ScaledClock",
+    "VirtualClock",
+    "create_clock",
+    "get_clock",
 ]
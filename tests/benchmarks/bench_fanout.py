@@ -0,0 +1,81 @@
+"""
+Measures how long it takes for a state change to reach every websocket of the
+ConnectionManager, against the former asyncio.run per connection and message.
+
+run with: python -m tests.benchmarks.bench_fanout
+"""
+import asyncio
+import json
+from time import perf_counter
+
+from mv.state_machine import set_factory_for_memory_use_only
+from mv._server._fast_api_server.connection_manager import ConnectionManager
+
+# the time a socket takes to write a message
+SEND_LATENCY = 0.001
+EVENTS = 5
+
+
+class FakeWebSocket:
+
+    def __init__(self, expected: int) -> None:
+        self.received = 0
+        self._expected = expected
+        self.done = asyncio.Event()
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, message: str):
+        await asyncio.sleep(SEND_LATENCY)
+        self.received += 1
+        if self.received == self._expected:
+            self.done.set()
+
+    async def close(self):
+        pass
+
+
+def _legacy_publish(websockets: list[FakeWebSocket], state: dict):
+    for websocket in websockets:
+        value = json.dumps(state)
+        asyncio.run(websocket.send_text(value))
+
+
+async def _fan_out(sockets: int) -> float:
+    manager = ConnectionManager("bench")
+    websockets = [FakeWebSocket(EVENTS) for _ in range(sockets)]
+    for websocket in websockets:
+        await manager.connect(websocket)
+    start = perf_counter()
+    for index in range(EVENTS):
+        await asyncio.to_thread(manager.publish, {"state": "ON", "index": index})
+    await asyncio.gather(*(websocket.done.wait() for websocket in websockets))
+    elapsed = perf_counter() - start
+    for websocket in websockets:
+        manager.disconnect(websocket)
+    return elapsed / EVENTS
+
+
+def _legacy(sockets: int) -> float:
+    websockets = [FakeWebSocket(EVENTS) for _ in range(sockets)]
+    start = perf_counter()
+    for index in range(EVENTS):
+        _legacy_publish(websockets, {"state": "ON", "index": index})
+    return (perf_counter() - start) / EVENTS
+
+
+def main():
+    set_factory_for_memory_use_only()
+    print(f"latency per event until all sockets received it ({SEND_LATENCY * 1000}ms per send)")
+    for sockets in (10, 100, 1000):
+        fan_out = asyncio.run(_fan_out(sockets))
+        legacy = _legacy(sockets)
+        print(
+            f"{sockets:>5} sockets: {fan_out * 1000:>8.1f} ms  "
+            f"asyncio.run per send: {legacy * 1000:>8.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Measures reads of obs_state per second from a file backend by an updater other than the
+one writing (as another process would), for the json state file, the journal, the
+memory mapped record and the sqlite database, with the state changed once every
+CHANGE_EVERY reads.
+
+run with: python -m tests.benchmarks.bench_file_reads
+"""
+import os
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Callable
+
+from mv._state_machine.file_backend import (
+    InFileStateUpdater,
+    JournalStateUpdater,
+    MmapStateUpdater,
+)
+from mv._state_machine.sqlite_backend import SqliteStateUpdater
+from mv._state_machine.base import AbstractStateUpdater
+
+OBS_STATES = ["IDLE", "CONFIGURING", "READY", "SCANNING"]
+CHANGE_EVERY = 100
+
+
+def _reads_per_second(
+    new_updater: Callable[[str], AbstractStateUpdater], machine_id: str, seconds: float
+) -> float:
+    writer = new_updater(machine_id)
+    reader = new_updater(machine_id)
+    with writer.update_state() as state:
+        state.update({"state": "ON", "obs_state": "EMPTY", "config": {"scan": 1}})
+    count = 0
+    start = perf_counter()
+    while perf_counter() - start < seconds:
+        if count % CHANGE_EVERY == 0:
+            with writer.update_state() as state:
+                state["obs_state"] = OBS_STATES[count // CHANGE_EVERY % len(OBS_STATES)]
+        reader.get_state().get("obs_state")
+        count += 1
+    return count / (perf_counter() - start)
+
+
+def main(seconds: float = 1):
+    cwd = Path.cwd()
+    with TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            for name, new_updater in [
+                ("json file", InFileStateUpdater),
+                ("journal", JournalStateUpdater),
+                ("mmap", MmapStateUpdater),
+                ("sqlite", SqliteStateUpdater),
+            ]:
+                reads = _reads_per_second(new_updater, name, seconds)
+                print(f"{name:>9}: {reads:>10,.0f} reads/s")
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""
+Measures state writes per second of the file backends, rewriting the json state file
+against appending the changes to the journal (and writing a row and a transition to the
+sqlite database), as the state grows (a configuration kept in the state is rewritten by
+every json write but only journalled when it changes).
+
+run with: python -m tests.benchmarks.bench_file_updates
+"""
+import os
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from mv._state_machine.file_backend import InFileStateUpdater, JournalStateUpdater
+from mv._state_machine.sqlite_backend import SqliteStateUpdater
+from mv._state_machine.base import AbstractStateUpdater
+
+OBS_STATES = ["IDLE", "CONFIGURING", "READY", "SCANNING"]
+SIZES = [0, 10_000, 100_000]
+
+
+def _writes_per_second(updater: AbstractStateUpdater, size: int, seconds: float) -> float:
+    with updater.update_state() as state:
+        state["config"] = "x" * size
+    count = 0
+    start = perf_counter()
+    while perf_counter() - start < seconds:
+        with updater.update_state() as state:
+            state["obs_state"] = OBS_STATES[count % len(OBS_STATES)]
+        count += 1
+    return count / (perf_counter() - start)
+
+
+def main(seconds: float = 1):
+    cwd = Path.cwd()
+    with TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            print("writes per second with a configuration of")
+            for size in SIZES:
+                json_file = _writes_per_second(InFileStateUpdater(f"json/{size}"), size, seconds)
+                journal = _writes_per_second(
+                    JournalStateUpdater(f"journal/{size}"), size, seconds
+                )
+                sqlite = _writes_per_second(SqliteStateUpdater(f"sqlite/{size}"), size, seconds)
+                print(
+                    f"{size:>7} bytes: json file {json_file:>8,.0f}/s  "
+                    f"journal {journal:>8,.0f}/s  sqlite {sqlite:>8,.0f}/s"
+                )
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    main()
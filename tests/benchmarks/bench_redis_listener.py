@@ -0,0 +1,124 @@
+"""
+Measures the CPU an idle redis state server burns and the latency from a write to its
+publisher, comparing the asyncio listener with the former pub/sub thread polling every
+millisecond.
+
+Runs against the redis server at REDIS_HOST:REDIS_PORT (e.g. a local redis-server), or
+fakeredis if there is none.
+
+run with: python -m tests.benchmarks.bench_redis_listener
+"""
+from queue import Queue
+from statistics import median
+from time import perf_counter, process_time, sleep
+
+import fakeredis
+from fakeredis import aioredis
+import redis
+import redis.asyncio as asyncio_redis
+
+from mv._state_machine import config
+from mv._state_machine.redis_backend import RedisStateServer, RedisStateUpdater
+from mv._state_machine.redis_backend.keys import state_channel
+
+SERVERS = 8
+IDLE_SECONDS = 2.0
+EVENTS = 200
+
+
+class LatencyPublisher:
+
+    def __init__(self) -> None:
+        self.received = Queue[float]()
+
+    def publish(self, state: dict):
+        self.received.put(perf_counter())
+
+
+class PollingStateServer(RedisStateServer):
+    # the former server: a pub/sub thread waking up every millisecond
+
+    def __init__(self, publisher, redis_client: redis.Redis, updater, machine_id):
+        super().__init__(publisher, None, updater, machine_id)  # type: ignore
+        self._pubsub = redis_client.pubsub()
+        self._thread = None
+
+    def start_server(self):
+        self._pubsub.subscribe(**{state_channel(self._machine_id): self._handler})
+        self._thread = self._pubsub.run_in_thread(sleep_time=0.001)
+
+    def stop_server(self):
+        if self._thread:
+            self._thread.stop()
+            self._thread.join(1)
+
+
+def _clients() -> tuple[redis.Redis, asyncio_redis.Redis, str]:
+    host, port = config.get_redis_host(), config.get_redis_port()
+    client = redis.Redis(host=host, port=port)
+    try:
+        client.ping()
+    except redis.ConnectionError:
+        # plain clients on a fake connection publish on the (fake) redis channel
+        server = fakeredis.FakeServer()
+        return (
+            redis.Redis(
+                connection_pool=redis.ConnectionPool(
+                    connection_class=fakeredis.FakeRedisConnection, server=server
+                )
+            ),
+            asyncio_redis.Redis(
+                connection_pool=asyncio_redis.ConnectionPool(
+                    connection_class=aioredis.FakeAsyncRedisConnection, server=server
+                )
+            ),
+            "fakeredis",
+        )
+    return client, asyncio_redis.Redis(host=host, port=port), f"redis at {host}:{port}"
+
+
+def _measure(name: str, polling: bool):
+    client, async_client, _ = _clients()
+    updater = RedisStateUpdater(client, async_client, "bench/listener", "script", "pubsub")
+    publishers = [LatencyPublisher() for _ in range(SERVERS)]
+    if polling:
+        servers = [
+            PollingStateServer(publisher, client, updater, "bench/listener")
+            for publisher in publishers
+        ]
+    else:
+        servers = [
+            RedisStateServer(publisher, async_client, updater, "bench/listener")
+            for publisher in publishers
+        ]
+    for server in servers:
+        server.start_server()
+    sleep(0.2)
+    start = process_time()
+    sleep(IDLE_SECONDS)
+    idle_cpu = (process_time() - start) / IDLE_SECONDS
+    latencies = []
+    for index in range(EVENTS):
+        written = perf_counter()
+        with updater.update_state() as state:
+            state["index"] = index
+        latencies.append(publishers[0].received.get(timeout=5) - written)
+        for publisher in publishers[1:]:
+            publisher.received.get(timeout=5)
+    for server in servers:
+        server.stop_server()
+    print(
+        f"{name:>9}: idle cpu {idle_cpu * 100:>6.1f}% of a core ({SERVERS} servers), "
+        f"latency median {median(latencies) * 1000:.2f} ms "
+        f"max {max(latencies) * 1000:.2f} ms"
+    )
+
+
+def main():
+    print(f"redis state servers on {_clients()[2]}")
+    _measure("asyncio", polling=False)
+    _measure("polling", polling=True)
+
+
+if __name__ == "__main__":
+    main()
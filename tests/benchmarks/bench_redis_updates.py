@@ -0,0 +1,80 @@
+"""
+Measures three phase commands (like configure) per second written through the redis
+updater, comparing the lua compare and set, WATCH/MULTI and the former redis lock.
+
+Runs against the redis server at REDIS_HOST:REDIS_PORT (e.g. a local redis-server), or
+fakeredis if there is none, in which case there are no round trips to save and the
+numbers only show the cost on the client.
+
+run with: python -m tests.benchmarks.bench_redis_updates
+"""
+from threading import Thread
+from time import perf_counter
+
+import fakeredis
+import redis
+import redis.asyncio as asyncio_redis
+
+from mv._state_machine import config
+from mv._state_machine.redis_backend import RedisStateUpdater
+from mv._state_machine.redis_backend.redis_stateupdater import UpdateMode
+
+PHASES = [
+    {"state": "ON", "obs_state": "CONFIGURING"},
+    {"obs_state": "READY"},
+    {"obs_state": "IDLE"},
+]
+MACHINES = 4
+
+
+def _clients() -> tuple[redis.Redis, asyncio_redis.Redis, str]:
+    host, port = config.get_redis_host(), config.get_redis_port()
+    client = redis.Redis(host=host, port=port)
+    try:
+        client.ping()
+    except redis.ConnectionError:
+        return fakeredis.FakeRedis(), fakeredis.FakeAsyncRedis(), "fakeredis"
+    return client, asyncio_redis.Redis(host=host, port=port), f"redis at {host}:{port}"
+
+
+def _commands(updater: RedisStateUpdater, seconds: float, done: list[int]):
+    count = 0
+    start = perf_counter()
+    while perf_counter() - start < seconds:
+        with updater.atomic():
+            for changes in PHASES:
+                with updater.update_state() as state:
+                    state.update(changes)
+        count += 1
+    done.append(count)
+
+
+def _run(mode: UpdateMode, machines: int, seconds: float) -> float:
+    client, async_client, _ = _clients()
+    updaters = [
+        RedisStateUpdater(client, async_client, f"bench/{mode}/{index}", mode)
+        for index in range(machines)
+    ]
+    done: list[int] = []
+    threads = [Thread(target=_commands, args=(updater, seconds, done)) for updater in updaters]
+    start = perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(done) / (perf_counter() - start)
+
+
+def main(seconds: float = 2):
+    print(f"three phase commands per second on {_clients()[2]}")
+    for mode in ("script", "transaction", "lock"):
+        single = _run(mode, 1, seconds)
+        parallel = _run(mode, MACHINES, seconds)
+        print(
+            f"{mode:>12}: {single:>10,.0f} commands/s  "
+            f"{parallel:>10,.0f} commands/s over {MACHINES} machines"
+        )
+
+
+if __name__ == "__main__":
+    main()
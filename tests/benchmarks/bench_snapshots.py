@@ -0,0 +1,66 @@
+"""
+Measures in memory state reads per second whilst another thread keeps writing, comparing
+the shared snapshots with the deepcopy per read they replaced.
+
+run with: python -m tests.benchmarks.bench_snapshots
+"""
+from copy import deepcopy
+from threading import Event, Thread
+from time import perf_counter
+from typing import Callable
+
+from mv._state_machine.inmem_backend import InMemStateUpdater
+
+READERS = 4
+
+
+def _writer(updater: InMemStateUpdater, stop: Event, writes: list[int]):
+    obs_states = ["IDLE", "CONFIGURING", "READY", "SCANNING"]
+    count = 0
+    while not stop.is_set():
+        with updater.update_state() as state:
+            state["state"] = "ON"
+            state["obs_state"] = obs_states[count % len(obs_states)]
+        count += 1
+    writes.append(count)
+
+
+def _reader(read: Callable[[], dict], stop: Event, reads: list[int]):
+    count = 0
+    while not stop.is_set():
+        read().get("obs_state")
+        count += 1
+    reads.append(count)
+
+
+def _run(name: str, read: Callable[[], dict], updater: InMemStateUpdater, seconds: float):
+    stop = Event()
+    reads: list[int] = []
+    writes: list[int] = []
+    threads = [Thread(target=_writer, args=(updater, stop, writes))] + [
+        Thread(target=_reader, args=(read, stop, reads)) for _ in range(READERS)
+    ]
+    start = perf_counter()
+    for thread in threads:
+        thread.start()
+    while perf_counter() - start < seconds:
+        stop.wait(0.05)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = perf_counter() - start
+    print(
+        f"{name:>10}: {sum(reads) / elapsed:>12,.0f} reads/s "
+        f"({READERS} readers) {sum(writes) / elapsed:>10,.0f} writes/s"
+    )
+
+
+def main(seconds: float = 2):
+    updater = InMemStateUpdater("bench")
+    updater.reset_state()
+    _run("snapshot", updater.get_state, updater, seconds)
+    _run("deepcopy", lambda: deepcopy(dict(updater.get_state())), updater, seconds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Measures requests per second of GET /state with the state persisted in a file, as the
+state grows (a configuration kept in the state), and the reads per second of the state
+file updater against parsing the file on every read, as it did before keeping the state.
+
+run with: python -m tests.benchmarks.bench_state_endpoint
+"""
+import json
+import os
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Callable
+
+os.environ["PERSIST_STATE_IN_FILE"] = "True"
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+from mv.server import app  # noqa: E402
+from mv.state_machine import get_state_updater  # noqa: E402
+
+SIZES = [0, 10_000, 100_000]
+
+
+def _per_second(call: Callable[[], object], seconds: float) -> float:
+    count = 0
+    start = perf_counter()
+    while perf_counter() - start < seconds:
+        call()
+        count += 1
+    return count / (perf_counter() - start)
+
+
+def _run(client: TestClient, seconds: float):
+    updater = get_state_updater()
+    path = Path(".build/state.json")
+    print("per second with a configuration of")
+    for size in SIZES:
+        with updater.update_state() as state:
+            state.update({"state": "ON", "obs_state": "READY", "config": "x" * size})
+        requests = _per_second(lambda: client.get("/state"), seconds)
+        cached = _per_second(lambda: updater.get_state().get("state"), seconds)
+        parsed = _per_second(lambda: json.loads(path.read_bytes()).get("state"), seconds)
+        print(
+            f"{size:>7} bytes: GET /state {requests:>8,.0f}  "
+            f"cached reads {cached:>10,.0f}  parsed reads {parsed:>8,.0f}"
+        )
+
+
+def main(seconds: float = 1):
+    cwd = Path.cwd()
+    with TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            # a client used as a context manager keeps its event loop between requests
+            with TestClient(app) as client:
+                _run(client, seconds)
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Counts the backend reads a command costs and the resulting command rate.
+
+run with: python -m tests.benchmarks.bench_transitions
+"""
+from collections import Counter
+from time import perf_counter
+
+from mv.state_machine import StateMachine, DEFAULT_MACHINE_ID
+from mv._state_machine.factory import InMemFactory, inject_factory
+from mv._state_machine.inmem_backend import InMemStateUpdater
+
+_reads = Counter[str]()
+
+
+class CountingStateUpdater(InMemStateUpdater):
+
+    def get_state(self):
+        _reads["get_state"] += 1
+        return super().get_state()
+
+    def state_machine_is_busy(self) -> bool:
+        _reads["state_machine_is_busy"] += 1
+        return super().state_machine_is_busy()
+
+
+class CountingFactory(InMemFactory):
+
+    def get_state_updater(self, machine_id=DEFAULT_MACHINE_ID):
+        _reads["get_state_updater"] += 1
+        return CountingStateUpdater(machine_id)
+
+
+def _cycle(state_machine: StateMachine):
+    state_machine.switch_on()
+    state_machine.assign_resources()
+    state_machine.configure()
+    state_machine.scan()
+    state_machine.clear_config()
+    state_machine.release_resources()
+    state_machine.switch_off()
+
+
+COMMANDS_PER_CYCLE = 7
+
+
+def main(cycles: int = 2000):
+    inject_factory(CountingFactory())
+    state_machine = StateMachine("bench")
+    state_machine.reset_state()
+    _reads.clear()
+    start = perf_counter()
+    for _ in range(cycles):
+        _cycle(state_machine)
+    elapsed = perf_counter() - start
+    commands = cycles * COMMANDS_PER_CYCLE
+    print(f"commands: {commands} in {elapsed:.2f}s ({commands / elapsed:.0f} commands/s)")
+    for name, count in sorted(_reads.items()):
+        print(f"{name:>24}: {count / commands:.2f} per command")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 import os
+from pathlib import Path
 from typing import Any, Generator, cast
 import pytest
 import pytest_asyncio
@@ -82,6 +83,7 @@ async def fxt_async_websocket(settings: Settings):
 async def fxt_websocket(settings: Settings):
     if settings.use_mock_ws:
         websocket = get_mock_ws_server()
+        websocket.clear()
         settings.websocket = websocket
         yield websocket
     else:
@@ -156,6 +158,13 @@ def fxt_events_observer(settings: Settings):
     return observer
 
 
+@pytest.fixture(name="build_dir")
+def fxt_build_dir(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    # the file backends keep their files under .build in the working directory
+    monkeypatch.chdir(tmp_path)
+    return tmp_path / ".build"
+
+
 @pytest.fixture(name="persist_state_in_file")
 def fxt_persist_state_in_file():
     os.environ["PERSIST_STATE_IN_FILE"] = "True"
@@ -41,6 +41,19 @@ class Publisher(AbstractPublisher):
             self._observer.set_event(state)
 
 
+class StatePublisher(AbstractPublisher):
+    # queues every state published, for tests that wait for states from other threads
+
+    def __init__(self) -> None:
+        self.states = queue.Queue[dict]()
+
+    def publish(self, state: dict):
+        self.states.put(state)
+
+    def next(self, timeout: float = 2) -> dict:
+        return self.states.get(timeout=timeout)
+
+
 class MessageObserver(AbstractObserver):
 
     def __init__(self) -> None:
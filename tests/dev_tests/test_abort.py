@@ -0,0 +1,127 @@
+import asyncio
+import queue
+from time import perf_counter
+from assertpy import assert_that
+import fakeredis
+import pytest
+
+from mv.state_machine import (
+    AsyncStateMachine,
+    CommandNotAllowed,
+    InFileStateUpdater,
+    StateMachine,
+    get_scheduler,
+    set_factory_for_memory_use_only,
+    state_server,
+)
+from mv._state_machine.inmem_backend import InMemStateUpdater
+from mv._state_machine.redis_backend import RedisStateUpdater
+from .helpers import Publisher
+
+pytestmark = pytest.mark.usefixtures("build_dir")
+
+
+class RecordingObserver:
+
+    def __init__(self) -> None:
+        self.events: queue.Queue[dict] = queue.Queue()
+
+    def set_event(self, event: dict):
+        self.events.put(event)
+
+
+def in_mem_updater():
+    return InMemStateUpdater("abort")
+
+
+def file_updater():
+    return InFileStateUpdater("abort")
+
+
+def redis_updater():
+    return RedisStateUpdater(fakeredis.FakeRedis(), fakeredis.FakeAsyncRedis(), "abort")
+
+
+@pytest.fixture(name="use_memory_state_machine", autouse=True)
+def fxt_use_memory_state_machine():
+    set_factory_for_memory_use_only()
+
+
+@pytest.fixture(name="updater", params=[in_mem_updater, file_updater, redis_updater])
+def fxt_updater(request):
+    updater = request.param()
+    updater.reset_state()
+    yield updater
+    get_scheduler().cancel_machine("abort")
+
+
+@pytest.fixture(name="ready_state_machine")
+def fxt_ready_state_machine(updater):
+    state_machine = StateMachine("abort")
+    state_machine._updater = updater
+    state_machine.switch_on()
+    state_machine.assign_resources()
+    state_machine.configure()
+    return state_machine
+
+
+def test_abort_preempts_scan(ready_state_machine: StateMachine):
+    scheduled = ready_state_machine.submit("scan", 10, {"delay": 10})
+    assert_that(ready_state_machine.obs_state).is_equal_to("BUSY")
+    start = perf_counter()
+    ready_state_machine.abort()
+    assert_that(perf_counter() - start).is_less_than(0.5)
+    assert_that(scheduled.cancelled).is_true()
+    assert_that(scheduled.wait(1)).is_true()
+    assert_that(ready_state_machine.obs_state).is_equal_to("IDLE")
+    assert_that(ready_state_machine.busy).is_false()
+    ready_state_machine.configure()
+    assert_that(ready_state_machine.obs_state).is_equal_to("READY")
+
+
+def test_preempted_phase_is_dropped(ready_state_machine: StateMachine, updater):
+    scheduled = ready_state_machine.submit("scan", 0.05)
+    # another replica aborts the scan through the shared backend
+    with updater.update_state() as state:
+        state["obs_state"] = "IDLE"
+    assert_that(scheduled.wait(1)).is_true()
+    assert_that(scheduled.cancelled).is_true()
+    assert_that(ready_state_machine.obs_state).is_equal_to("IDLE")
+
+
+def test_abort_not_allowed_when_idle(ready_state_machine: StateMachine):
+    ready_state_machine.clear_config()
+    with pytest.raises(CommandNotAllowed):
+        ready_state_machine.abort()
+
+
+def test_abort_emits_aborted():
+    state_machine = StateMachine("abort")
+    state_machine.reset_state()
+    state_machine.switch_on()
+    state_machine.assign_resources()
+    publisher = Publisher()
+    observer = RecordingObserver()
+    publisher.subscribe(observer)
+    with state_server(publisher, "abort"):
+        state_machine.submit("configure", 10)
+        state_machine.abort()
+        # events left over from setting up the machine come first
+        obs_states = []
+        while obs_states[-2:] != ["ABORTED", "IDLE"]:
+            obs_states.append(observer.events.get(timeout=1).get("obs_state"))
+    assert_that(obs_states[-3:]).is_equal_to(["BUSY", "ABORTED", "IDLE"])
+
+
+@pytest.mark.asyncio
+async def test_async_abort():
+    state_machine = AsyncStateMachine("async/abort")
+    state_machine.reset_state()
+    await state_machine.async_switch_on()
+    await state_machine.async_assign_resources()
+    task = asyncio.create_task(state_machine.async_configure(10))
+    await asyncio.sleep(0.01)
+    assert_that(state_machine.obs_state).is_equal_to("BUSY")
+    await state_machine.async_abort()
+    await asyncio.wait_for(task, 1)
+    assert_that(state_machine.obs_state).is_equal_to("IDLE")
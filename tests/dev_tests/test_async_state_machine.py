@@ -0,0 +1,81 @@
+import asyncio
+import threading
+from time import perf_counter
+from assertpy import assert_that
+import pytest
+
+from mv.state_machine import (
+    get_async_state_machine,
+    reset_state_machine,
+    set_factory_for_memory_use_only,
+    CommandNotAllowed,
+)
+
+
+@pytest.fixture(name="use_memory_state_machine", autouse=True)
+def fxt_use_memory_state_machine():
+    set_factory_for_memory_use_only()
+
+
+@pytest.fixture(name="async_state_machine")
+def fxt_async_state_machine():
+    reset_state_machine("async")
+    return get_async_state_machine("async")
+
+
+@pytest.mark.asyncio
+async def test_async_commands(async_state_machine):
+    await async_state_machine.async_switch_on(0.01)
+    assert_that(async_state_machine.state).is_equal_to("ON")
+    await async_state_machine.async_assign_resources(0.01, {"delay": 0.01})
+    await async_state_machine.async_configure(0.01, {"delay": 0.01})
+    await async_state_machine.async_scan(0.01, {"delay": 0.01})
+    assert_that(async_state_machine.obs_state).is_equal_to("READY")
+    await async_state_machine.async_clear_config(0.01)
+    await async_state_machine.async_release_resources(0.01, {"delay": 0.01})
+    assert_that(async_state_machine.obs_state).is_equal_to("EMPTY")
+    await async_state_machine.async_switch_off(0.01)
+    assert_that(async_state_machine.state).is_equal_to("OFF")
+
+
+@pytest.mark.asyncio
+async def test_async_command_states(async_state_machine):
+    await async_state_machine.async_switch_on()
+    task = asyncio.create_task(
+        async_state_machine.async_assign_resources(0.05, {"delay": 0.05})
+    )
+    await asyncio.sleep(0.02)
+    assert_that(async_state_machine.obs_state).is_equal_to("BUSY")
+    assert_that(async_state_machine.busy).is_true()
+    await asyncio.sleep(0.06)
+    assert_that(async_state_machine.obs_state).is_equal_to("RESOURCING")
+    await task
+    assert_that(async_state_machine.obs_state).is_equal_to("IDLE")
+
+
+@pytest.mark.asyncio
+async def test_async_not_allowed(async_state_machine):
+    with pytest.raises(CommandNotAllowed):
+        await async_state_machine.async_scan()
+
+
+@pytest.mark.asyncio
+async def test_concurrent_delayed_commands_do_not_use_threads():
+    machine_ids = [f"async/{index}" for index in range(1000)]
+    for machine_id in machine_ids:
+        reset_state_machine(machine_id)
+    machines = [get_async_state_machine(machine_id) for machine_id in machine_ids]
+    threads = threading.active_count()
+
+    async def count_threads():
+        await asyncio.sleep(0.1)
+        return threading.active_count()
+
+    start = perf_counter()
+    *_, threads_in_flight = await asyncio.gather(
+        *(machine.async_switch_on(0.2) for machine in machines), count_threads()
+    )
+    elapsed = perf_counter() - start
+    assert_that(threads_in_flight).is_equal_to(threads)
+    assert_that(elapsed).is_less_than(2)
+    assert_that({machine.state for machine in machines}).is_equal_to({"ON"})
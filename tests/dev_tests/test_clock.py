@@ -0,0 +1,128 @@
+from time import perf_counter, sleep
+from assertpy import assert_that
+import pytest
+from fastapi.testclient import TestClient
+
+from mv.state_machine import (
+    ClockError,
+    RealClock,
+    ScaledClock,
+    TransitionScheduler,
+    VirtualClock,
+    create_clock,
+    get_async_state_machine,
+    get_state_machine,
+    inject_scheduler,
+    reset_state_machine,
+    set_factory_for_memory_use_only,
+)
+from mv._state_machine import config
+from mv._state_machine.clock import set_clock
+from mv._server._fast_api_server.fast_api_server import app
+
+
+@pytest.fixture(name="use_memory_state_machine", autouse=True)
+def fxt_use_memory_state_machine():
+    set_factory_for_memory_use_only()
+
+
+@pytest.fixture(name="use_clock")
+def fxt_use_clock(request):
+    scheduler = TransitionScheduler(clock=request.param)
+    inject_scheduler(scheduler)
+    yield request.param
+    for scheduled in scheduler.in_flight():
+        scheduled.cancel()
+    inject_scheduler(None)
+
+
+@pytest.mark.parametrize("use_clock", [ScaledClock(1000)], indirect=True)
+def test_scaled_clock_compresses_delays(use_clock):
+    reset_state_machine("clock")
+    state_machine = get_state_machine("clock")
+    start = perf_counter()
+    state_machine.switch_on(10)
+    state_machine.assign_resources(10, {"delay": 10})
+    assert_that(perf_counter() - start).is_less_than(1)
+    assert_that(state_machine.obs_state).is_equal_to("IDLE")
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("use_clock", [ScaledClock(1000)], indirect=True)
+async def test_scaled_clock_compresses_async_delays(use_clock):
+    reset_state_machine("clock")
+    state_machine = get_async_state_machine("clock")
+    start = perf_counter()
+    await state_machine.async_switch_on(10)
+    assert_that(perf_counter() - start).is_less_than(1)
+    assert_that(state_machine.state).is_equal_to("ON")
+
+
+@pytest.mark.parametrize("use_clock", [VirtualClock()], indirect=True)
+def test_virtual_clock_keeps_order(use_clock: VirtualClock):
+    machine_ids = ["clock/1", "clock/2", "clock/3"]
+    delays = [3, 1, 2]
+    machines = []
+    for machine_id in machine_ids:
+        reset_state_machine(machine_id)
+        machines.append(get_state_machine(machine_id))
+    commands = [machine.submit("switch_on", delay) for machine, delay in zip(machines, delays)]
+    use_clock.advance(1)
+    commands[1].wait(1)
+    assert_that([machine.state for machine in machines]).is_equal_to(["BUSY", "ON", "BUSY"])
+    use_clock.advance(1)
+    commands[2].wait(1)
+    assert_that([machine.state for machine in machines]).is_equal_to(["BUSY", "ON", "ON"])
+    use_clock.advance(1)
+    commands[0].wait(1)
+    assert_that([machine.state for machine in machines]).is_equal_to(["ON", "ON", "ON"])
+
+
+def test_only_virtual_clock_advances():
+    with pytest.raises(ClockError):
+        RealClock().advance(1)
+    with pytest.raises(ClockError):
+        VirtualClock().advance(-1)
+    with pytest.raises(ClockError):
+        create_clock("lunar")
+    clock = VirtualClock()
+    clock.advance(2)
+    assert_that(clock.now()).is_equal_to(2)
+    assert_that(create_clock("scaled", 100).factor).is_equal_to(100)
+
+
+def test_clock_selected_by_env(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(config, "STATE_MACHINE_CLOCK", None)
+    monkeypatch.setattr(config, "STATE_MACHINE_TIME_SCALE", 100.0)
+    assert_that(config.get_clock_mode()).is_equal_to("scaled")
+    monkeypatch.setattr(config, "STATE_MACHINE_CLOCK", "virtual")
+    assert_that(config.get_clock_mode()).is_equal_to("virtual")
+
+
+def test_clock_api():
+    inject_scheduler(TransitionScheduler(clock=RealClock()))
+    client = TestClient(app)
+    query = "?machine_id=clock/api"
+    try:
+        result = client.post("clock/advance", json={"seconds": 1})
+        assert_that(result.status_code).is_equal_to(405)
+        result = client.post("clock", json={"mode": "virtual"})
+        assert_that(result.json()).is_equal_to({"mode": "virtual", "now": 0.0})
+        client.post(f"switch_on{query}")
+        client.post(f"assign_resources{query}")
+        client.post(f"background_configure{query}", json={"delay": 5, "config": None})
+        assert_that(client.get(f"obs_state{query}").json()).is_equal_to("BUSY")
+        # the configure in flight is due on the virtual clock
+        result = client.post("clock", json={"mode": "real"})
+        assert_that(result.status_code).is_equal_to(409)
+        assert_that(client.get("clock").json()["mode"]).is_equal_to("virtual")
+        result = client.post("clock/advance", json={"seconds": 5})
+        assert_that(result.json()["now"]).is_equal_to(5)
+        for _ in range(100):
+            if client.get(f"obs_state{query}").json() == "READY":
+                break
+            sleep(0.01)
+        assert_that(client.get(f"obs_state{query}").json()).is_equal_to("READY")
+    finally:
+        inject_scheduler(None)
+        set_clock(None)
@@ -0,0 +1,227 @@
+import asyncio
+import multiprocessing
+from threading import Event
+import time
+from typing import Any, Callable
+from assertpy import assert_that
+import pytest
+
+from mv.state_machine import (
+    AsyncStateMachine,
+    InFileStateUpdater,
+    JournalStateUpdater,
+    MmapStateUpdater,
+    SqliteStateUpdater,
+    StateMachine,
+    StateMachineBusyError,
+    TransitionScheduler,
+    VirtualClock,
+    get_scheduler,
+    inject_scheduler,
+)
+from mv._state_machine import config
+from mv._state_machine.base import AbstractFactory, AbstractStateUpdater, MachineId
+from mv._state_machine.factory import inject_factory
+from mv._state_machine.lease_keeper import LeaseKeeper
+
+UPDATERS = [InFileStateUpdater, JournalStateUpdater, MmapStateUpdater, SqliteStateUpdater]
+
+NewUpdater = Callable[[str], AbstractStateUpdater]
+
+
+pytestmark = [
+    pytest.mark.usefixtures("build_dir"),
+    pytest.mark.parametrize("new_updater", UPDATERS),
+]
+
+
+@pytest.fixture(name="machine_id")
+def fxt_machine_id(request: pytest.FixtureRequest) -> str:
+    # the states published are remembered per machine for the whole process
+    return f"marked/{request.node.name}"
+
+
+class ReplicaFactory(AbstractFactory):
+    # every state machine gets updaters of its own, as those of another process would be
+
+    def __init__(self, new_updater: NewUpdater) -> None:
+        self._new_updater = new_updater
+
+    def get_state_updater(self, machine_id: MachineId) -> AbstractStateUpdater:
+        return self._new_updater(machine_id)
+
+    def get_state_server(self, *args: Any):
+        raise NotImplementedError()
+
+
+@pytest.fixture(name="replica")
+def fxt_replica(new_updater: NewUpdater, machine_id: str):
+    scheduler = TransitionScheduler(clock=VirtualClock())
+    inject_scheduler(scheduler)
+    inject_factory(ReplicaFactory(new_updater))
+    yield StateMachine(machine_id)
+    inject_factory(None)
+    for scheduled in scheduler.in_flight():
+        scheduled.cancel()
+    inject_scheduler(None)
+
+
+def _is_busy(new_updater: NewUpdater, machine_id: str, busy: Any):
+    busy.value = new_updater(machine_id).state_machine_is_busy()
+
+
+def test_a_command_in_flight_makes_the_machine_busy_for_other_processes(
+    new_updater: NewUpdater, machine_id: str
+):
+    updater = new_updater(machine_id)
+    assert_that(updater.begin_command("configure")).is_true()
+    context = multiprocessing.get_context("fork")
+    busy = context.Value("b", False)
+    process = context.Process(target=_is_busy, args=(new_updater, machine_id, busy))
+    process.start()
+    process.join(5)
+    assert_that(bool(busy.value)).is_true()
+    assert_that(new_updater(machine_id).begin_command("scan")).is_false()
+    updater.end_command()
+    assert_that(new_updater(machine_id).state_machine_is_busy()).is_false()
+
+
+def test_a_marker_whose_lease_ran_out_is_taken_over(
+    new_updater: NewUpdater, machine_id: str, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(config, "COMMAND_LEASE", 0.05)
+    stalled = new_updater(machine_id)
+    assert_that(stalled.begin_command("configure")).is_true()
+    time.sleep(0.1)
+    other = new_updater(machine_id)
+    assert_that(other.state_machine_is_busy()).is_false()
+    assert_that(other.begin_command("abort")).is_true()
+    assert_that(stalled.renew_command()).is_false()
+    # nor does the stalled command clear the marker of the other
+    stalled.end_command()
+    assert_that(new_updater(machine_id).state_machine_is_busy()).is_true()
+    other.end_command()
+
+
+def test_a_marker_is_renewed_whilst_held(
+    new_updater: NewUpdater, machine_id: str, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(config, "COMMAND_LEASE", 0.2)
+    updater = new_updater(machine_id)
+    keeper = LeaseKeeper()
+    assert_that(updater.begin_command("scan")).is_true()
+    keeper.hold(updater)
+    time.sleep(0.5)
+    assert_that(new_updater(machine_id).state_machine_is_busy()).is_true()
+    keeper.drop(updater)
+    updater.end_command()
+    assert_that(new_updater(machine_id).state_machine_is_busy()).is_false()
+
+
+def test_a_marker_seen_once_is_followed_through_renewals(
+    new_updater: NewUpdater, machine_id: str, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(config, "COMMAND_LEASE", 0.1)
+    observer = new_updater(machine_id)
+    owner = new_updater(machine_id)
+    assert_that(owner.begin_command("scan")).is_true()
+    assert_that(observer.state_machine_is_busy()).is_true()
+    for _ in range(3):
+        time.sleep(0.05)
+        assert_that(owner.renew_command()).is_true()
+        assert_that(observer.state_machine_is_busy()).is_true()
+    owner.end_command()
+    assert_that(observer.state_machine_is_busy()).is_false()
+    assert_that(observer.begin_command("configure")).is_true()
+    assert_that(owner.state_machine_is_busy()).is_true()
+    observer.end_command()
+
+
+def test_a_command_in_flight_makes_the_machine_busy_for_other_replicas(
+    new_updater: NewUpdater, machine_id: str, replica: StateMachine
+):
+    other = new_updater(machine_id)
+    replica.switch_on()
+    assert_that(replica.submit("assign_resources", 5)).is_not_none()
+    assert_that(other.state_machine_is_busy()).is_true()
+    replica.abort()
+    assert_that(other.state_machine_is_busy()).is_false()
+    # and the other way round
+    assert_that(other.begin_command("release_resources")).is_true()
+    with pytest.raises(StateMachineBusyError):
+        replica.configure()
+    other.end_command()
+    replica.configure()
+    assert_that(replica.obs_state).is_equal_to("READY")
+
+
+def _write(updater: AbstractStateUpdater, obs_state: str):
+    with updater.update_state() as state:
+        state["obs_state"] = obs_state
+
+
+def test_an_abort_frees_the_machine_from_a_command_of_another_process(
+    new_updater: NewUpdater, machine_id: str, replica: StateMachine
+):
+    replica.switch_on()
+    replica.assign_resources()
+    owner = new_updater(machine_id)
+    assert_that(owner.begin_command("configure")).is_true()
+    _write(owner, "CONFIGURING")
+    replica.abort()
+    assert_that(new_updater(machine_id).state_machine_is_busy()).is_false()
+    assert_that(owner.renew_command()).is_false()
+    replica.configure()
+    assert_that(replica.obs_state).is_equal_to("READY")
+
+
+def test_a_phase_of_a_command_aborted_by_another_process_is_dropped(
+    new_updater: NewUpdater, machine_id: str, replica: StateMachine
+):
+    replica.switch_on()
+    replica.assign_resources()
+    replica.configure()
+    scheduled = replica.submit("scan", 5)
+    assert_that(scheduled).is_not_none()
+    # another process aborts the scan and begins a command that is BUSY too
+    other = new_updater(machine_id)
+    other.abort_command()
+    _write(other, "IDLE")
+    assert_that(other.begin_command("configure")).is_true()
+    _write(other, "BUSY")
+    get_scheduler().clock.advance(5)
+    assert_that(scheduled.wait(1)).is_true()
+    assert_that(scheduled.cancelled).is_true()
+    assert_that(replica.obs_state).is_equal_to("BUSY")
+    assert_that(new_updater(machine_id).state_machine_is_busy()).is_true()
+    other.end_command()
+
+
+def test_a_command_that_lost_its_marker_is_cancelled(
+    new_updater: NewUpdater, machine_id: str, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(config, "COMMAND_LEASE", 0.1)
+    owner = new_updater(machine_id)
+    lost = Event()
+    assert_that(owner.begin_command("scan")).is_true()
+    LeaseKeeper().hold(owner, lost.set)
+    new_updater(machine_id).abort_command()
+    assert_that(lost.wait(1)).is_true()
+
+
+@pytest.mark.asyncio
+async def test_async_command_marks_the_machine_till_it_finishes(
+    new_updater: NewUpdater, machine_id: str
+):
+    inject_factory(ReplicaFactory(new_updater))
+    try:
+        replica = AsyncStateMachine(machine_id)
+    finally:
+        inject_factory(None)
+    other = new_updater(machine_id)
+    switching_on = asyncio.create_task(replica.async_switch_on(0.2))
+    await asyncio.sleep(0.05)
+    assert_that(await other.async_state_machine_is_busy()).is_true()
+    await switching_on
+    assert_that(await other.async_state_machine_is_busy()).is_false()
+    assert_that(await replica.async_get_attribute("state")).is_equal_to("ON")
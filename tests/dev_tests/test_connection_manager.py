@@ -0,0 +1,163 @@
+import asyncio
+import json
+from assertpy import assert_that
+import pytest
+
+from mv.state_machine import set_factory_for_memory_use_only
+from mv._server._fast_api_server.connection_manager import ConnectionManager
+
+
+class FakeWebSocket:
+
+    def __init__(self, stuck: bool = False) -> None:
+        self.messages: list[str] = []
+        self.received = asyncio.Event()
+        self.closed = False
+        self._stuck = stuck
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, message: str):
+        if self._stuck:
+            await asyncio.Event().wait()
+        self.messages.append(message)
+        self.received.set()
+
+    async def close(self):
+        self.closed = True
+
+
+@pytest.fixture(name="use_memory_state_machine", autouse=True)
+def fxt_use_memory_state_machine():
+    set_factory_for_memory_use_only()
+
+
+def _received(websocket: FakeWebSocket, with_seq: bool = False) -> list[dict]:
+    messages = [json.loads(message) for message in websocket.messages]
+    if not with_seq:
+        for message in messages:
+            message.pop("seq")
+    return messages
+
+
+async def _publish(manager: ConnectionManager, *states: dict):
+    # the state server publishes from its own thread
+    for state in states:
+        await asyncio.to_thread(manager.publish, state)
+
+
+@pytest.mark.asyncio
+async def test_every_client_gets_every_event_in_order():
+    manager = ConnectionManager("connections")
+    websockets = [FakeWebSocket() for _ in range(10)]
+    for websocket in websockets:
+        await manager.connect(websocket)
+    states = [{"state": "BUSY"}, {"state": "ON"}, {"state": "OFF"}]
+    await _publish(manager, *states)
+    await asyncio.sleep(0.05)
+    for websocket in websockets:
+        assert_that(_received(websocket)).is_equal_to(states)
+    for websocket in websockets:
+        manager.disconnect(websocket)
+    assert_that(manager.active_connections).is_empty()
+    manager.close()
+
+
+@pytest.mark.asyncio
+async def test_stuck_client_is_evicted():
+    manager = ConnectionManager("connections", send_timeout=0.05)
+    stuck = FakeWebSocket(stuck=True)
+    healthy = FakeWebSocket()
+    await manager.connect(stuck)
+    await manager.connect(healthy)
+    await _publish(manager, {"state": "ON"})
+    await asyncio.wait_for(healthy.received.wait(), 1)
+    assert_that(healthy.messages).is_length(1)
+    await asyncio.sleep(0.1)
+    assert_that(stuck.closed).is_true()
+    assert_that(manager.active_connections).is_equal_to([healthy])
+    manager.close()
+
+
+@pytest.mark.asyncio
+async def test_subscribed_clients_only_get_changed_attributes():
+    manager = ConnectionManager("connections")
+    everything = FakeWebSocket()
+    obs_state = FakeWebSocket()
+    state_changes = FakeWebSocket()
+    for websocket in (everything, obs_state, state_changes):
+        await manager.connect(websocket)
+    manager.subscribe(obs_state, ["obs_state"])
+    manager.subscribe(state_changes, ["state"], on_change=True)
+    states = [
+        {"state": "ON", "obs_state": "IDLE"},
+        {"state": "ON", "obs_state": "READY"},
+        {"state": "OFF", "obs_state": "READY"},
+    ]
+    await _publish(manager, *states)
+    await asyncio.sleep(0.05)
+    assert_that(_received(everything)).is_equal_to(states)
+    assert_that(_received(obs_state)).is_equal_to(
+        [{"obs_state": "IDLE"}, {"obs_state": "READY"}, {"obs_state": "READY"}]
+    )
+    assert_that(_received(state_changes, with_seq=True)).is_equal_to(
+        [{"state": "ON", "seq": 1}, {"state": "OFF", "seq": 3}]
+    )
+    manager.close()
+
+
+@pytest.mark.asyncio
+async def test_reconnecting_client_gets_the_events_it_missed():
+    manager = ConnectionManager("connections")
+    websocket = FakeWebSocket()
+    await manager.connect(websocket)
+    await _publish(manager, {"state": "ON"})
+    await asyncio.sleep(0.05)
+    manager.disconnect(websocket)
+    await _publish(manager, {"state": "OFF"}, {"state": "ON"})
+    await asyncio.sleep(0.05)
+    reconnected = FakeWebSocket()
+    await manager.connect(reconnected, since=1)
+    await asyncio.sleep(0.05)
+    assert_that(_received(reconnected, with_seq=True)).is_equal_to(
+        [{"state": "OFF", "seq": 2}, {"state": "ON", "seq": 3}]
+    )
+    manager.close()
+
+
+@pytest.mark.asyncio
+async def test_client_too_far_behind_gets_the_latest_event():
+    manager = ConnectionManager("connections", replay_size=2)
+    websocket = FakeWebSocket()
+    await manager.connect(websocket)
+    manager.disconnect(websocket)
+    await _publish(manager, {"state": "ON"}, {"state": "OFF"}, {"state": "ON"})
+    await asyncio.sleep(0.05)
+    reconnected = FakeWebSocket()
+    await manager.connect(reconnected, since=0)
+    await asyncio.sleep(0.05)
+    assert_that(_received(reconnected, with_seq=True)).is_equal_to([{"state": "ON", "seq": 3}])
+    manager.close()
+
+
+@pytest.mark.asyncio
+async def test_client_subscribing_on_reconnecting_gets_what_it_missed_as_subscribed():
+    manager = ConnectionManager("connections")
+    websocket = FakeWebSocket()
+    await manager.connect(websocket)
+    manager.disconnect(websocket)
+    await _publish(
+        manager,
+        {"state": "ON", "obs_state": "IDLE"},
+        {"state": "ON", "obs_state": "READY"},
+    )
+    reconnected = FakeWebSocket()
+    await manager.connect(reconnected, since=0, attributes=["state"], on_change=True)
+    await _publish(manager, {"state": "ON", "obs_state": "SCANNING"}, {"state": "OFF"})
+    await asyncio.sleep(0.05)
+    # the state replayed is remembered as sent
+    assert_that(_received(reconnected, with_seq=True)).is_equal_to(
+        [{"state": "ON", "seq": 1}, {"state": "OFF", "seq": 4}]
+    )
+    manager.close()
@@ -0,0 +1,122 @@
+from queue import Empty
+from threading import Thread
+from time import perf_counter
+from assertpy import assert_that
+import pytest
+
+from mv.state_machine import (
+    get_state_machine,
+    reset_state_machine,
+    set_factory_for_memory_use_only,
+    state_server,
+)
+from mv._state_machine.event_hub import EventHub, SubscriptionClosed
+from .helpers import Publisher
+
+
+class RecordingObserver:
+
+    def __init__(self) -> None:
+        self.events: list[dict] = []
+
+    def set_event(self, event: dict):
+        self.events.append(event)
+
+
+def test_every_subscriber_gets_every_event():
+    hub = EventHub[int]()
+    first = hub.subscribe()
+    second = hub.subscribe()
+    for event in range(3):
+        hub.publish(event)
+    assert_that([first.get(0) for _ in range(3)]).is_equal_to([0, 1, 2])
+    assert_that([second.get(0) for _ in range(3)]).is_equal_to([0, 1, 2])
+
+
+def test_drop_oldest():
+    hub = EventHub[int]()
+    subscription = hub.subscribe(maxsize=2, policy="drop_oldest")
+    for event in range(5):
+        hub.publish(event)
+    assert_that([subscription.get(0), subscription.get(0)]).is_equal_to([3, 4])
+    assert_that(subscription.dropped).is_equal_to(3)
+
+
+def test_a_subscriber_that_fell_behind_does_not_hold_up_the_writer_by_default():
+    hub = EventHub[int]()
+    subscription = hub.subscribe(maxsize=1)
+    start = perf_counter()
+    for event in range(3):
+        hub.publish(event)
+    assert_that(perf_counter() - start).is_less_than(0.5)
+    assert_that(subscription.get(0)).is_equal_to(2)
+    assert_that(subscription.dropped).is_equal_to(2)
+
+
+def test_keep_latest():
+    hub = EventHub[int]()
+    subscription = hub.subscribe(policy="keep_latest")
+    for event in range(5):
+        hub.publish(event)
+    assert_that(subscription.get(0)).is_equal_to(4)
+    with pytest.raises(Empty):
+        subscription.get(0)
+
+
+def test_block_waits_for_room():
+    hub = EventHub[int]()
+    subscription = hub.subscribe(maxsize=1, policy="block")
+    hub.publish(0)
+    publisher = Thread(target=hub.publish, args=(1,))
+    publisher.start()
+    publisher.join(0.05)
+    assert_that(publisher.is_alive()).is_true()
+    assert_that(subscription.get(0)).is_equal_to(0)
+    publisher.join(1)
+    assert_that(subscription.get(0)).is_equal_to(1)
+    assert_that(subscription.dropped).is_equal_to(0)
+
+
+def test_slow_subscriber_does_not_stall_the_others():
+    hub = EventHub[int]()
+    hub.subscribe(maxsize=1, policy="keep_latest")
+    fast = hub.subscribe()
+    start = perf_counter()
+    for event in range(100):
+        hub.publish(event)
+    assert_that(perf_counter() - start).is_less_than(0.5)
+    assert_that(len(fast)).is_equal_to(100)
+
+
+def test_closed_subscription_stops_iterating():
+    hub = EventHub[int]()
+    subscription = hub.subscribe()
+    hub.publish(0)
+    subscription.close()
+    hub.publish(1)
+    assert_that(list(subscription)).is_equal_to([0])
+    assert_that(hub.subscriptions).is_empty()
+    with pytest.raises(SubscriptionClosed):
+        subscription.get(0)
+
+
+def test_all_state_servers_see_every_change():
+    set_factory_for_memory_use_only()
+    reset_state_machine("hub")
+    state_machine = get_state_machine("hub")
+    observers = [RecordingObserver(), RecordingObserver()]
+    publishers = [Publisher(), Publisher()]
+    for publisher, observer in zip(publishers, observers):
+        publisher.subscribe(observer)
+    with state_server(publishers[0], "hub"), state_server(publishers[1], "hub"):
+        state_machine.switch_on()
+        state_machine.assign_resources()
+    expected = [
+        {"state": "BUSY", "obs_state": None},
+        {"state": "ON", "obs_state": "EMPTY"},
+        {"state": "ON", "obs_state": "BUSY"},
+        {"state": "ON", "obs_state": "RESOURCING"},
+        {"state": "ON", "obs_state": "IDLE"},
+    ]
+    for observer in observers:
+        assert_that(observer.events).is_equal_to(expected)
@@ -0,0 +1,87 @@
+import multiprocessing
+from pathlib import Path
+from threading import Event, Thread
+from assertpy import assert_that
+import pytest
+
+from mv.state_machine import InFileStateUpdater
+
+MACHINE_ID = "file/updater"
+WRITES = 50
+
+
+pytestmark = pytest.mark.usefixtures("build_dir")
+
+
+def _count(writes: int):
+    updater = InFileStateUpdater(MACHINE_ID)
+    for _ in range(writes):
+        with updater.update_state() as state:
+            state["count"] = state.get("count", 0) + 1
+
+
+def test_processes_sharing_the_file_lose_no_updates():
+    InFileStateUpdater(MACHINE_ID).reset_state()
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=_count, args=(WRITES,)) for _ in range(4)]
+    for process in processes:
+        process.start()
+    _count(WRITES)
+    for process in processes:
+        process.join(10)
+    assert_that(InFileStateUpdater(MACHINE_ID).get_state()).is_equal_to({"count": 5 * WRITES})
+
+
+def test_readers_never_see_a_partial_write():
+    updater = InFileStateUpdater(MACHINE_ID)
+    done = Event()
+    seen = []
+
+    def read():
+        while not done.is_set():
+            seen.append(updater.get_state())
+
+    reader = Thread(target=read)
+    reader.start()
+    try:
+        for index in range(200):
+            with updater.update_state() as state:
+                state["obs_state"] = "READY" if index % 2 else "IDLE"
+                state["config"] = "x" * 10_000
+    finally:
+        done.set()
+        reader.join()
+    assert_that(seen).is_not_empty()
+    assert_that({len(state) for state in seen}).is_subset_of({0, 2})
+
+
+def test_writes_leave_no_temporary_file(build_dir: Path):
+    updater = InFileStateUpdater(MACHINE_ID)
+    with updater.update_state() as state:
+        state["state"] = "ON"
+    assert_that([path.name for path in build_dir.iterdir() if path.suffix == ".tmp"]).is_empty()
+
+
+def test_an_unchanged_file_is_not_parsed_again():
+    InFileStateUpdater(MACHINE_ID).reset_state()
+    reader = InFileStateUpdater(MACHINE_ID)
+    first = reader.get_state()
+    assert_that(reader.get_state()).is_same_as(first)
+
+
+def test_writes_of_the_same_size_are_seen_by_other_updaters():
+    writer = InFileStateUpdater(MACHINE_ID)
+    reader = InFileStateUpdater(MACHINE_ID)
+    for obs_state in ["IDLE", "BUSY"] * 50:
+        with writer.update_state() as state:
+            state["obs_state"] = obs_state
+        assert_that(reader.get_state()).is_equal_to({"obs_state": obs_state})
+
+
+def test_a_file_changed_in_place_is_read_again(build_dir: Path):
+    updater = InFileStateUpdater(MACHINE_ID)
+    with updater.update_state() as state:
+        state["state"] = "ON"
+    assert_that(updater.get_state()).is_equal_to({"state": "ON"})
+    (build_dir / "state_file%2Fupdater.json").write_text('{"state": "OFF", "obs_state": null}')
+    assert_that(updater.get_state()).is_equal_to({"state": "OFF", "obs_state": None})
@@ -0,0 +1,120 @@
+import multiprocessing
+import threading
+from queue import Empty
+from typing import Callable
+from assertpy import assert_that
+import pytest
+
+from mv.state_machine import (
+    FileStateServer,
+    InFileStateUpdater,
+    JournalStateUpdater,
+    MmapStateUpdater,
+)
+from mv._state_machine.file_backend.base import WatchableStateUpdater
+from .helpers import StatePublisher
+
+UPDATERS = [InFileStateUpdater, JournalStateUpdater, MmapStateUpdater]
+
+
+pytestmark = pytest.mark.usefixtures("build_dir")
+
+
+@pytest.fixture(name="machine_id")
+def fxt_machine_id(request: pytest.FixtureRequest) -> str:
+    # the states published are remembered per machine for the whole process
+    return f"watched/{request.node.name}"
+
+
+def _write(new_updater: Callable[[str], WatchableStateUpdater], machine_id: str, obs_state: str):
+    with new_updater(machine_id).update_state() as state:
+        state["obs_state"] = obs_state
+
+
+@pytest.mark.parametrize("watch", ["auto", "poll"])
+@pytest.mark.parametrize("new_updater", UPDATERS)
+def test_writes_of_other_processes_are_published(
+    new_updater: Callable[[str], WatchableStateUpdater], watch: str, machine_id: str
+):
+    publisher = StatePublisher()
+    server = FileStateServer(publisher, new_updater(machine_id), machine_id, watch=watch)
+    server.start_server()
+    try:
+        context = multiprocessing.get_context("fork")
+        for obs_state in ["IDLE", "READY"]:
+            process = context.Process(target=_write, args=(new_updater, machine_id, obs_state))
+            process.start()
+            process.join(5)
+            assert_that(publisher.next()).is_equal_to({"obs_state": obs_state})
+    finally:
+        server.stop_server()
+
+
+@pytest.mark.parametrize("new_updater", UPDATERS)
+def test_writes_of_this_process_are_published_once(
+    new_updater: Callable[[str], WatchableStateUpdater], machine_id: str
+):
+    publisher = StatePublisher()
+    server = FileStateServer(publisher, new_updater(machine_id), machine_id)
+    server.start_server()
+    try:
+        # by another updater of the machine, as the state machine has
+        _write(new_updater, machine_id, "IDLE")
+        assert_that(publisher.next()).is_equal_to({"obs_state": "IDLE"})
+        with pytest.raises(Empty):
+            publisher.next(timeout=0.3)
+    finally:
+        server.stop_server()
+
+
+def test_a_reset_of_this_process_is_not_published(machine_id: str):
+    publisher = StatePublisher()
+    updater = InFileStateUpdater(machine_id)
+    server = FileStateServer(publisher, updater, machine_id, watch="poll", interval=0.01)
+    server.start_server()
+    try:
+        updater.reset_state()
+        with pytest.raises(Empty):
+            publisher.next(timeout=0.3)
+    finally:
+        server.stop_server()
+
+
+def _watchers() -> int:
+    return sum(thread.name == "file-watcher" for thread in threading.enumerate())
+
+
+@pytest.mark.parametrize("watch", ["auto", "poll"])
+def test_servers_of_a_directory_share_one_watcher(watch: str, machine_id: str):
+    watchers = _watchers()
+    machines = {
+        f"{machine_id}/{index}": new_updater for index, new_updater in enumerate(UPDATERS)
+    }
+    publishers = {machine: StatePublisher() for machine in machines}
+    servers = [
+        FileStateServer(publishers[machine], new_updater(machine), machine, watch=watch)
+        for machine, new_updater in machines.items()
+    ]
+    for server in servers:
+        server.start_server()
+    try:
+        assert_that(_watchers()).is_equal_to(watchers + 1)
+        context = multiprocessing.get_context("fork")
+        machine = f"{machine_id}/1"
+        process = context.Process(target=_write, args=(machines[machine], machine, "IDLE"))
+        process.start()
+        process.join(5)
+        assert_that(publishers[machine].next()).is_equal_to({"obs_state": "IDLE"})
+        # the machines that did not change publish nothing
+        with pytest.raises(Empty):
+            publishers[f"{machine_id}/0"].next(timeout=0.3)
+        servers.pop(0).stop_server()
+        machine = f"{machine_id}/2"
+        process = context.Process(target=_write, args=(machines[machine], machine, "READY"))
+        process.start()
+        process.join(5)
+        assert_that(publishers[machine].next()).is_equal_to({"obs_state": "READY"})
+    finally:
+        for server in servers:
+            server.stop_server()
+    assert_that(_watchers()).is_equal_to(watchers)
@@ -0,0 +1,107 @@
+import multiprocessing
+from pathlib import Path
+from assertpy import assert_that
+import pytest
+
+from mv.state_machine import JournalStateUpdater
+from mv._state_machine.file_backend.journal_stateupdater import get_journal_path
+
+MACHINE_ID = "journal/updater"
+WRITES = 50
+
+
+pytestmark = pytest.mark.usefixtures("build_dir")
+
+
+def _write(updater: JournalStateUpdater, *obs_states: str):
+    for obs_state in obs_states:
+        with updater.update_state() as state:
+            state["obs_state"] = obs_state
+
+
+def test_writes_append_only_the_changes():
+    updater = JournalStateUpdater(MACHINE_ID, fsync_interval=0)
+    with updater.update_state() as state:
+        state.update({"state": "ON", "obs_state": "EMPTY"})
+    _write(updater, "IDLE")
+    with updater.update_state() as state:
+        del state["obs_state"]
+    records = [
+        {key: value for key, value in record.items() if key != "at"}
+        for record in updater.history()
+    ]
+    assert_that(records).is_equal_to(
+        [
+            {"seq": 1, "set": {"state": "ON", "obs_state": "EMPTY"}},
+            {"seq": 2, "set": {"obs_state": "IDLE"}},
+            {"seq": 3, "del": ["obs_state"]},
+        ]
+    )
+
+
+def test_state_is_rebuilt_from_the_snapshot_and_journal(build_dir: Path):
+    updater = JournalStateUpdater(MACHINE_ID, compact_every=3, keep=1)
+    with updater.update_state() as state:
+        state["state"] = "ON"
+    _write(updater, "EMPTY", "IDLE", "READY", "SCANNING", "READY", "IDLE")
+    restarted = JournalStateUpdater(MACHINE_ID)
+    assert_that(restarted.get_state()).is_equal_to({"state": "ON", "obs_state": "IDLE"})
+    assert_that(restarted.version).is_equal_to(7)
+    # the journal holds the records since the last snapshot, one older journal is kept
+    assert_that([record["seq"] for record in updater.history()]).is_equal_to([4, 5, 6, 7])
+
+
+def test_a_torn_record_is_dropped_on_startup():
+    updater = JournalStateUpdater(MACHINE_ID)
+    _write(updater, "IDLE", "READY")
+    path = get_journal_path(MACHINE_ID)
+    path.write_bytes(path.read_bytes()[:-3])
+    restarted = JournalStateUpdater(MACHINE_ID)
+    assert_that(restarted.get_state()).is_equal_to({"obs_state": "IDLE"})
+    _write(restarted, "SCANNING")
+    assert_that(JournalStateUpdater(MACHINE_ID).get_state()).is_equal_to(
+        {"obs_state": "SCANNING"}
+    )
+
+
+def test_atomic_rolls_back_with_a_record():
+    updater = JournalStateUpdater(MACHINE_ID)
+    _write(updater, "IDLE")
+    with pytest.raises(RuntimeError):
+        with updater.atomic():
+            _write(updater, "CONFIGURING")
+            raise RuntimeError("failed to configure")
+    assert_that(updater.get_state()).is_equal_to({"obs_state": "IDLE"})
+    assert_that([record.get("set") for record in updater.history()]).is_equal_to(
+        [{"obs_state": "IDLE"}, {"obs_state": "CONFIGURING"}, {"obs_state": "IDLE"}]
+    )
+
+
+@pytest.mark.asyncio
+async def test_async_updates_append_to_the_journal():
+    updater = JournalStateUpdater(MACHINE_ID)
+    async with updater.async_atomic():
+        async with updater.async_update_state() as state:
+            state["state"] = "ON"
+    assert_that(JournalStateUpdater(MACHINE_ID).get_state()).is_equal_to({"state": "ON"})
+
+
+def _count(writes: int):
+    updater = JournalStateUpdater(MACHINE_ID, compact_every=7)
+    for _ in range(writes):
+        with updater.update_state() as state:
+            state["count"] = state.get("count", 0) + 1
+
+
+def test_processes_sharing_the_journal_lose_no_updates():
+    reader = JournalStateUpdater(MACHINE_ID)
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=_count, args=(WRITES,)) for _ in range(4)]
+    for process in processes:
+        process.start()
+    _count(WRITES)
+    for process in processes:
+        process.join(10)
+    # a process that did not write catches up with the others, across compactions
+    assert_that(reader.get_state()).is_equal_to({"count": 5 * WRITES})
+    assert_that(reader.version).is_equal_to(5 * WRITES)
@@ -0,0 +1,52 @@
+from copy import deepcopy
+import pickle
+from assertpy import assert_that
+import pytest
+
+from mv._state_machine.inmem_backend import InMemStateUpdater
+from mv._state_machine.inmem_backend.memstate import FrozenState
+
+
+@pytest.fixture(name="updater")
+def fxt_updater():
+    updater = InMemStateUpdater("memstate")
+    updater.reset_state()
+    return updater
+
+
+def test_reads_share_the_snapshot(updater: InMemStateUpdater):
+    with updater.update_state() as state:
+        state["state"] = "ON"
+    snapshot = updater.get_state()
+    assert_that(updater.get_state()).is_same_as(snapshot)
+    assert_that(snapshot).is_equal_to({"state": "ON"})
+    assert_that(deepcopy(snapshot)).is_same_as(snapshot)
+
+
+def test_snapshots_are_read_only(updater: InMemStateUpdater):
+    snapshot = updater.get_state()
+    with pytest.raises(TypeError):
+        snapshot["state"] = "ON"
+    with pytest.raises(TypeError):
+        snapshot.update({"state": "ON"})
+    with pytest.raises(TypeError):
+        snapshot.clear()
+
+
+def test_writes_swap_in_a_new_version(updater: InMemStateUpdater):
+    before = updater.get_state()
+    version = updater.version
+    assert_that(updater.has_changed_since(version)).is_false()
+    with updater.update_state() as state:
+        state["obs_state"] = "IDLE"
+    assert_that(updater.has_changed_since(version)).is_true()
+    assert_that(updater.version).is_greater_than(version)
+    assert_that(before).is_equal_to({})
+    assert_that(updater.get_state()).is_equal_to({"obs_state": "IDLE"})
+
+
+def test_snapshot_pickles():
+    snapshot = FrozenState({"state": "ON"}, 3)
+    copied = pickle.loads(pickle.dumps(snapshot))
+    assert_that(copied).is_equal_to(snapshot)
+    assert_that(copied.version).is_equal_to(3)
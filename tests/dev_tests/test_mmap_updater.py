@@ -0,0 +1,108 @@
+import multiprocessing
+from threading import Event, Thread
+from assertpy import assert_that
+import pytest
+
+from mv.state_machine import MmapStateUpdater
+from mv._state_machine.file_backend.mmap_stateupdater import EXTRAS_SIZE, SEQ
+
+MACHINE_ID = "mmap/updater"
+WRITES = 50
+
+
+pytestmark = pytest.mark.usefixtures("build_dir")
+
+
+def test_states_are_kept_as_codes_and_other_attributes_as_json():
+    updater = MmapStateUpdater(MACHINE_ID)
+    with updater.update_state() as state:
+        state.update({"state": "ON", "obs_state": None, "config": {"scan": 1}})
+    assert_that(MmapStateUpdater(MACHINE_ID).get_state()).is_equal_to(
+        {"state": "ON", "obs_state": None, "config": {"scan": 1}}
+    )
+    with updater.update_state() as state:
+        # values without a code go with the other attributes
+        state["state"] = "UNKNOWN"
+        del state["config"]
+    assert_that(MmapStateUpdater(MACHINE_ID).get_state()).is_equal_to(
+        {"state": "UNKNOWN", "obs_state": None}
+    )
+    assert_that(updater.version).is_equal_to(2)
+
+
+def test_unchanged_state_is_not_decoded_again():
+    updater = MmapStateUpdater(MACHINE_ID)
+    with updater.update_state() as state:
+        state["obs_state"] = "IDLE"
+    reader = MmapStateUpdater(MACHINE_ID)
+    first = reader.get_state()
+    assert_that(reader.get_state()).is_same_as(first)
+    with updater.update_state() as state:
+        state["obs_state"] = "READY"
+    assert_that(reader.get_attribute("obs_state")).is_equal_to("READY")
+
+
+def test_too_large_a_state_is_refused():
+    updater = MmapStateUpdater(MACHINE_ID)
+    with pytest.raises(ValueError):
+        with updater.update_state() as state:
+            state["config"] = "x" * EXTRAS_SIZE
+    assert_that(updater.get_state()).is_empty()
+
+
+def test_a_write_left_half_way_is_recovered():
+    updater = MmapStateUpdater(MACHINE_ID)
+    with updater.update_state() as state:
+        state["obs_state"] = "IDLE"
+    # a writer that died after marking its write
+    SEQ.pack_into(updater._map, 0, SEQ.unpack_from(updater._map)[0] + 1)
+    reader = MmapStateUpdater(MACHINE_ID)
+    assert_that(reader.get_state()).is_equal_to({"obs_state": "IDLE"})
+    with updater.update_state() as state:
+        state["obs_state"] = "READY"
+    assert_that(SEQ.unpack_from(updater._map)[0] % 2).is_zero()
+    assert_that(reader.get_state()).is_equal_to({"obs_state": "READY"})
+
+
+def test_readers_never_see_a_partial_write():
+    updater = MmapStateUpdater(MACHINE_ID)
+    reader = MmapStateUpdater(MACHINE_ID)
+    done = Event()
+    seen = []
+
+    def read():
+        while not done.is_set():
+            seen.append(dict(reader.get_state()))
+
+    thread = Thread(target=read)
+    thread.start()
+    try:
+        for index in range(500):
+            with updater.update_state() as state:
+                state["obs_state"] = "READY" if index % 2 else "IDLE"
+                state["config"] = ("r" if index % 2 else "i") * (100 + index)
+    finally:
+        done.set()
+        thread.join()
+    # the state is empty until the first write
+    for state in filter(None, seen):
+        assert_that(state["config"][0]).is_equal_to(state["obs_state"][0].lower())
+
+
+def _count(writes: int):
+    updater = MmapStateUpdater(MACHINE_ID)
+    for _ in range(writes):
+        with updater.update_state() as state:
+            state["count"] = state.get("count", 0) + 1
+
+
+def test_processes_sharing_the_file_lose_no_updates():
+    reader = MmapStateUpdater(MACHINE_ID)
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=_count, args=(WRITES,)) for _ in range(4)]
+    for process in processes:
+        process.start()
+    _count(WRITES)
+    for process in processes:
+        process.join(10)
+    assert_that(reader.get_state()).is_equal_to({"count": 5 * WRITES})
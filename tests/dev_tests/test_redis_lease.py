@@ -0,0 +1,344 @@
+import asyncio
+import json
+from threading import Thread
+import time
+from typing import Any
+from assertpy import assert_that
+import fakeredis
+from fakeredis import aioredis
+import pytest
+import redis
+import redis.asyncio as asyncio_redis
+
+from mv.state_machine import (
+    AsyncStateMachine,
+    StateMachine,
+    StateMachineBusyError,
+    TransitionScheduler,
+    VirtualClock,
+    inject_scheduler,
+)
+from mv._state_machine import config
+from mv._state_machine.base import AbstractFactory, MachineId
+from mv._state_machine.factory import inject_factory
+from mv._state_machine.lease_keeper import LeaseKeeper
+from mv._state_machine.redis_backend import RedisHashStateUpdater, RedisStateUpdater
+from mv._state_machine.redis_backend.keys import command_key, lock_key, state_key
+from mv._state_machine.redis_backend.lease import (
+    AsyncLeaseLock,
+    LeaseLock,
+    LeaseLost,
+)
+from mv._state_machine.redis_backend.redis_stateupdater import UpdateMode
+
+MACHINE_ID = "redis/lease"
+
+
+@pytest.fixture(name="redis_server")
+def fxt_redis_server():
+    return fakeredis.FakeServer()
+
+
+def _client(redis_server: fakeredis.FakeServer) -> redis.Redis:
+    # a plain client on a fake connection, as fakeredis clients take the in process paths
+    return redis.Redis(
+        connection_pool=redis.ConnectionPool(
+            connection_class=fakeredis.FakeRedisConnection, server=redis_server
+        )
+    )
+
+
+def _async_client(redis_server: fakeredis.FakeServer) -> asyncio_redis.Redis:
+    return asyncio_redis.Redis(
+        connection_pool=asyncio_redis.ConnectionPool(
+            connection_class=aioredis.FakeAsyncRedisConnection, server=redis_server
+        )
+    )
+
+
+def _updater(
+    redis_server: fakeredis.FakeServer, mode: UpdateMode = "script"
+) -> RedisStateUpdater:
+    return RedisStateUpdater(
+        _client(redis_server), _async_client(redis_server), MACHINE_ID, mode
+    )
+
+
+class ReplicaFactory(AbstractFactory):
+    # every state machine gets updaters of its own, as those of another replica would be
+
+    def __init__(self, redis_server: fakeredis.FakeServer) -> None:
+        self._redis_server = redis_server
+
+    def get_state_updater(self, machine_id: MachineId = MACHINE_ID) -> RedisStateUpdater:
+        return _updater(self._redis_server)
+
+    def get_state_server(self, *args: Any):
+        raise NotImplementedError()
+
+
+@pytest.fixture(name="scheduler")
+def fxt_scheduler():
+    scheduler = TransitionScheduler(clock=VirtualClock())
+    inject_scheduler(scheduler)
+    yield scheduler
+    for scheduled in scheduler.in_flight():
+        scheduled.cancel()
+    inject_scheduler(None)
+
+
+@pytest.fixture(name="replica")
+def fxt_replica(redis_server: fakeredis.FakeServer, scheduler: TransitionScheduler):
+    inject_factory(ReplicaFactory(redis_server))
+    yield StateMachine(MACHINE_ID)
+    inject_factory(None)
+
+
+def test_command_lease_is_renewed_whilst_held(
+    redis_server: fakeredis.FakeServer, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(config, "COMMAND_LEASE", 0.2)
+    updater = _updater(redis_server)
+    keeper = LeaseKeeper()
+    assert_that(updater.begin_command("scan")).is_true()
+    keeper.hold(updater)
+    time.sleep(0.5)
+    assert_that(_updater(redis_server).state_machine_is_busy()).is_true()
+    keeper.drop(updater)
+    updater.end_command()
+    assert_that(_updater(redis_server).state_machine_is_busy()).is_false()
+    assert_that(updater.command_metrics.renewed).is_greater_than(0)
+    assert_that(updater.command_metrics.lost).is_equal_to(0)
+
+
+def test_a_command_in_flight_makes_the_machine_busy_for_other_replicas(
+    redis_server: fakeredis.FakeServer, replica: StateMachine
+):
+    other = _updater(redis_server)
+    replica.switch_on()
+    assert_that(replica.submit("assign_resources", 5)).is_not_none()
+    assert_that(other.state_machine_is_busy()).is_true()
+    assert_that(other.begin_command("switch_off")).is_false()
+    replica.abort()
+    assert_that(other.state_machine_is_busy()).is_false()
+    # and the other way round
+    assert_that(other.begin_command("release_resources")).is_true()
+    with pytest.raises(StateMachineBusyError):
+        replica.configure()
+    other.end_command()
+    replica.configure()
+    assert_that(replica.obs_state).is_equal_to("READY")
+    assert_that(other.state_machine_is_busy()).is_false()
+
+
+@pytest.mark.parametrize("mode", ["script", "transaction", "lock"])
+@pytest.mark.parametrize("new_updater", [RedisStateUpdater, RedisHashStateUpdater])
+def test_writes_of_a_command_that_lost_its_lease_are_refused(
+    redis_server: fakeredis.FakeServer, mode: UpdateMode, new_updater: type[RedisStateUpdater]
+):
+    client = _client(redis_server)
+    updater = new_updater(client, _async_client(redis_server), MACHINE_ID, mode)
+    updater.begin_command("configure")
+    with updater.update_state() as state:
+        state["obs_state"] = "CONFIGURING"
+    # the replica stalls past its lease and another one starts a command
+    client.delete(command_key(MACHINE_ID))
+    other = _updater(redis_server)
+    assert_that(other.begin_command("abort")).is_true()
+    with pytest.raises(LeaseLost):
+        with updater.update_state() as state:
+            state["obs_state"] = "READY"
+    assert_that(updater.get_state()).is_equal_to({"obs_state": "CONFIGURING"})
+    updater.end_command()
+    assert_that(other.state_machine_is_busy()).is_true()
+    other.end_command()
+
+
+def test_an_abort_frees_the_machine_from_a_command_of_another_replica(
+    redis_server: fakeredis.FakeServer, replica: StateMachine
+):
+    replica.switch_on()
+    replica.assign_resources()
+    owner = _updater(redis_server)
+    owner.begin_command("configure")
+    client = _client(redis_server)
+    token = int(client.get(command_key(MACHINE_ID)))
+    with owner.update_state() as state:
+        state["obs_state"] = "CONFIGURING"
+    replica.abort()
+    assert_that(_updater(redis_server).state_machine_is_busy()).is_false()
+    assert_that(owner.renew_command()).is_false()
+    # the fence moved on, so the tokens handed out before are never valid again
+    assert_that(int(client.get(f"{command_key(MACHINE_ID)}:fence"))).is_greater_than(token)
+    replica.configure()
+    assert_that(replica.obs_state).is_equal_to("READY")
+
+
+def test_a_phase_of_a_command_aborted_by_another_replica_is_dropped(
+    redis_server: fakeredis.FakeServer, replica: StateMachine, scheduler: TransitionScheduler
+):
+    replica.switch_on()
+    replica.assign_resources()
+    replica.configure()
+    scheduled = replica.submit("scan", 5)
+    other = _updater(redis_server)
+    other.abort_command()
+    with other.update_state() as state:
+        state["obs_state"] = "IDLE"
+    assert_that(other.begin_command("configure")).is_true()
+    with other.update_state() as state:
+        state["obs_state"] = "BUSY"
+    scheduler.clock.advance(5)
+    assert_that(scheduled.wait(1)).is_true()
+    assert_that(scheduled.cancelled).is_true()
+    assert_that(replica.obs_state).is_equal_to("BUSY")
+    other.end_command()
+
+
+def _write_before_set(
+    redis_server: fakeredis.FakeServer,
+    replica: StateMachine,
+    monkeypatch: pytest.MonkeyPatch,
+    failure: None | Exception = None,
+):
+    # another replica writes obs_state between the read and the write of the next phase
+    updater = replica._updater
+    try_set = updater._try_set
+
+    def _try_set(expected: bytes, state_str: str) -> int:
+        monkeypatch.setattr(updater, "_try_set", try_set)
+        with _updater(redis_server).update_state() as state:
+            state["obs_state"] = "IDLE"
+        if failure is not None:
+            raise failure
+        return try_set(expected, state_str)
+
+    monkeypatch.setattr(updater, "_try_set", _try_set)
+
+
+def test_a_phase_gives_way_to_an_abort_between_its_read_and_its_write(
+    redis_server: fakeredis.FakeServer,
+    replica: StateMachine,
+    scheduler: TransitionScheduler,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    replica.switch_on()
+    replica.assign_resources()
+    replica.configure()
+    scheduled = replica.submit("scan", 5)
+    _write_before_set(redis_server, replica, monkeypatch)
+    scheduler.clock.advance(5)
+    assert_that(scheduled.wait(1)).is_true()
+    assert_that(scheduled.cancelled).is_true()
+    assert_that(replica.obs_state).is_equal_to("IDLE")
+
+
+def test_a_failed_command_is_not_rolled_back_over_a_later_write(
+    redis_server: fakeredis.FakeServer,
+    replica: StateMachine,
+    scheduler: TransitionScheduler,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    replica.switch_on()
+    replica.assign_resources()
+    replica.configure()
+    scheduled = replica.submit("scan", 5)
+    _write_before_set(redis_server, replica, monkeypatch, RuntimeError("connection lost"))
+    scheduler.clock.advance(5)
+    with pytest.raises(RuntimeError):
+        scheduled.wait(1)
+    assert_that(replica.obs_state).is_equal_to("IDLE")
+
+
+def test_tokens_grow_with_every_acquisition(redis_server: fakeredis.FakeServer):
+    lock = LeaseLock(_client(redis_server), "lease")
+    tokens = []
+    for _ in range(2):
+        with lock:
+            tokens.append(lock.token)
+    assert_that(tokens[1]).is_greater_than(tokens[0])
+
+
+def test_waiting_for_the_lock_is_counted(redis_server: fakeredis.FakeServer):
+    first = LeaseLock(_client(redis_server), "lease")
+    second = LeaseLock(_client(redis_server), "lease")
+    first.acquire()
+    assert_that(second.acquire(timeout=0.05)).is_false()
+    waiter = Thread(target=second.acquire)
+    waiter.start()
+    time.sleep(0.1)
+    first.release()
+    waiter.join(1)
+    second.release()
+    assert_that(second.metrics.as_dict()).contains_entry({"acquired": 1}, {"contended": 1})
+    assert_that(second.metrics.waited).is_greater_than_or_equal_to(0.1)
+
+
+def test_holder_whose_lease_ran_out_cannot_write(redis_server: fakeredis.FakeServer):
+    client = _client(redis_server)
+    updater = RedisStateUpdater(client, _async_client(redis_server), MACHINE_ID, "lock")
+    other = LeaseLock(_client(redis_server), lock_key(MACHINE_ID))
+    with pytest.raises(LeaseLost):
+        with updater.update_state() as state:
+            # the holder stalls past its lease and another replica takes the lock
+            client.delete(lock_key(MACHINE_ID))
+            other.acquire()
+            state["obs_state"] = "READY"
+    other.release()
+    assert_that(client.get(state_key(MACHINE_ID))).is_none()
+
+
+@pytest.mark.asyncio
+async def test_async_command_holds_the_lease_till_it_finishes(
+    redis_server: fakeredis.FakeServer,
+):
+    inject_factory(ReplicaFactory(redis_server))
+    try:
+        replica = AsyncStateMachine(MACHINE_ID)
+    finally:
+        inject_factory(None)
+    other = _updater(redis_server)
+    switching_on = asyncio.create_task(replica.async_switch_on(0.2))
+    await asyncio.sleep(0.05)
+    assert_that(await other.async_state_machine_is_busy()).is_true()
+    await switching_on
+    assert_that(await other.async_state_machine_is_busy()).is_false()
+    assert_that(await replica.async_get_attribute("state")).is_equal_to("ON")
+
+
+@pytest.mark.asyncio
+async def test_async_command_aborted_by_another_replica_writes_no_more(
+    redis_server: fakeredis.FakeServer,
+):
+    inject_factory(ReplicaFactory(redis_server))
+    try:
+        replica = AsyncStateMachine(MACHINE_ID)
+    finally:
+        inject_factory(None)
+    await replica.async_switch_on()
+    await replica.async_assign_resources()
+    configuring = asyncio.create_task(replica.async_configure(0.2))
+    await asyncio.sleep(0.05)
+    other = _updater(redis_server)
+    other.abort_command()
+    with other.update_state() as state:
+        state["obs_state"] = "IDLE"
+    await asyncio.wait_for(configuring, 1)
+    assert_that(await replica.async_get_attribute("obs_state")).is_equal_to("IDLE")
+    assert_that(await other.async_state_machine_is_busy()).is_false()
+
+
+@pytest.mark.asyncio
+async def test_async_lock_is_given_back(redis_server: fakeredis.FakeServer):
+    client = _async_client(redis_server)
+    lock = AsyncLeaseLock(client, "lease", lease=0.2)
+    async with lock:
+        assert_that(await lock.locked()).is_true()
+    assert_that(await lock.locked()).is_false()
+    updater = RedisStateUpdater(_client(redis_server), client, MACHINE_ID, "lock")
+    async with updater.async_update_state() as state:
+        state["obs_state"] = "READY"
+    assert_that(json.loads(await client.get(state_key(MACHINE_ID)))).is_equal_to(
+        {"obs_state": "READY"}
+    )
+    assert_that(updater.lock_metrics.acquired).is_equal_to(1)
@@ -0,0 +1,583 @@
+import asyncio
+import json
+import threading
+import time
+from typing import Any
+from assertpy import assert_that
+import fakeredis
+from fakeredis import aioredis
+import pytest
+import redis
+import redis.asyncio as asyncio_redis
+from redis.exceptions import ResponseError
+
+from mv._state_machine import config
+from mv._state_machine.factory import Redisfactory
+from mv._state_machine.redis_backend import (
+    RedisHashStateUpdater,
+    RedisStateServer,
+    RedisStateUpdater,
+    RedisStreamStateServer,
+)
+from mv._state_machine.redis_backend.keys import (
+    hash_key,
+    state_channel,
+    state_key,
+    stream_key,
+    version_key,
+)
+from mv._state_machine.redis_backend.redis_stateupdater import StateConflict, UpdateMode
+from mv._state_machine.state_control import subscribe_state_changes
+from .helpers import StatePublisher
+
+MACHINE_ID = "redis/updater"
+
+
+class CountingRedis(fakeredis.FakeRedis):
+    # counts the commands sent, i.e. the round trips of a non pipelined client
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.commands: list[str] = []
+
+    def execute_command(self, *args: Any, **options: Any):
+        self.commands.append(str(args[0]))
+        return super().execute_command(*args, **options)
+
+
+@pytest.fixture(name="redis_server")
+def fxt_redis_server():
+    return fakeredis.FakeServer()
+
+
+@pytest.fixture(name="redis_client")
+def fxt_redis_client(redis_server: fakeredis.FakeServer):
+    return CountingRedis(server=redis_server)
+
+
+def _updater(redis_client: CountingRedis, mode: UpdateMode) -> RedisStateUpdater:
+    async_client = fakeredis.FakeAsyncRedis(
+        server=redis_client.connection_pool.connection_kwargs["server"]
+    )
+    return RedisStateUpdater(redis_client, async_client, MACHINE_ID, mode)
+
+
+def _other_writer(redis_client: fakeredis.FakeRedis, **changes: Any):
+    # writes the state behind the back of an update in progress
+    state = json.loads(redis_client.get(state_key(MACHINE_ID)) or "{}")
+    state.update(changes)
+    redis_client.set(state_key(MACHINE_ID), json.dumps(state))
+
+
+@pytest.mark.parametrize("mode", ["script", "transaction", "lock"])
+def test_update_writes_and_publishes(redis_client: CountingRedis, mode: UpdateMode):
+    updater = _updater(redis_client, mode)
+    subscription = subscribe_state_changes(MACHINE_ID)
+    try:
+        with updater.update_state() as state:
+            state["state"] = "ON"
+        assert_that(updater.get_state()).is_equal_to({"state": "ON"})
+        assert_that(subscription.get(timeout=1)).is_equal_to({"state": "ON"})
+    finally:
+        subscription.close()
+
+
+def test_script_update_takes_two_round_trips(redis_client: CountingRedis):
+    updater = _updater(redis_client, "script")
+    # the first update loads the script
+    updater.reset_state()
+    redis_client.commands.clear()
+    with updater.update_state() as state:
+        state["state"] = "ON"
+    assert_that(redis_client.commands).is_equal_to(["GET", "EVALSHA"])
+
+
+@pytest.mark.parametrize("mode", ["script", "transaction"])
+def test_concurrent_change_of_other_attribute_is_kept(
+    redis_client: CountingRedis, mode: UpdateMode
+):
+    updater = _updater(redis_client, mode)
+    with updater.update_state() as state:
+        state.update({"state": "ON", "obs_state": "IDLE"})
+    with updater.update_state() as state:
+        _other_writer(redis_client, state="OFF")
+        state["obs_state"] = "READY"
+    assert_that(updater.get_state()).is_equal_to({"state": "OFF", "obs_state": "READY"})
+
+
+@pytest.mark.parametrize("mode", ["script", "transaction"])
+def test_concurrent_change_of_same_attribute_conflicts(
+    redis_client: CountingRedis, mode: UpdateMode
+):
+    updater = _updater(redis_client, mode)
+    with updater.update_state() as state:
+        state.update({"state": "ON", "obs_state": "IDLE"})
+    with pytest.raises(StateConflict):
+        with updater.update_state() as state:
+            _other_writer(redis_client, obs_state="ABORTED")
+            state["obs_state"] = "READY"
+    assert_that(updater.get_state()).is_equal_to({"state": "ON", "obs_state": "ABORTED"})
+
+
+def test_refused_script_falls_back_to_transaction(
+    redis_client: CountingRedis, monkeypatch: pytest.MonkeyPatch
+):
+    updater = _updater(redis_client, "script")
+
+    def refuse(*args: Any, **kwargs: Any):
+        raise ResponseError("unknown command 'EVALSHA'")
+
+    monkeypatch.setattr(updater, "_compare_and_set", refuse)
+    with updater.update_state() as state:
+        state["state"] = "ON"
+    assert_that(updater.mode).is_equal_to("transaction")
+    assert_that(updater.get_state()).is_equal_to({"state": "ON"})
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mode", ["script", "transaction"])
+async def test_async_update_rebases_concurrent_change(
+    redis_client: CountingRedis, mode: UpdateMode
+):
+    updater = _updater(redis_client, mode)
+    async with updater.async_update_state() as state:
+        _other_writer(redis_client, state="ON")
+        state["obs_state"] = "IDLE"
+    assert_that(updater.get_state()).is_equal_to({"state": "ON", "obs_state": "IDLE"})
+
+
+def _networked(redis_server: fakeredis.FakeServer) -> tuple[redis.Redis, asyncio_redis.Redis]:
+    # plain clients (on a fake connection) take the path of a real redis server: the
+    # state is published on the redis channel rather than the in process hub
+    return (
+        redis.Redis(
+            connection_pool=redis.ConnectionPool(
+                connection_class=fakeredis.FakeRedisConnection, server=redis_server
+            )
+        ),
+        asyncio_redis.Redis(
+            connection_pool=asyncio_redis.ConnectionPool(
+                connection_class=aioredis.FakeAsyncRedisConnection, server=redis_server
+            )
+        ),
+    )
+
+
+@pytest.mark.parametrize("mode", ["script", "transaction", "lock"])
+def test_writes_publish_the_versioned_state(
+    redis_server: fakeredis.FakeServer, mode: UpdateMode
+):
+    client, async_client = _networked(redis_server)
+    updater = RedisStateUpdater(client, async_client, MACHINE_ID, mode)
+    pubsub = client.pubsub()
+    pubsub.subscribe(state_channel(MACHINE_ID))
+    pubsub.get_message(timeout=1)
+    for obs_state in ("IDLE", "READY"):
+        with updater.update_state() as state:
+            state["obs_state"] = obs_state
+    messages = [json.loads(pubsub.get_message(timeout=1)["data"]) for _ in range(2)]
+    assert_that(messages).is_equal_to(
+        [
+            {"version": 1, "state": {"obs_state": "IDLE"}},
+            {"version": 2, "state": {"obs_state": "READY"}},
+        ]
+    )
+    pubsub.close()
+
+
+@pytest.mark.parametrize("mode", ["script", "transaction", "lock"])
+@pytest.mark.parametrize("new_updater", [RedisStateUpdater, RedisHashStateUpdater])
+def test_a_rollback_is_a_versioned_and_published_write(
+    redis_server: fakeredis.FakeServer, mode: UpdateMode, new_updater: type[RedisStateUpdater]
+):
+    client, async_client = _networked(redis_server)
+    updater = new_updater(client, async_client, MACHINE_ID, mode)
+    pubsub = client.pubsub()
+    pubsub.subscribe(state_channel(MACHINE_ID))
+    pubsub.get_message(timeout=1)
+    with pytest.raises(RuntimeError):
+        with updater.atomic():
+            with updater.update_state() as state:
+                state["obs_state"] = "CONFIGURING"
+            raise RuntimeError("failed to configure")
+    messages = [json.loads(pubsub.get_message(timeout=1)["data"]) for _ in range(2)]
+    assert_that([(message["version"], message["state"]) for message in messages]).is_equal_to(
+        [(1, {"obs_state": "CONFIGURING"}), (2, {})]
+    )
+    # the state was not there before
+    assert_that(client.keys("state*")).is_equal_to([version_key(MACHINE_ID).encode()])
+    pubsub.close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mode", ["script", "transaction", "lock"])
+async def test_an_async_rollback_restores_the_state_as_a_new_version(
+    redis_server: fakeredis.FakeServer, mode: UpdateMode
+):
+    client, async_client = _networked(redis_server)
+    updater = RedisStateUpdater(client, async_client, MACHINE_ID, mode)
+    async with updater.async_update_state() as state:
+        state["obs_state"] = "IDLE"
+    with pytest.raises(RuntimeError):
+        async with updater.async_atomic():
+            async with updater.async_update_state() as state:
+                state["obs_state"] = "CONFIGURING"
+            raise RuntimeError("failed to configure")
+    assert_that(await updater.async_get_state()).is_equal_to({"obs_state": "IDLE"})
+    assert_that(int(client.get(version_key(MACHINE_ID)))).is_equal_to(3)
+
+
+def test_state_server_forwards_published_state_without_reading_it(
+    redis_server: fakeredis.FakeServer,
+):
+    client, async_client = _networked(redis_server)
+    updater = RedisStateUpdater(client, async_client, MACHINE_ID)
+    publisher = StatePublisher()
+    server = RedisStateServer(publisher, async_client, updater, MACHINE_ID)
+    server.start_server()
+    try:
+        with updater.update_state() as state:
+            state["state"] = "ON"
+        # a later write the published state must not be read back as
+        client.set(state_key(MACHINE_ID), json.dumps({"state": "OFF"}))
+        assert_that(publisher.states.get(timeout=1)).is_equal_to({"state": "ON"})
+        assert_that(server.version).is_equal_to(1)
+    finally:
+        server.stop_server()
+
+
+def test_state_server_listens_on_connections_of_its_own_loop(
+    redis_server: fakeredis.FakeServer,
+):
+    client, async_client = _networked(redis_server)
+    updater = RedisStateUpdater(client, async_client, MACHINE_ID)
+
+    async def write():
+        async with updater.async_update_state() as state:
+            state["state"] = "ON"
+
+    # leaves a connection of another (now closed) loop in the pool of the client
+    asyncio.run(write())
+    publisher = StatePublisher()
+    server = RedisStateServer(publisher, async_client, updater, MACHINE_ID)
+    server.start_server()
+    try:
+        with updater.update_state() as state:
+            state["state"] = "OFF"
+        assert_that(publisher.next()).is_equal_to({"state": "OFF"})
+    finally:
+        server.stop_server()
+
+
+def _stream_updater(redis_server: fakeredis.FakeServer, mode: UpdateMode = "script"):
+    client, async_client = _networked(redis_server)
+    updater = RedisStateUpdater(client, async_client, MACHINE_ID, mode, "streams")
+    return client, updater
+
+
+def _write(updater: RedisStateUpdater, *obs_states: str):
+    for obs_state in obs_states:
+        with updater.update_state() as state:
+            state["obs_state"] = obs_state
+
+
+def _received(publisher: StatePublisher, count: int) -> list[str]:
+    return [publisher.states.get(timeout=1)["obs_state"] for _ in range(count)]
+
+
+@pytest.mark.parametrize("mode", ["script", "transaction", "lock"])
+def test_writes_append_to_the_stream(redis_server: fakeredis.FakeServer, mode: UpdateMode):
+    client, updater = _stream_updater(redis_server, mode)
+    _write(updater, "IDLE", "READY")
+    events = client.xrange(stream_key(MACHINE_ID))
+    assert_that([fields for _, fields in events]).is_equal_to(
+        [
+            {b"version": b"1", b"state": b'{"obs_state": "IDLE"}'},
+            {b"version": b"2", b"state": b'{"obs_state": "READY"}'},
+        ]
+    )
+
+
+def test_stream_reader_resumes_from_the_last_event(redis_server: fakeredis.FakeServer):
+    client, updater = _stream_updater(redis_server)
+    _write(updater, "EMPTY")
+    publisher = StatePublisher()
+    server = RedisStreamStateServer(publisher, client, MACHINE_ID)
+    server.start_server()
+    _write(updater, "IDLE")
+    assert_that(_received(publisher, 1)).is_equal_to(["IDLE"])
+    # a stalled reader does not lose the events added in the meantime
+    server.stop_server()
+    _write(updater, "READY", "SCANNING")
+    server.start_server()
+    assert_that(_received(publisher, 2)).is_equal_to(["READY", "SCANNING"])
+    server.stop_server()
+
+
+def test_stream_group_resumes_after_a_restart(redis_server: fakeredis.FakeServer):
+    client, updater = _stream_updater(redis_server)
+    publisher = StatePublisher()
+    server = RedisStreamStateServer(publisher, client, MACHINE_ID, group="pod-1")
+    server.start_server()
+    _write(updater, "IDLE")
+    assert_that(_received(publisher, 1)).is_equal_to(["IDLE"])
+    server.stop_server()
+    _write(updater, "READY")
+    restarted = RedisStreamStateServer(publisher, client, MACHINE_ID, group="pod-1")
+    restarted.start_server()
+    assert_that(_received(publisher, 1)).is_equal_to(["READY"])
+    restarted.stop_server()
+
+
+class BlockingRedis(redis.Redis):
+    # a sync client the async paths must not use, as its calls would block the loop
+
+    def execute_command(self, *args: Any, **options: Any):
+        raise AssertionError(f"blocking {args[0]} called")
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mode", ["script", "transaction", "lock"])
+async def test_async_paths_only_use_the_async_client(
+    redis_server: fakeredis.FakeServer, mode: UpdateMode
+):
+    _, async_client = _networked(redis_server)
+    blocking = BlockingRedis(
+        connection_pool=redis.ConnectionPool(
+            connection_class=fakeredis.FakeRedisConnection, server=redis_server
+        )
+    )
+    updater = RedisStateUpdater(blocking, async_client, MACHINE_ID, mode)
+    async with updater.async_atomic():
+        async with updater.async_update_state() as state:
+            state["state"] = "ON"
+    assert_that(await updater.async_get_state()).is_equal_to({"state": "ON"})
+    assert_that(await updater.async_state_machine_is_busy()).is_false()
+
+
+def _counting_networked(redis_server: fakeredis.FakeServer):
+    class NetworkedCountingRedis(redis.Redis):
+        commands: list[str] = []
+
+        def execute_command(self, *args: Any, **options: Any):
+            self.commands.append(str(args[0]))
+            return super().execute_command(*args, **options)
+
+    client = NetworkedCountingRedis(
+        connection_pool=redis.ConnectionPool(
+            connection_class=fakeredis.FakeRedisConnection, server=redis_server
+        )
+    )
+    return client, _networked(redis_server)[1]
+
+
+def _wait_for(condition, timeout: float = 2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+@pytest.mark.parametrize("transport", ["pubsub", "streams"])
+def test_mirror_serves_reads_without_redis(redis_server: fakeredis.FakeServer, transport):
+    client, async_client = _counting_networked(redis_server)
+    reader = RedisStateUpdater(client, async_client, MACHINE_ID, "script", transport, 1.0)
+    writer_client, writer_async_client = _networked(redis_server)
+    writer = RedisStateUpdater(
+        writer_client, writer_async_client, MACHINE_ID, "script", transport, 0
+    )
+    _write(writer, "IDLE")
+    try:
+        _wait_for(lambda: reader.mirror and reader.mirror.get() is not None)
+        client.commands.clear()
+        assert_that(reader.get_state()).is_equal_to({"obs_state": "IDLE"})
+        # another replica's write reaches the mirror
+        _write(writer, "READY")
+        _wait_for(lambda: reader.get_state() == {"obs_state": "READY"})
+        assert_that(client.commands).is_empty()
+        # as do the reader's own writes, straight away
+        _write(reader, "SCANNING")
+        client.commands.clear()
+        assert_that(reader.get_state()).is_equal_to({"obs_state": "SCANNING"})
+        assert_that(client.commands).is_empty()
+    finally:
+        assert reader.mirror
+        reader.mirror.stop()
+    # a mirror that stopped hearing from redis is no longer used
+    client.commands.clear()
+    assert_that(reader.get_state()).is_equal_to({"obs_state": "SCANNING"})
+    assert_that(client.commands).contains("GET")
+
+
+@pytest.mark.parametrize("transport", ["pubsub", "streams"])
+def test_mirror_is_not_fresh_past_writes_it_did_not_hear(
+    redis_server: fakeredis.FakeServer, transport
+):
+    client, async_client = _networked(redis_server)
+    reader = RedisStateUpdater(client, async_client, MACHINE_ID, "script", transport, 0.2)
+    writer = RedisStateUpdater(*_networked(redis_server), MACHINE_ID, "script", transport, 0)
+    _write(writer, "IDLE")
+    mirror = reader.mirror
+    assert mirror
+    try:
+        _wait_for(lambda: mirror.get() == {"obs_state": "IDLE"})
+        # as a writer that does not publish would
+        client.set(state_key(MACHINE_ID), json.dumps({"obs_state": "READY"}))
+        client.incr(version_key(MACHINE_ID))
+        _wait_for(lambda: mirror.get() == {"obs_state": "READY"})
+        assert_that(mirror.version).is_equal_to(2)
+    finally:
+        mirror.stop()
+
+
+def _mirror_threads() -> int:
+    return sum(thread.name == "state-mirror" for thread in threading.enumerate())
+
+
+@pytest.mark.parametrize("transport", ["pubsub", "streams"])
+def test_updaters_of_a_factory_share_one_mirror_stopped_with_the_server(
+    redis_server: fakeredis.FakeServer, transport, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(config, "REDIS_MIRROR_MAX_AGE", 1.0)
+    monkeypatch.setattr(config, "REDIS_STATE_TRANSPORT", transport)
+    factory = Redisfactory(*_networked(redis_server))
+    mirrors = _mirror_threads()
+    updater = factory.get_state_updater(MACHINE_ID)
+    other = factory.get_state_updater(MACHINE_ID)
+    assert isinstance(updater, RedisStateUpdater) and isinstance(other, RedisStateUpdater)
+    mirror = updater.mirror
+    assert mirror
+    assert_that(other.mirror).is_same_as(mirror)
+    server = factory.get_state_server(StatePublisher(), MACHINE_ID)
+    server.start_server()
+    try:
+        _write(updater, "IDLE")
+        _wait_for(lambda: other.get_state() == {"obs_state": "IDLE"})
+        _wait_for(lambda: mirror.get() is not None)
+        assert_that(_mirror_threads()).is_equal_to(mirrors + 1)
+    finally:
+        server.stop_server()
+    assert_that(mirror.stopped).is_true()
+    assert_that(mirror.get()).is_none()
+    # the updaters made from then on get a mirror of their own again
+    newer = factory.get_state_updater(MACHINE_ID)
+    assert isinstance(newer, RedisStateUpdater)
+    assert_that(newer.mirror).is_not_same_as(mirror)
+
+
+def _hash_updater(redis_client: CountingRedis, mode: UpdateMode) -> RedisHashStateUpdater:
+    async_client = fakeredis.FakeAsyncRedis(
+        server=redis_client.connection_pool.connection_kwargs["server"]
+    )
+    return RedisHashStateUpdater(redis_client, async_client, MACHINE_ID, mode)
+
+
+@pytest.mark.parametrize("mode", ["script", "transaction", "lock"])
+def test_hash_update_writes_only_the_changed_field(
+    redis_server: fakeredis.FakeServer, mode: UpdateMode
+):
+    client, async_client = _networked(redis_server)
+    updater = RedisHashStateUpdater(client, async_client, MACHINE_ID, mode)
+    with updater.update_state() as state:
+        state.update({"state": "ON", "obs_state": "IDLE"})
+    pubsub = client.pubsub()
+    pubsub.subscribe(state_channel(MACHINE_ID))
+    pubsub.get_message(timeout=1)
+    with updater.update_state() as state:
+        state["obs_state"] = "READY"
+    assert_that(json.loads(pubsub.get_message(timeout=1)["data"])).is_equal_to(
+        {"version": 2, "state": {"state": "ON", "obs_state": "READY"}, "changed": ["obs_state"]}
+    )
+    assert_that(client.hgetall(hash_key(MACHINE_ID))).is_equal_to(
+        {b"state": b'"ON"', b"obs_state": b'"READY"'}
+    )
+    assert_that(client.exists(state_key(MACHINE_ID))).is_zero()
+    pubsub.close()
+
+
+def test_hash_script_update_sends_only_the_changed_field(redis_client: CountingRedis):
+    updater = _hash_updater(redis_client, "script")
+    with updater.update_state() as state:
+        state.update({"state": "ON", "obs_state": "IDLE"})
+    redis_client.commands.clear()
+    with updater.update_state() as state:
+        state["obs_state"] = "READY"
+    assert_that(redis_client.commands).is_equal_to(["HGETALL", "EVALSHA"])
+
+
+@pytest.mark.parametrize("mode", ["script", "transaction"])
+def test_hash_concurrent_changes_conflict_only_on_the_same_field(
+    redis_client: CountingRedis, mode: UpdateMode
+):
+    updater = _hash_updater(redis_client, mode)
+    with updater.update_state() as state:
+        state.update({"state": "ON", "obs_state": "IDLE"})
+    with updater.update_state() as state:
+        redis_client.hset(hash_key(MACHINE_ID), "state", '"OFF"')
+        state["obs_state"] = "READY"
+    assert_that(updater.get_state()).is_equal_to({"state": "OFF", "obs_state": "READY"})
+    with pytest.raises(StateConflict):
+        with updater.update_state() as state:
+            redis_client.hset(hash_key(MACHINE_ID), "obs_state", '"ABORTED"')
+            state["obs_state"] = "SCANNING"
+    assert_that(updater.get_state()).is_equal_to({"state": "OFF", "obs_state": "ABORTED"})
+
+
+def test_hash_reads_of_one_attribute_fetch_only_its_field(redis_client: CountingRedis):
+    updater = _hash_updater(redis_client, "script")
+    with updater.update_state() as state:
+        state.update({"state": "ON", "obs_state": "IDLE"})
+    redis_client.commands.clear()
+    assert_that(updater.get_attribute("obs_state")).is_equal_to("IDLE")
+    assert_that(redis_client.commands).is_equal_to(["HGET"])
+
+
+def test_hash_layout_takes_over_the_json_state(redis_client: CountingRedis):
+    redis_client.set(state_key(MACHINE_ID), json.dumps({"state": "ON", "obs_state": "IDLE"}))
+    updater = _hash_updater(redis_client, "script")
+    assert_that(updater.get_attribute("state")).is_equal_to("ON")
+    assert_that(redis_client.exists(state_key(MACHINE_ID))).is_zero()
+    # emptying the hash (which removes it) does not bring the json state back
+    updater.reset_state()
+    assert_that(_hash_updater(redis_client, "script").get_state()).is_empty()
+
+
+def test_hash_atomic_restores_the_fields(redis_client: CountingRedis):
+    updater = _hash_updater(redis_client, "script")
+    with updater.update_state() as state:
+        state.update({"state": "ON", "obs_state": "IDLE"})
+    with pytest.raises(RuntimeError):
+        with updater.atomic():
+            with updater.update_state() as state:
+                state["obs_state"] = "CONFIGURING"
+                del state["state"]
+            raise RuntimeError("failed to configure")
+    assert_that(updater.get_state()).is_equal_to({"state": "ON", "obs_state": "IDLE"})
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mode", ["script", "transaction", "lock"])
+async def test_hash_async_paths_only_use_the_async_client(
+    redis_server: fakeredis.FakeServer, mode: UpdateMode
+):
+    _, async_client = _networked(redis_server)
+    await async_client.set(state_key(MACHINE_ID), json.dumps({"state": "OFF"}))
+    blocking = BlockingRedis(
+        connection_pool=redis.ConnectionPool(
+            connection_class=fakeredis.FakeRedisConnection, server=redis_server
+        )
+    )
+    updater = RedisHashStateUpdater(blocking, async_client, MACHINE_ID, mode)
+    async with updater.async_atomic():
+        async with updater.async_update_state() as state:
+            state["obs_state"] = "IDLE"
+    assert_that(await updater.async_get_state()).is_equal_to(
+        {"state": "OFF", "obs_state": "IDLE"}
+    )
+    assert_that(await updater.async_get_attribute("obs_state")).is_equal_to("IDLE")
+
+
+def test_keys_take_the_configured_prefix(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(config, "REDIS_KEY_PREFIX", "mv:")
+    assert_that(hash_key()).is_equal_to("mv:state_fields")
+    assert_that(state_channel(MACHINE_ID)).is_equal_to(f"mv:state_control_signals:{MACHINE_ID}")
@@ -0,0 +1,99 @@
+from assertpy import assert_that
+import pytest
+import fakeredis
+
+from mv.state_machine import (
+    get_state_machine,
+    get_state_machine_registry,
+    get_state_updater,
+    reset_state_machine,
+    set_factory_for_memory_use_only,
+    state_server,
+    InFileStateUpdater,
+    StateMachine,
+    DEFAULT_MACHINE_ID,
+)
+from mv._state_machine.redis_backend import RedisStateUpdater
+from .helpers import EventObserver, Publisher
+
+
+@pytest.fixture(name="use_memory_state_machine", autouse=True)
+def fxt_use_memory_state_machine():
+    set_factory_for_memory_use_only()
+
+
+@pytest.fixture(name="machines")
+def fxt_machines():
+    machine_ids = ["subarray/1", "subarray/2"]
+    for machine_id in machine_ids:
+        reset_state_machine(machine_id)
+    return [get_state_machine(machine_id) for machine_id in machine_ids]
+
+
+def test_same_machine_for_same_id():
+    registry = get_state_machine_registry()
+    machine = get_state_machine("subarray/1")
+    assert_that(get_state_machine("subarray/1")).is_same_as(machine)
+    assert_that(machine.machine_id).is_equal_to("subarray/1")
+    assert_that(registry).contains("subarray/1")
+    assert_that(get_state_machine()).is_not_same_as(machine)
+    assert_that(get_state_machine().machine_id).is_equal_to(DEFAULT_MACHINE_ID)
+
+
+def test_machines_have_independent_state(machines: list[StateMachine]):
+    first, second = machines
+    first.switch_on()
+    first.assign_resources()
+    assert_that(first.obs_state).is_equal_to("IDLE")
+    assert_that(second.state).is_none()
+    assert_that(second.obs_state).is_none()
+
+
+def test_lock_of_one_machine_does_not_block_another(machines: list[StateMachine]):
+    first, second = machines
+    first_updater = get_state_updater(first.machine_id)
+    with first_updater.update_state():
+        assert_that(first.busy).is_true()
+        assert_that(second.busy).is_false()
+        second.switch_on()
+    assert_that(second.state).is_equal_to("ON")
+
+
+def test_events_are_published_per_machine(machines: list[StateMachine]):
+    first, second = machines
+    publisher = Publisher()
+    observer = EventObserver()
+    publisher.subscribe(observer)
+    with state_server(publisher, second.machine_id):
+        first.switch_on()
+        first.assign_resources()
+        second.switch_on()
+        while observer.state != {"state": "ON", "obs_state": "EMPTY"}:
+            observer.wait_for_next_event()
+            assert_that(observer.state.get("obs_state")).is_not_equal_to("IDLE")
+
+
+@pytest.mark.usefixtures("build_dir")
+def test_file_state_per_machine():
+    first = InFileStateUpdater("subarray/1")
+    second = InFileStateUpdater("subarray/2")
+    assert_that(first._path).is_not_equal_to(second._path)
+    assert_that(first._path.name).does_not_contain("/")
+    first.reset_state()
+    second.reset_state()
+    with first.update_state() as state:
+        state["state"] = "ON"
+    assert_that(first.get_state()).is_equal_to({"state": "ON"})
+    assert_that(second.get_state()).is_equal_to({})
+
+
+def test_redis_state_per_machine():
+    client = fakeredis.FakeRedis()
+    async_client = fakeredis.FakeAsyncRedis()
+    first = RedisStateUpdater(client, async_client, "subarray/1")
+    second = RedisStateUpdater(client, async_client, "subarray/2")
+    with first.update_state() as state:
+        state["state"] = "ON"
+    assert_that(first.get_state()).is_equal_to({"state": "ON"})
+    assert_that(second.get_state()).is_equal_to({})
+    assert_that(client.get("state")).is_none()
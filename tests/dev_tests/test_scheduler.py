@@ -0,0 +1,160 @@
+import asyncio
+import threading
+from time import perf_counter, sleep
+from assertpy import assert_that
+import pytest
+
+from mv.state_machine import (
+    TransitionScheduler,
+    VirtualClock,
+    get_state_machine,
+    inject_scheduler,
+    reset_state_machine,
+    set_factory_for_memory_use_only,
+    StateMachineBusyError,
+)
+from mv._state_machine.scheduler import CommandCancelled, ScheduledCommand
+from mv._state_machine.transitions import Phase
+
+
+def wait_for(condition, timeout: float = 5):
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return
+        sleep(0.01)
+    raise AssertionError("condition not met in time")
+
+
+@pytest.fixture(name="clock")
+def fxt_clock():
+    return VirtualClock()
+
+
+@pytest.fixture(name="scheduler")
+def fxt_scheduler(clock: VirtualClock):
+    scheduler = TransitionScheduler(clock=clock)
+    inject_scheduler(scheduler)
+    yield scheduler
+    for scheduled in scheduler.in_flight():
+        scheduled.cancel()
+    inject_scheduler(None)
+
+
+@pytest.fixture(name="on_state_machine")
+def fxt_on_state_machine(scheduler: TransitionScheduler):
+    set_factory_for_memory_use_only()
+    reset_state_machine("scheduler")
+    state_machine = get_state_machine("scheduler")
+    state_machine.switch_on()
+    return state_machine
+
+
+def test_timers_fire_in_due_order(scheduler: TransitionScheduler, clock: VirtualClock):
+    fired = []
+    scheduler.call_later(2, lambda: fired.append(2))
+    scheduler.call_later(1, lambda: fired.append(1))
+    scheduler.call_later(3, lambda: fired.append(3)).cancel()
+    clock.advance(5)
+    wait_for(lambda: len(fired) == 2)
+    assert_that(fired).is_equal_to([1, 2])
+
+
+def test_delayed_command_is_inspectable(
+    on_state_machine, scheduler: TransitionScheduler, clock: VirtualClock
+):
+    scheduled = on_state_machine.submit("assign_resources", 10, {"delay": 5})
+    assert_that(on_state_machine.obs_state).is_equal_to("BUSY")
+    assert_that(on_state_machine.pending_command).is_same_as(scheduled)
+    assert_that(scheduled.command).is_equal_to("assign_resources")
+    assert_that(scheduled.due).is_equal_to(10)
+    assert_that(scheduled.next_phase.changes).is_equal_to({"obs_state": "RESOURCING"})
+    assert_that(on_state_machine.busy).is_true()
+    with pytest.raises(StateMachineBusyError):
+        on_state_machine.submit("release_resources")
+    clock.advance(10)
+    wait_for(lambda: on_state_machine.obs_state == "RESOURCING")
+    assert_that(scheduled.due).is_equal_to(15)
+    clock.advance(5)
+    assert_that(scheduled.wait(5)).is_true()
+    assert_that(on_state_machine.obs_state).is_equal_to("IDLE")
+    assert_that(on_state_machine.pending_command).is_none()
+
+
+def test_delayed_command_is_cancellable(
+    on_state_machine, scheduler: TransitionScheduler, clock: VirtualClock
+):
+    scheduled = on_state_machine.submit("assign_resources", 10)
+    assert_that(on_state_machine.cancel_pending_command()).is_true()
+    assert_that(scheduled.cancelled).is_true()
+    assert_that(scheduled.done).is_true()
+    clock.advance(20)
+    sleep(0.05)
+    assert_that(on_state_machine.obs_state).is_equal_to("BUSY")
+    assert_that(scheduler.in_flight()).is_empty()
+
+
+def test_command_finishes_when_its_rollback_fails(scheduler: TransitionScheduler):
+    finished = []
+
+    def apply_phase(phase: Phase):
+        raise RuntimeError("failed to apply")
+
+    def on_error(scheduled: ScheduledCommand, exception: Exception):
+        raise RuntimeError("failed to roll back")
+
+    with pytest.raises(RuntimeError, match="failed to roll back"):
+        scheduler.submit(
+            "scheduler/rollback",
+            "scan",
+            [Phase(None, {"obs_state": "SCANNING"})],
+            apply_phase,
+            on_error,
+            lambda: finished.append(True),
+        )
+    assert_that(finished).is_equal_to([True])
+    assert_that(scheduler.is_busy("scheduler/rollback")).is_false()
+
+
+def test_failure_of_a_delayed_phase_is_logged(
+    scheduler: TransitionScheduler, clock: VirtualClock, caplog: pytest.LogCaptureFixture
+):
+    def apply_phase(phase: Phase):
+        raise RuntimeError("failed to apply")
+
+    scheduled = scheduler.submit(
+        "scheduler/failed", "scan", [Phase(1, {"obs_state": "SCANNING"})], apply_phase
+    )
+    clock.advance(1)
+    wait_for(lambda: scheduled.done)
+    assert_that(caplog.text).contains("scan of scheduler/failed failed", "failed to apply")
+    with pytest.raises(RuntimeError):
+        scheduled.wait()
+
+
+@pytest.mark.asyncio
+async def test_async_command_cancelled_between_sleeps_does_not_sleep_again(
+    scheduler: TransitionScheduler,
+):
+    scheduled = scheduler.register("scheduler/async", "scan", [])
+    # as if cancelled whilst writing a phase, with no sleep to interrupt
+    scheduled.cancel()
+    start = perf_counter()
+    with pytest.raises(CommandCancelled):
+        await asyncio.wait_for(scheduled.async_sleep(10), 1)
+    assert_that(perf_counter() - start).is_less_than(0.5)
+
+
+def test_thread_count_is_flat(scheduler: TransitionScheduler, clock: VirtualClock):
+    set_factory_for_memory_use_only()
+    machine_ids = [f"scheduler/{index}" for index in range(200)]
+    for machine_id in machine_ids:
+        reset_state_machine(machine_id)
+    scheduler.call_later(None, lambda: None)
+    threads = threading.active_count()
+    commands = [get_state_machine(machine_id).submit("switch_on", 1) for machine_id in machine_ids]
+    assert_that(scheduler.in_flight()).is_length(200)
+    assert_that(threading.active_count()).is_equal_to(threads)
+    clock.advance(1)
+    for scheduled in commands:
+        scheduled.wait(5)
+    assert_that({get_state_machine(id).state for id in machine_ids}).is_equal_to({"ON"})
@@ -0,0 +1,199 @@
+import asyncio
+import multiprocessing
+import threading
+from pathlib import Path
+from queue import Empty
+from assertpy import assert_that
+import pytest
+
+from mv.state_machine import SqliteStateServer, SqliteStateUpdater
+from .helpers import StatePublisher
+
+WRITES = 50
+
+
+pytestmark = pytest.mark.usefixtures("build_dir")
+
+
+@pytest.fixture(name="machine_id")
+def fxt_machine_id(request: pytest.FixtureRequest) -> str:
+    # the states published are remembered per machine for the whole process
+    return f"sqlite/{request.node.name}"
+
+
+def _write(machine_id: str, *obs_states: str):
+    updater = SqliteStateUpdater(machine_id)
+    for obs_state in obs_states:
+        with updater.update_state() as state:
+            state["obs_state"] = obs_state
+
+
+def test_writes_record_the_transitions(machine_id: str, build_dir: Path):
+    updater = SqliteStateUpdater(machine_id)
+    with updater.update_state() as state:
+        state.update({"state": "ON", "obs_state": "EMPTY"})
+    _write(machine_id, "IDLE", "IDLE")
+    with updater.update_state() as state:
+        del state["obs_state"]
+    assert_that(SqliteStateUpdater(machine_id).get_state()).is_equal_to({"state": "ON"})
+    assert_that(updater.version).is_equal_to(3)
+    # a write that changes nothing is not recorded
+    records = [
+        {key: value for key, value in record.items() if key != "at"}
+        for record in updater.history()
+    ]
+    assert_that(records).is_equal_to(
+        [
+            {"version": 1, "set": {"state": "ON", "obs_state": "EMPTY"}},
+            {"version": 2, "set": {"obs_state": "IDLE"}},
+            {"version": 3, "del": ["obs_state"]},
+        ]
+    )
+    assert_that((build_dir / "state.db").exists()).is_true()
+
+
+def test_machines_are_kept_apart(machine_id: str):
+    _write(f"{machine_id}/1", "IDLE")
+    _write(f"{machine_id}/2", "READY")
+    assert_that(SqliteStateUpdater(f"{machine_id}/1").get_state()).is_equal_to(
+        {"obs_state": "IDLE"}
+    )
+    assert_that(SqliteStateUpdater(f"{machine_id}/2").version).is_equal_to(1)
+
+
+def test_unchanged_state_is_not_parsed_again(machine_id: str):
+    _write(machine_id, "IDLE")
+    reader = SqliteStateUpdater(machine_id)
+    first = reader.get_state()
+    assert_that(reader.get_state()).is_same_as(first)
+    _write(machine_id, "READY")
+    assert_that(reader.get_attribute("obs_state")).is_equal_to("READY")
+
+
+def test_a_failed_update_changes_nothing(machine_id: str):
+    updater = SqliteStateUpdater(machine_id)
+    _write(machine_id, "IDLE")
+    with pytest.raises(RuntimeError):
+        with updater.update_state() as state:
+            state["obs_state"] = "CONFIGURING"
+            raise RuntimeError("failed to configure")
+    assert_that(updater.get_state()).is_equal_to({"obs_state": "IDLE"})
+    # the database was left for other writers
+    _write(machine_id, "READY")
+    assert_that(updater.version).is_equal_to(2)
+
+
+def test_atomic_rolls_back_with_a_transition(machine_id: str):
+    updater = SqliteStateUpdater(machine_id)
+    _write(machine_id, "IDLE")
+    with pytest.raises(RuntimeError):
+        with updater.atomic():
+            _write(machine_id, "CONFIGURING")
+            raise RuntimeError("failed to configure")
+    assert_that(updater.get_state()).is_equal_to({"obs_state": "IDLE"})
+    assert_that([record.get("set") for record in updater.history()]).is_equal_to(
+        [{"obs_state": "IDLE"}, {"obs_state": "CONFIGURING"}, {"obs_state": "IDLE"}]
+    )
+
+
+def test_only_the_latest_transitions_are_kept(machine_id: str):
+    updater = SqliteStateUpdater(machine_id, history_keep=2)
+    _write(machine_id, "IDLE", "READY")
+    with updater.update_state() as state:
+        state["obs_state"] = "SCANNING"
+    assert_that([record["version"] for record in updater.history()]).is_equal_to([2, 3])
+
+
+@pytest.mark.asyncio
+async def test_async_updates_wait_for_other_writers_without_holding_up_the_loop(
+    machine_id: str,
+):
+    updater = SqliteStateUpdater(machine_id)
+    other = updater.connect()
+    other.execute("BEGIN IMMEDIATE")
+
+    async def update():
+        async with updater.async_atomic():
+            async with updater.async_update_state() as state:
+                state["state"] = "ON"
+
+    task = asyncio.create_task(update())
+    await asyncio.sleep(0.05)
+    assert_that(task.done()).is_false()
+    other.execute("ROLLBACK")
+    other.close()
+    await asyncio.wait_for(task, 2)
+    assert_that(updater.get_state()).is_equal_to({"state": "ON"})
+
+
+def _count(machine_id: str, writes: int):
+    updater = SqliteStateUpdater(machine_id)
+    for _ in range(writes):
+        with updater.update_state() as state:
+            state["count"] = state.get("count", 0) + 1
+
+
+def test_processes_sharing_the_database_lose_no_updates(machine_id: str):
+    reader = SqliteStateUpdater(machine_id)
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=_count, args=(machine_id, WRITES)) for _ in range(4)]
+    for process in processes:
+        process.start()
+    _count(machine_id, WRITES)
+    for process in processes:
+        process.join(10)
+    assert_that(reader.get_state()).is_equal_to({"count": 5 * WRITES})
+    assert_that(reader.version).is_equal_to(5 * WRITES)
+
+
+def test_commits_of_other_processes_are_published(machine_id: str):
+    publisher = StatePublisher()
+    server = SqliteStateServer(publisher, SqliteStateUpdater(machine_id), machine_id)
+    server.start_server()
+    try:
+        context = multiprocessing.get_context("fork")
+        process = context.Process(target=_write, args=(machine_id, "IDLE"))
+        process.start()
+        process.join(5)
+        assert_that(publisher.next()).is_equal_to({"obs_state": "IDLE"})
+        # writes of this process are published once
+        _write(machine_id, "READY")
+        assert_that(publisher.next()).is_equal_to({"obs_state": "READY"})
+        with pytest.raises(Empty):
+            publisher.next(timeout=0.3)
+    finally:
+        server.stop_server()
+
+
+def _pollers() -> int:
+    return sum(thread.name == "sqlite-poller" for thread in threading.enumerate())
+
+
+def test_servers_of_a_database_share_one_poller(machine_id: str):
+    pollers = _pollers()
+    publishers = {f"{machine_id}/{index}": StatePublisher() for index in range(3)}
+    servers = [
+        SqliteStateServer(publisher, SqliteStateUpdater(machine), machine)
+        for machine, publisher in publishers.items()
+    ]
+    for server in servers:
+        server.start_server()
+    try:
+        assert_that(_pollers()).is_equal_to(pollers + 1)
+        context = multiprocessing.get_context("fork")
+        process = context.Process(target=_write, args=(f"{machine_id}/1", "IDLE"))
+        process.start()
+        process.join(5)
+        assert_that(publishers[f"{machine_id}/1"].next()).is_equal_to({"obs_state": "IDLE"})
+        # the machines that did not change publish nothing
+        with pytest.raises(Empty):
+            publishers[f"{machine_id}/0"].next(timeout=0.3)
+        servers.pop(0).stop_server()
+        process = context.Process(target=_write, args=(f"{machine_id}/2", "READY"))
+        process.start()
+        process.join(5)
+        assert_that(publishers[f"{machine_id}/2"].next()).is_equal_to({"obs_state": "READY"})
+    finally:
+        for server in servers:
+            server.stop_server()
+    assert_that(_pollers()).is_equal_to(pollers)
@@ -1,8 +1,6 @@
 from concurrent.futures import ThreadPoolExecutor, TimeoutError
 from contextlib import contextmanager
-from threading import Event
 from typing import Any, Callable
-from unittest import mock
 from assertpy import assert_that
 import pytest
 from time import sleep
@@ -14,6 +12,12 @@ from mv.state_machine import (
     reset_state_machine,
     CommandNotAllowed,
 )
+from mv._state_machine.scheduler import (
+    ScheduledCommand,
+    TransitionScheduler,
+    inject_scheduler,
+)
+from mv._state_machine.clock import VirtualClock
 
 
 def polled_sleep(
@@ -35,33 +39,36 @@ class CommandNotIgnored(Exception):
 class FakeTicker:
 
     def __init__(self):
-        self._sleeping = Event()
-        self._unblocked = Event()
+        self.clock = VirtualClock()
+        self.scheduler = TransitionScheduler(clock=self.clock)
         self._initiated_sleep = False
-        self.sleep_called = 0
         self._future = None
         self._executor = None
-        self._canceled = False
 
     def cancel_sleep(self):
-        self._canceled = True
+        # every timer is due straight away
+        self.clock.advance_to(float("inf"))
+
+    def _pending(self) -> ScheduledCommand | None:
+        for scheduled in self.scheduler.in_flight():
+            if (due := scheduled.due) is not None and due > self.clock.now():
+                return scheduled
+        return None
 
     def stop_sleeping(self):
         self.wait_until_sleeping(10)
-        self._unblocked.set()
-        self._sleeping.clear()
+        if scheduled := self._pending():
+            self.clock.advance_to(scheduled.due)
 
     def assert_command_ignored(self):
         try:
             self._future.result(0.1)
         except TimeoutError as time_out_err:
-            if self._sleeping.is_set():
-                self._unblocked.clear()
             raise CommandNotIgnored() from time_out_err
         except Exception as exception:
             raise CommandNotIgnored() from exception
-        # if sleep not called then we can assume the method wasnt' ran
-        if self.sleep_called != 0:
+        # if nothing got scheduled then we can assume the method wasnt' ran
+        if self.scheduler.in_flight():
             raise CommandNotIgnored()
 
     @contextmanager
@@ -73,9 +80,9 @@ class FakeTicker:
 
     def tick(self):
         """
-        Advance the program to the point where a thread is sleeping.
-        If the thread is already sleeping it will advance to the point where the next sleep
-        command is called.
+        Advance the program to the point where a command waits on a delayed phase.
+        If the command is already waiting it will advance to the point where the next
+        delayed phase is scheduled.
         """
         if self._initiated_sleep:
             self.stop_sleeping()
@@ -84,35 +91,24 @@ class FakeTicker:
 
     def tock(self):
         """
-        Lets a thread continue by breaking the sleeping block.
+        Lets a command continue by firing the timer of its delayed phase.
         """
         self.stop_sleeping()
-        return self._future.result()
+        return self._future.result(10)
 
     def clear(self):
-        self._unblocked.set()
-
-    def fake_sleep(self, _):
-        self.sleep_called += 1
-        if self._canceled:
-            return
-        self._sleeping.set()
-        returned_without_time_out = self._unblocked.wait(timeout=10)
-        if not returned_without_time_out:
-            raise Exception(
-                "returned with the timeout of 10 seconds, did you remember to tick?"
-            )
-        self._unblocked.clear()
+        for scheduled in self.scheduler.in_flight():
+            scheduled.cancel()
 
     def wait_until_sleeping(self, timeout: float = 5):
         assert self._future
-        sleep_interval = polled_sleep(timeout)
+        sleep_interval = polled_sleep(timeout, 0.01)
         while next(sleep_interval):
             if self._future.done():
                 if exception := self._future.exception():
                     raise exception
                 return self._future.result()
-            if self._sleeping.is_set():
+            if self._pending():
                 return
         raise Exception(
             f"returned with the timeout of {timeout} seconds, did you remember to tick?"
@@ -142,9 +138,9 @@ def fxt_ticker():
 
 @pytest.fixture(name="use_fake_time")
 def fxt_use_fake_time(ticker: FakeTicker):
-    with mock.patch("mv._state_machine.state_machine.sleep") as mock_sleep:
-        mock_sleep.side_effect = ticker.fake_sleep
-        yield
+    inject_scheduler(ticker.scheduler)
+    yield
+    inject_scheduler(None)
 
 
 @pytest.mark.usefixtures("use_memory_state_machine")
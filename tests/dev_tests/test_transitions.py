@@ -0,0 +1,55 @@
+from assertpy import assert_that
+import pytest
+
+from mv.state_machine import StateMachine, set_factory_for_memory_use_only
+from mv._state_machine.transitions import TransitionTable
+
+
+@pytest.fixture(name="table")
+def fxt_table():
+    return TransitionTable(
+        StateMachine._allowed_commands,
+        StateMachine._ignore_if_in,
+        StateMachine._must_be_on,
+    )
+
+
+@pytest.mark.parametrize(
+    "command, state, verdict",
+    [
+        ("switch_on", {}, "RUN"),
+        ("switch_on", {"state": "ON", "obs_state": "EMPTY"}, "IGNORE"),
+        ("switch_off", {"state": "ON", "obs_state": "IDLE"}, "NOT_ALLOWED"),
+        ("assign_resources", {"state": "OFF"}, "NOT_ON"),
+        ("assign_resources", {"state": "ON", "obs_state": "EMPTY"}, "RUN"),
+        ("assign_resources", {"state": "ON", "obs_state": "IDLE"}, "IGNORE"),
+        ("scan", {"state": "ON", "obs_state": "IDLE"}, "NOT_ALLOWED"),
+        ("scan", {"state": "ON", "obs_state": "SCANNING"}, "IGNORE"),
+        ("abort", {"state": "ON", "obs_state": "SCANNING"}, "RUN"),
+    ],
+)
+def test_verdicts(table: TransitionTable, command: str, state: dict, verdict: str):
+    assert_that(table.check(command, state)).is_equal_to(verdict)
+
+
+def test_unknown_state_is_evaluated(table: TransitionTable):
+    assert_that(table.check("scan", {"state": "ON", "obs_state": "FOO"})).is_equal_to(
+        "NOT_ALLOWED"
+    )
+
+
+def test_single_state_read_per_check():
+    set_factory_for_memory_use_only()
+    state_machine = StateMachine("transitions")
+    state_machine.reset_state()
+    state_machine.switch_on()
+    reads = []
+    get_state = state_machine._updater.get_state
+
+    def counting_get_state():
+        reads.append(1)
+        return get_state()
+
+    state_machine._updater.get_state = counting_get_state
+    state_machine.assign_resources()
+    assert_that(reads).is_length(1)
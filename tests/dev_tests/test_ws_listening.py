@@ -1,7 +1,13 @@
 import asyncio
+from contextlib import contextmanager
+import json
+from queue import Queue
 from assertpy import assert_that
 import pytest
+from websockets.exceptions import ConnectionClosedError
 from mv.client import AsyncMockWSServer, MockWSServer
+from mv._client import ws_listener
+from mv._client.ws_listener import WSListener
 from .helpers import MessageObserver, AsynchMessageObserver
 
 
@@ -44,3 +50,51 @@ def test_real_listening(listening: MockWSServer, observer: MessageObserver):
     websocket.send(tx_message)
     rx_message = observer.message.get()
     assert_that(rx_message).is_equal_to(tx_message)
+
+
+class DroppingWebSocket:
+    # sends the given events and then loses the connection (unless closed before)
+
+    def __init__(self, *events: dict) -> None:
+        self.messages = Queue[str | Exception]()
+        for event in events:
+            self.messages.put(json.dumps(event))
+
+    def drop(self):
+        self.messages.put(ConnectionClosedError(None, None))
+
+    def recv(self):
+        message = self.messages.get()
+        if isinstance(message, Exception):
+            raise message
+        return message
+
+    def send(self, message):
+        pass
+
+    def close(self):
+        self.messages.put(Exception("closed"))
+
+
+def test_listener_reconnects_since_the_last_event(
+    monkeypatch: pytest.MonkeyPatch, observer: MessageObserver
+):
+    first = DroppingWebSocket({"state": "ON", "seq": 1})
+    first.drop()
+    second = DroppingWebSocket({"state": "OFF", "seq": 2})
+    websockets = iter([first, second])
+    connected_since = []
+
+    @contextmanager
+    def get_websocket(since=None):
+        connected_since.append(since)
+        yield next(websockets)
+
+    monkeypatch.setattr(ws_listener, "get_websocket", get_websocket)
+    monkeypatch.setattr(ws_listener, "RECONNECT_DELAY", 0)
+    listener = WSListener(observer)
+    with listener.listening():
+        assert_that(observer.message.get(timeout=1)).is_equal_to({"state": "ON"})
+        assert_that(observer.message.get(timeout=1)).is_equal_to({"state": "OFF"})
+    assert_that(connected_since).is_equal_to([None, 1])
+    assert_that(listener.since).is_equal_to(2)